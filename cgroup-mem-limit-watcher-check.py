@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+
+"""
+Checks MemoryEvents and Watcher of cgroup-mem-limit-watcher.py on a fake cgroup tree in a temp dir,
+i.e. plain files instead of the kernel interface, and a child process as the signal target:
+the notification registrations and their fallbacks, and the escalation states of the watcher.
+
+Exits with code 1 if a check fails.
+
+Example::
+
+	./cgroup-mem-limit-watcher-check.py
+"""
+
+import os
+import sys
+import time
+import signal
+import shutil
+import tempfile
+import importlib.util
+from subprocess import Popen, PIPE
+
+MyDir = os.path.dirname(os.path.abspath(__file__))
+Limit = 1000 * 1024 * 1024
+
+# Reports the signals it gets on stdout, one per line.
+ChildCode = """
+import signal, sys, time
+def handler(signum, frame):
+	sys.stdout.write("%i\\n" % signum)
+	sys.stdout.flush()
+signal.signal(signal.SIGUSR1, handler)
+signal.signal(signal.SIGTERM, handler)
+sys.stdout.write("ready\\n")
+sys.stdout.flush()
+time.sleep(60)
+"""
+
+
+def loadWatcherModule():
+	"""
+	:return: cgroup-mem-limit-watcher.py as a module
+	"""
+	sys.path.insert(0, MyDir)
+	spec = importlib.util.spec_from_file_location(
+		"cgroup_mem_limit_watcher", os.path.join(MyDir, "cgroup-mem-limit-watcher.py"))
+	mod = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(mod)
+	return mod
+
+
+class FakeClock:
+	"""
+	Replaces the time module in the watcher module, so that we don't need to wait for the grace period.
+	"""
+
+	def __init__(self):
+		self.now = time.time()
+
+	def time(self):
+		return self.now
+
+
+class Env:
+	"""
+	Fake cgroup tree, and the watcher module.
+	"""
+
+	def __init__(self, tmpDir):
+		"""
+		:param str tmpDir:
+		"""
+		self.tmpDir = tmpDir
+		self.mod = loadWatcherModule()
+		self.cgroupModule = sys.modules["i6lib.cgroup"]
+		self.count = 0
+
+	def makeCgroup(self, version, procs=(), files=None):
+		"""
+		:param int version: 1 or 2
+		:param list[int]|tuple[int] procs:
+		:param dict[str,str]|None files: additional files, e.g. the notification files
+		:return: cgroup dir
+		:rtype: str
+		"""
+		self.count += 1
+		d = os.path.join(self.tmpDir, "cg%i" % self.count)
+		os.mkdir(d)
+		if version == 2:
+			base = {"memory.current": "0\n", "memory.max": "%i\n" % Limit, "memory.stat": "anon 0\nfile 0\n"}
+		else:
+			base = {
+				"memory.usage_in_bytes": "0\n", "memory.limit_in_bytes": "%i\n" % Limit,
+				"memory.stat": "total_rss 0\ntotal_cache 0\ntotal_swap 0\n"}
+		base["cgroup.procs"] = "".join(["%i\n" % pid for pid in procs])
+		base.update(files or {})
+		for filename, content in base.items():
+			with open(os.path.join(d, filename), "w") as f:
+				f.write(content)
+		return d
+
+	def setRss(self, cgroupDir, rss):
+		"""
+		:param str cgroupDir: v2
+		:param int rss:
+		"""
+		with open(os.path.join(cgroupDir, "memory.stat"), "w") as f:
+			f.write("anon %i\nfile 0\n" % rss)
+
+
+def checkEventsV2OnPlainFiles(env):
+	d = env.makeCgroup(2, files={"memory.events": "low 0\nhigh 0\nmax 0\noom 0\noom_kill 0\n", "memory.pressure": ""})
+	cgroup = env.cgroupModule.MemoryCgroup(d)
+	events = env.mod.MemoryEvents(cgroup)
+	try:
+		assert sorted(events.fds.values()) == ["memory.events", "memory.pressure"], events.fds
+		assert open(os.path.join(d, "memory.pressure")).read() == events.PsiTrigger
+		# Plain files never report POLLPRI, so this must block for the timeout, and not spin.
+		start = time.time()
+		assert events.wait(0.2) == []
+		duration = time.time() - start
+		assert 0.15 <= duration < 1., "wait took %.2f secs" % duration
+	finally:
+		events.close()
+		cgroup.close()
+	assert not events.isActive() and events.files == []
+
+
+def checkEventsV2Missing(env):
+	d = env.makeCgroup(2)
+	cgroup = env.cgroupModule.MemoryCgroup(d)
+	events = env.mod.MemoryEvents(cgroup)
+	try:
+		assert not events.isActive(), events.fds
+		events.setThreshold(Limit // 2)  # noop for v2
+		assert not events.isActive(), events.fds
+		start = time.time()
+		assert events.wait(0.1) == []
+		assert time.time() - start >= 0.05
+	finally:
+		events.close()
+		cgroup.close()
+
+
+def checkEventsV1EventFd(env):
+	d = env.makeCgroup(1, files={"memory.pressure_level": "", "cgroup.event_control": ""})
+	cgroup = env.cgroupModule.MemoryCgroup(d)
+	events = env.mod.MemoryEvents(cgroup)
+	try:
+		assert list(events.fds.values()) == ["memory.pressure_level"], events.fds
+		efd, = events.fds
+		args = open(os.path.join(d, "cgroup.event_control")).read().split()
+		assert args[0] == str(efd) and args[2] == events.PressureLevel, args
+		events.setThreshold(Limit // 2)
+		events.setThreshold(Limit // 4)  # replaces the previous threshold
+		assert sorted(events.fds.values()) == ["memory.pressure_level", "memory.usage_in_bytes"], events.fds
+		thresholdFd = events.thresholdFds[0]
+		args = open(os.path.join(d, "cgroup.event_control")).read().split()
+		assert args[0] == str(thresholdFd) and args[2] == str(Limit // 4), args
+		# What the kernel would do when the threshold is crossed.
+		os.eventfd_write(thresholdFd, 1)
+		assert events.wait(1.) == ["memory.usage_in_bytes"]
+		assert events.wait(0.) == [], "notification not drained"
+	finally:
+		events.close()
+		cgroup.close()
+	assert not events.isActive() and events.files == []
+
+
+class WatcherRun:
+	"""
+	Watcher on a fake v2 cgroup, with a child process and ourselves in it.
+	"""
+
+	def __init__(self, env, sendSignals, grace=10.):
+		"""
+		:param Env env:
+		:param bool sendSignals:
+		:param float grace:
+		"""
+		self.env = env
+		self.child = Popen([sys.executable, "-c", ChildCode], stdout=PIPE)
+		assert self.child.stdout.readline() == b"ready\n"
+		self.dir = env.makeCgroup(2, procs=[os.getpid(), self.child.pid])
+		self.cgroup = env.cgroupModule.MemoryCgroup(self.dir)
+		self.clock = FakeClock()
+		env.mod.time = self.clock
+		self.logs = []
+		self.watcher = env.mod.Watcher(
+			self.cgroup, horizon=30., grace=grace, window=30., hysteresis=0.1, sendSignals=sendSignals)
+		self.watcher.log = self.logs.append
+
+	def step(self, rss, secs=1.):
+		"""
+		:param int rss:
+		:param float secs: fake time since the last step
+		:return: Watcher.check result
+		:rtype: bool
+		"""
+		self.clock.now += secs
+		self.env.setRss(self.dir, rss)
+		return self.watcher.check(Limit)
+
+	def readSignal(self):
+		"""
+		:return: next signal the child reported
+		:rtype: int
+		"""
+		return int(self.child.stdout.readline())
+
+	def close(self):
+		self.env.mod.time = time
+		self.child.kill()
+		self.child.wait()
+		self.cgroup.close()
+
+
+def checkWatcherEscalation(env):
+	run = WatcherRun(env, sendSignals=True)
+	try:
+		assert not run.step(Limit // 10)
+		assert run.watcher.state == "normal"
+		assert run.step(Limit * 96 // 100)
+		assert run.watcher.state == "notified", run.logs
+		assert run.watcher.proc == run.child.pid, "signal target %r, logs: %r" % (run.watcher.proc, run.logs)
+		assert run.readSignal() == signal.SIGUSR1
+		for i in range(5):  # still rising, but within the grace period
+			run.step(Limit * (96 + i // 2) // 100)
+		assert run.watcher.state == "notified", run.logs
+		run.step(Limit * 99 // 100, secs=10.)
+		assert run.watcher.state == "escalated", run.logs
+		assert run.readSignal() == signal.SIGTERM
+		run.step(Limit * 90 // 100)  # within the hysteresis
+		assert run.watcher.state == "escalated", run.logs
+		for i in range(40):  # the rising samples leave the window
+			run.step(Limit // 10)
+		assert run.watcher.state == "normal", run.logs
+		assert not run.step(Limit // 10)
+	finally:
+		run.close()
+
+
+def checkWatcherLogOnly(env):
+	run = WatcherRun(env, sendSignals=False, grace=0.)
+	try:
+		for i in range(10):
+			run.step(Limit * (96 + i // 4) // 100)
+		assert run.watcher.state == "escalated", run.logs
+		wouldSend = [msg for msg in run.logs if msg.startswith("would send signal")]
+		assert wouldSend == [
+			"would send signal SIGUSR1 to proc %i (log only)" % run.child.pid,
+			"would send signal SIGTERM to proc %i (log only)" % run.child.pid], run.logs
+		run.child.kill()
+		assert run.child.stdout.read() == b"", "child got a signal"
+	finally:
+		run.close()
+
+
+def checkWatcherProcGone(env):
+	run = WatcherRun(env, sendSignals=True)
+	try:
+		run.child.kill()
+		run.child.wait()
+		run.step(Limit * 96 // 100)  # the pid is still in cgroup.procs, but gone
+		assert run.watcher.state == "normal", run.logs
+		assert run.watcher.proc is None, run.logs
+	finally:
+		run.close()
+
+
+Checks = [
+	checkEventsV2OnPlainFiles, checkEventsV2Missing, checkEventsV1EventFd,
+	checkWatcherEscalation, checkWatcherLogOnly, checkWatcherProcGone]
+
+
+def main():
+	tmpDir = tempfile.mkdtemp(prefix="cgroup-mem-limit-watcher-check-")
+	ok = True
+	try:
+		env = Env(tmpDir)
+		for check in Checks:
+			try:
+				check(env)
+			except AssertionError as exc:
+				print("%s: FAILED: %s" % (check.__name__, exc))
+				ok = False
+			else:
+				print("%s: ok" % check.__name__)
+	finally:
+		shutil.rmtree(tmpDir)
+	sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+	main()
@@ -1,69 +1,619 @@
 #!/usr/bin/env python3
 # Author: Albert Zeyer
 import sys, time, os
-import resource, signal
+import signal
+import select
+from argparse import ArgumentParser
+from collections import deque
+from fnmatch import fnmatch
+import json
+from i6lib.str_ import byteNumRepr
+from i6lib.cgroup import MemoryCgroup, getMemoryCgroupRoot, findLimitedCgroups
+from i6lib.proc import scanProcs, getTreeMemUsage, getOwnAncestry, findSignalTarget
+from i6lib.metrics import MetricsRegistry, MetricsExporter
 
 MemUsageFactorLimit = 0.95
+PredictMinUsageFactor = 0.5  # below this, we don't predict, e.g. the steep ramp at the start of a job is fine
 NotifySignal = signal.SIGUSR1
 
-def byteNumRepr(c):
-	if c < 1024: return "%i B" % c
-	S = "KMG"
-	i = 0
-	while i < len(S) - 1:
-		if c < 0.8 * 1024 ** (i + 2): break
-		i += 1
-	f = float(c) / (1024 ** (i + 1))
-	return "%.1f %sB" % (f, S[i])
+def getProcOomScore(procId):
+	return int(open("/proc/%i/oom_score" % procId).read())
 
-def getRssLimit():
-	return int(open("/sys/fs/cgroup/memory/memory.limit_in_bytes").read())
 
-def getProcs():
-	procs = open("/sys/fs/cgroup/memory/cgroup.procs").read().splitlines()
-	return list(map(int, procs))
 
-def getProcOomScore(procId):
-	return int(open("/proc/%i/oom_score" % procId).read())
+class MemoryEvents:
+	"""
+	Kernel notifications about the memory usage of the cgroup,
+	so that we can react within milliseconds, and not only at the next poll.
+
+	cgroup v1: eventfds registered via cgroup.event_control,
+	for a memory.usage_in_bytes threshold, and for memory.pressure_level.
+	cgroup v2: changes of memory.events, and a PSI trigger on memory.pressure, via poll(POLLPRI).
+
+	If the kernel or the permissions do not allow some of these, we just go without them.
+	"""
+
+	PressureLevel = "medium"
+	PsiTrigger = "some 150000 2000000"  # 150ms stall within 2s. unprivileged triggers need a 2s window
+
+	def __init__(self, cgroup, poll=None):
+		"""
+		:param MemoryCgroup cgroup:
+		:param select.poll|None poll: to share one poll object between multiple cgroups
+		"""
+		self.cgroupDir = cgroup.dir
+		self.version = cgroup.version
+		self.poll = poll or select.poll()
+		self.fds = {}  # fd -> name
+		self.files = []  # fds which must stay open for the registrations
+		self.thresholdFds = None  # (eventfd, usage fd), v1
+		if self.version == 2:
+			self._register("memory.events", self._openPollFile("memory.events", os.O_RDONLY))
+			fd = self._openPollFile("memory.pressure", os.O_RDWR | os.O_NONBLOCK)
+			if fd is not None:
+				try:
+					os.write(fd, self.PsiTrigger.encode("utf8"))
+				except OSError as exc:
+					print("%s/memory.pressure trigger not available: %s" % (self.cgroupDir, exc))
+					os.close(fd)
+					fd = None
+			self._register("memory.pressure", fd)
+		else:
+			self._register("memory.pressure_level", self._registerEventFd("memory.pressure_level", self.PressureLevel))
+
+	def _openPollFile(self, filename, flags):
+		try:
+			fd = os.open("%s/%s" % (self.cgroupDir, filename), flags)
+		except OSError as exc:
+			print("%s/%s not available: %s" % (self.cgroupDir, filename, exc))
+			return None
+		if filename == "memory.events":
+			os.pread(fd, 4096, 0)  # arm the notification
+		return fd
+
+	def _registerEventFd(self, filename, arg):
+		"""
+		cgroup v1.
+
+		:param str filename: e.g. memory.usage_in_bytes
+		:param str arg: e.g. the threshold
+		:return: (eventfd, fd of filename), or None
+		:rtype: (int,int)|None
+		"""
+		if not hasattr(os, "eventfd"):
+			return None
+		efd = fd = None
+		try:
+			efd = os.eventfd(0, os.EFD_CLOEXEC | os.EFD_NONBLOCK)
+			fd = os.open("%s/%s" % (self.cgroupDir, filename), os.O_RDONLY)
+			with open("%s/cgroup.event_control" % self.cgroupDir, "w") as f:
+				f.write("%i %i %s" % (efd, fd, arg))
+		except (IOError, OSError) as exc:
+			print("%s/%s notification not available: %s" % (self.cgroupDir, filename, exc))
+			for fd_ in (efd, fd):
+				if fd_ is not None:
+					os.close(fd_)
+			return None
+		return efd, fd
+
+	def _register(self, name, fds):
+		"""
+		:param str name:
+		:param int|(int,int)|None fds: fd to poll, or (eventfd, fd to keep open)
+		"""
+		if fds is None:
+			return
+		if isinstance(fds, tuple):
+			self.files.append(fds[1])
+			fds = fds[0]
+			self.poll.register(fds, select.POLLIN)
+		else:
+			self.poll.register(fds, select.POLLPRI)
+		self.files.append(fds)
+		self.fds[fds] = name
+
+	def _unregister(self, fds):
+		"""
+		:param (int,int) fds: (eventfd, fd)
+		"""
+		self.poll.unregister(fds[0])
+		del self.fds[fds[0]]
+		for fd in fds:
+			self.files.remove(fd)
+			os.close(fd)  # closing the eventfd also removes the registration
+
+	def isActive(self):
+		return bool(self.fds)
+
+	def setThreshold(self, threshold):
+		"""
+		Notify when the usage crosses the threshold. Only cgroup v1.
+
+		:param int threshold: in bytes
+		"""
+		if self.version == 2:
+			return
+		if self.thresholdFds:
+			self._unregister(self.thresholdFds)
+		self.thresholdFds = self._registerEventFd("memory.usage_in_bytes", str(int(threshold)))
+		self._register("memory.usage_in_bytes", self.thresholdFds)
+
+	def wait(self, timeout):
+		"""
+		:param float timeout: in secs
+		:return: names of the notifications which fired. empty on timeout
+		:rtype: list[str]
+		"""
+		try:
+			events = self.poll.poll(timeout * 1000)
+		except InterruptedError:
+			return []
+		return [self.handleEvent(fd) for fd, _ in events]
+
+	def handleEvent(self, fd):
+		"""
+		Drains the notification, so that poll blocks again.
+
+		:param int fd: one of self.fds
+		:return: name of the notification
+		:rtype: str
+		"""
+		if self.fds[fd] == "memory.events":
+			os.pread(fd, 4096, 0)  # re-arm
+		elif self.fds[fd] != "memory.pressure":
+			try:
+				os.eventfd_read(fd)
+			except BlockingIOError:
+				pass
+		return self.fds[fd]
+
+	def close(self):
+		for fd in self.fds:
+			self.poll.unregister(fd)
+		for fd in self.files:
+			os.close(fd)
+		self.fds.clear()
+		self.files = []
+
+
+def getSignalTarget(cgroup, usePss=False, log=print):
+	"""
+	:param MemoryCgroup cgroup:
+	:param bool usePss: attribute memory via PSS instead of RSS
+	:param log: print function
+	:return: pid of the process which uses the most memory, together with its children, or None if there are no procs.
+		this is never the watcher itself or one of its ancestors, e.g. the job shell
+	:rtype: int|None
+	"""
+	# Aggregate by process tree, e.g. the main process together with its data loader workers.
+	procs = scanProcs(cgroup.getProcs(), smaps=usePss)
+	for pid in getOwnAncestry():
+		procs.pop(pid, None)
+	trees = getTreeMemUsage(procs)
+	log("top process trees:")
+	for mem,root,pids in trees[:3]:
+		log("%i (%s, %i procs): %s" % (root, procs[root].comm, len(pids), byteNumRepr(mem)))
+	pid = findSignalTarget(procs)
+	if pid is not None:
+		log("signal target: %i (%s)" % (pid, procs[pid].comm))
+	return pid
+
+
+class LimitPredictor:
+	"""
+	Keeps a sliding window of (time, rss) samples,
+	and estimates the growth rate via linear regression,
+	and from that the time until the limit is hit.
+	"""
+
+	def __init__(self, window, minSamples=5):
+		"""
+		:param float window: in secs
+		:param int minSamples: before we predict anything
+		"""
+		self.window = window
+		self.minSamples = minSamples
+		self.samples = deque()
+
+	def add(self, t, used):
+		"""
+		:param float t:
+		:param int used:
+		"""
+		self.samples.append((t, used))
+		while self.samples[0][0] < t - self.window:
+			self.samples.popleft()
+
+	def getSlope(self):
+		"""
+		:return: growth rate in bytes/sec, or None if we don't have enough samples yet
+		:rtype: float|None
+		"""
+		n = len(self.samples)
+		if n < max(self.minSamples, 3):
+			return None
+		t0 = self.samples[0][0]
+		if self.samples[-1][0] - t0 < 1.:
+			return None
+		meanT = sum([t - t0 for t, _ in self.samples]) / n
+		meanU = sum([float(u) for _, u in self.samples]) / n
+		cov = sum([(t - t0 - meanT) * (u - meanU) for t, u in self.samples])
+		var = sum([(t - t0 - meanT) ** 2 for t, _ in self.samples])
+		return cov / var
+
+	def getTimeToLimit(self, limit):
+		"""
+		:param int limit:
+		:return: projected secs until the limit is hit. inf if not growing, None if not enough samples
+		:rtype: float|None
+		"""
+		slope = self.getSlope()
+		if slope is None:
+			return None
+		if slope <= 0:
+			return float("inf")
+		return max(limit - self.samples[-1][1], 0) / slope
+
+
+class Watcher:
+	"""
+	Escalation policy:
+	If the usage is above MemUsageFactorLimit of the limit,
+	or if it is above PredictMinUsageFactor and projected to hit the limit within the horizon,
+	we send NotifySignal to the heaviest process (see getSignalTarget).
+	If the memory still keeps rising after the grace period, we send EscalateSignal.
+	We only go back to normal (and would notify again) once the usage dropped
+	below (MemUsageFactorLimit - hysteresis) and is not projected to hit the limit anymore.
+	"""
+
+	EscalateSignal = signal.SIGTERM
+	WatchFactor = 0.5  # above this, sample frequently, to get a meaningful trend
+
+	def __init__(self, cgroup, horizon, grace, window, hysteresis, usePss=False, sendSignals=True, logPrefix="",
+				 metrics=None):
+		"""
+		:param MemoryCgroup cgroup:
+		:param float horizon: secs
+		:param float grace: secs
+		:param float window: secs
+		:param float hysteresis: fraction of the limit
+		:param bool usePss:
+		:param bool sendSignals: if False, only log which signals we would send
+		:param str logPrefix:
+		:param MetricsRegistry|None metrics:
+		"""
+		self.cgroup = cgroup
+		self.logPrefix = logPrefix
+		self.metrics = metrics
+		self.peakRss = 0
+		self.horizon = horizon
+		self.grace = grace
+		self.hysteresis = hysteresis
+		self.usePss = usePss
+		self.sendSignals = sendSignals
+		self.predictor = LimitPredictor(window)
+		self.state = "normal"  # or "notified" or "escalated"
+		self.notifyTime = None
+		self.proc = None
+
+	def check(self, limit):
+		"""
+		:param int limit:
+		:return: whether we want to check again soon, i.e. not just wait for the kernel notifications
+		:rtype: bool
+		"""
+		now = time.time()
+		used = self.cgroup.getRss()
+		self.predictor.add(now, used)
+		fact = float(used) / limit
+		timeToLimit = self.predictor.getTimeToLimit(limit)
+		predicted = fact >= PredictMinUsageFactor and timeToLimit is not None and timeToLimit < self.horizon
+		self.peakRss = max(self.peakRss, used)
+		if self.metrics:
+			self._updateMetrics(limit, used, timeToLimit)
+
+		if self.state == "normal":
+			if fact >= MemUsageFactorLimit or predicted:
+				self._report(limit, used, fact, timeToLimit)
+				self.proc = getSignalTarget(self.cgroup, usePss=self.usePss, log=self.log)
+				if self._kill(NotifySignal):
+					self.state = "notified"
+					self.notifyTime = now
+		elif fact < MemUsageFactorLimit - self.hysteresis and not predicted:
+			self.log("mem usage back to normal: %s, percentage: %s%%" % (byteNumRepr(used), round(100.0*fact)))
+			self.state = "normal"
+		elif self.state == "notified" and now - self.notifyTime >= self.grace:
+			slope = self.predictor.getSlope()
+			if slope is not None and slope > 0:
+				self._report(limit, used, fact, timeToLimit)
+				self.log("still rising %s/s after %.0f secs grace period" % (byteNumRepr(slope), self.grace))
+				if self._kill(self.EscalateSignal):
+					self.state = "escalated"
+		return self.state != "normal" or fact >= self.WatchFactor
+
+	def log(self, msg):
+		print(self.logPrefix + msg)
+
+	def _updateMetrics(self, limit, used, timeToLimit):
+		labels = {"cgroup": self.cgroup.dir}
+		self.metrics.setGauge("cgroup_memory_rss_bytes", used, labels, help="RSS of the cgroup")
+		self.metrics.setGauge("cgroup_memory_limit_bytes", limit, labels, help="memory limit of the cgroup")
+		self.metrics.setGauge(
+			"cgroup_memory_rss_peak_bytes", self.peakRss, labels, help="max RSS seen by the watcher")
+		self.metrics.setGauge(
+			"cgroup_memory_time_to_limit_seconds", timeToLimit, labels,
+			help="projected time until the limit is hit, from the recent growth rate")
+		for state in ("normal", "notified", "escalated"):
+			self.metrics.setGauge(
+				"cgroup_memory_watcher_state", int(self.state == state), dict(labels, state=state),
+				help="escalation state of the watcher")
+
+	def _report(self, limit, used, fact, timeToLimit):
+		self.log("mem limit: %s, current rss: %s, percentage: %s%%" % (byteNumRepr(limit), byteNumRepr(used), round(100.0*fact)))
+		if timeToLimit is not None and timeToLimit != float("inf"):
+			self.log("projected to hit the limit in %.1f secs" % timeToLimit)
+
+	def _kill(self, sig):
+		"""
+		:param signal.Signals sig:
+		:return: whether the signal was sent
+		:rtype: bool
+		"""
+		if self.proc is None:
+			return False
+		if not self.sendSignals:
+			self.log("would send signal %s to proc %i (log only)" % (sig.name, self.proc))
+			return True
+		self.log("sending signal %s to proc %i ..." % (sig.name, self.proc))
+		if self.metrics:
+			self.metrics.incCounter(
+				"cgroup_memory_watcher_signals", {"cgroup": self.cgroup.dir, "signal": sig.name},
+				help="signals sent by the watcher")
+		try:
+			os.kill(self.proc, sig)
+		except ProcessLookupError:
+			self.log("proc %i does not exist anymore" % self.proc)
+			self.proc = None
+			self.state = "normal"
+			return False
+		return True
+
+
+class WatchedCgroup:
+	"""
+	State of one cgroup in the NodeWatcher.
+	"""
+
+	def __init__(self, cgroup, events, watcher):
+		"""
+		:param MemoryCgroup cgroup:
+		:param MemoryEvents|None events:
+		:param Watcher watcher:
+		"""
+		self.cgroup = cgroup
+		self.events = events
+		self.watcher = watcher
+		self.limit = None
+		self.nextCheck = 0.
+
+	def close(self):
+		if self.events:
+			self.events.close()
+		self.cgroup.close()
+
+
+class NodeWatcher:
+	"""
+	Daemon mode: one process which watches all job cgroups on the node, from one poll loop.
+	A job cgroup is the topmost cgroup below the root with a memory limit.
+	The cgroups are rescanned regularly, to pick up new jobs and to drop finished ones.
+	"""
+
+	def __init__(self, root, watcherOpts, policies=(), pattern=None, useEvents=True,
+				 fallbackInterval=1., rescanInterval=5., exporter=None):
+		"""
+		:param str root: root of the memory cgroup hierarchy
+		:param dict[str] watcherOpts: kwargs for Watcher
+		:param list[(str,dict[str])] policies: (fnmatch pattern of the path relative to root, Watcher kwargs).
+			all matching policies are applied, in order
+		:param str|None pattern: only cgroups whose relative path matches
+		:param bool useEvents: use MemoryEvents
+		:param float fallbackInterval:
+		:param float rescanInterval:
+		:param MetricsExporter|None exporter:
+		"""
+		self.root = root
+		self.watcherOpts = watcherOpts
+		self.policies = policies
+		self.pattern = pattern
+		self.useEvents = useEvents
+		self.fallbackInterval = fallbackInterval
+		self.rescanInterval = rescanInterval
+		self.exporter = exporter
+		self.poll = select.poll()
+		self.cgroups = {}  # dir -> WatchedCgroup
+
+	def getWatcherOpts(self, cgroupDir):
+		"""
+		:param str cgroupDir:
+		:rtype: dict[str]
+		"""
+		relPath = os.path.relpath(cgroupDir, self.root)
+		opts = dict(self.watcherOpts)
+		for pattern, policyOpts in self.policies:
+			if fnmatch(relPath, pattern):
+				opts.update(policyOpts)
+		return opts
+
+	def rescan(self):
+		dirs = findLimitedCgroups(self.root, pattern=self.pattern)
+		for d in sorted(set(self.cgroups) - set(dirs)):
+			self.drop(d)
+		for d in dirs:
+			if d in self.cgroups:
+				continue
+			try:
+				cgroup = MemoryCgroup(d)
+			except (IOError, OSError):
+				continue  # gone in the meantime
+			opts = self.getWatcherOpts(d)
+			print("%s: watching, limit %s, %r" % (d, byteNumRepr(cgroup.getLimit() or 0), opts))
+			events = MemoryEvents(cgroup, poll=self.poll) if self.useEvents else None
+			watcher = Watcher(
+				cgroup, logPrefix="%s: " % d, metrics=self.exporter.registry if self.exporter else None, **opts)
+			self.cgroups[d] = WatchedCgroup(cgroup, events, watcher)
+
+	def drop(self, cgroupDir):
+		"""
+		:param str cgroupDir:
+		"""
+		print("%s: gone" % cgroupDir)
+		self.cgroups.pop(cgroupDir).close()
+		if self.exporter:
+			self.exporter.registry.remove({"cgroup": cgroupDir})
+
+	def check(self, w):
+		"""
+		:param WatchedCgroup w:
+		"""
+		try:
+			limit = w.cgroup.getLimit()
+			if limit != w.limit:
+				w.limit = limit
+				if w.events and limit is not None:
+					w.events.setThreshold(limit * MemUsageFactorLimit)
+			checkSoon = w.watcher.check(limit) if limit is not None else False
+		except (IOError, OSError):
+			# Most likely the job just finished, and the cgroup was removed.
+			self.drop(w.cgroup.dir)
+			return
+		if checkSoon or not (w.events and w.events.isActive()):
+			w.nextCheck = time.time() + 1.
+		else:
+			w.nextCheck = time.time() + self.fallbackInterval
+
+	def run(self):
+		nextRescan = 0.
+		while True:
+			if time.time() >= nextRescan:
+				self.rescan()
+				nextRescan = time.time() + self.rescanInterval
+			for w in list(self.cgroups.values()):
+				if w.nextCheck <= time.time():
+					self.check(w)
+			if self.exporter:
+				self.exporter.update()
+			timeout = min([w.nextCheck for w in self.cgroups.values()] + [nextRescan]) - time.time()
+			try:
+				events = self.poll.poll(max(timeout, 0.) * 1000)
+			except InterruptedError:
+				continue
+			for fd, _ in events:
+				for w in self.cgroups.values():
+					if w.events and fd in w.events.fds:
+						w.events.handleEvent(fd)
+						w.nextCheck = 0.
+						break
+
+
+def main():
+	parser = ArgumentParser(
+		description="Sends %s to the biggest process of the cgroup when it is close to its memory limit." % (
+			NotifySignal.name,))
+	parser.add_argument("--cgroup-dir", help="default: the memory cgroup of this process")
+	parser.add_argument(
+		"--daemon", action="store_true",
+		help="watch all cgroups with a memory limit below --cgroup-root, e.g. all jobs on the node")
+	parser.add_argument("--cgroup-root", help="with --daemon. default: %s" % getMemoryCgroupRoot())
+	parser.add_argument(
+		"--cgroup-pattern", help="with --daemon. only cgroups whose path relative to the root match, e.g. 'sge/*'")
+	parser.add_argument(
+		"--policies", metavar="JSON_FILE",
+		help="with --daemon. list of [pattern, {option: value}], to override"
+			 " horizon/grace/window/hysteresis/usePss/sendSignals per cgroup")
+	signalGroup = parser.add_mutually_exclusive_group()
+	signalGroup.add_argument(
+		"--signal", action="store_true",
+		help="send the signals. this is the default without --daemon."
+			 " with --daemon, either this or --dry-run must be given explicitly, as it acts on every job of the node")
+	signalGroup.add_argument(
+		"--dry-run", action="store_true", help="only log which signals would be sent to which process")
+	parser.add_argument(
+		"--rescan-interval", type=float, default=5., help="with --daemon, in secs. default: 5")
+	parser.add_argument(
+		"--metrics-socket", metavar="PATH", help="serve OpenMetrics via HTTP on this Unix socket")
+	parser.add_argument(
+		"--metrics-textfile", metavar="FILE", help="write OpenMetrics to this file (atomically rewritten)")
+	parser.add_argument(
+		"--no-events", action="store_true", help="do not use kernel notifications, only poll every second")
+	parser.add_argument(
+		"--fallback-interval", type=float, default=1.,
+		help="poll interval in secs when kernel notifications are available. default: 1")
+	parser.add_argument(
+		"--pss", action="store_true",
+		help="attribute memory via PSS (smaps_rollup), which does not count memory shared by forked workers twice")
+	parser.add_argument(
+		"--horizon", type=float, default=30.,
+		help="signal early if the limit is projected to be hit within this many secs. default: 30")
+	parser.add_argument(
+		"--grace", type=float, default=60.,
+		help="send %s if memory still rises this many secs after the first signal. default: 60" % (
+			Watcher.EscalateSignal.name,))
+	parser.add_argument(
+		"--window", type=float, default=10., help="secs of samples for the growth estimation. default: 10")
+	parser.add_argument(
+		"--hysteresis", type=float, default=0.05,
+		help="back to normal below (%s - this) of the limit. default: 0.05" % MemUsageFactorLimit)
+	args = parser.parse_args()
+	if args.daemon and not (args.signal or args.dry_run):
+		parser.error("--daemon needs either --signal or --dry-run")
+	watcherOpts = dict(
+		horizon=args.horizon, grace=args.grace, window=args.window, hysteresis=args.hysteresis, usePss=args.pss,
+		sendSignals=not args.dry_run)
+
+	# Force disable stdout buffering.
+	sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 1)
+
+	exporter = None
+	if args.metrics_socket or args.metrics_textfile:
+		exporter = MetricsExporter(MetricsRegistry(), socketPath=args.metrics_socket, textfile=args.metrics_textfile)
+
+	if args.daemon:
+		policies = json.load(open(args.policies)) if args.policies else []
+		NodeWatcher(
+			args.cgroup_root or getMemoryCgroupRoot(), watcherOpts=watcherOpts, policies=policies,
+			pattern=args.cgroup_pattern, useEvents=not args.no_events,
+			fallbackInterval=args.fallback_interval, rescanInterval=args.rescan_interval, exporter=exporter).run()
+		return
+
+	cgroup = MemoryCgroup(args.cgroup_dir)
+	events = None if args.no_events else MemoryEvents(cgroup)
+	watcher = Watcher(cgroup, metrics=exporter.registry if exporter else None, **watcherOpts)
+	limit = None
+	while True:
+		newLimit = cgroup.getLimit()
+		if newLimit != limit:
+			limit = newLimit
+			if events and limit is not None:
+				events.setThreshold(limit * MemUsageFactorLimit)
+
+		checkSoon = watcher.check(limit) if limit is not None else False
+		if exporter:
+			exporter.update()
+
+		if events and events.isActive() and not checkSoon:
+			events.wait(args.fallback_interval)
+		else:
+			time.sleep(1)
+		if os.getppid() <= 1:
+			# This means that our parent process has died. Stop now.
+			break
+	if events:
+		events.close()
+	cgroup.close()
+	if exporter:
+		exporter.close()
 
-def getProcRss(procId):
-	# http://man7.org/linux/man-pages/man5/proc.5.html
-	stats = open("/proc/%i/stat" % procId).read().split()
-	mstats = open("/proc/%i/statm" % procId).read().split()
-	rss1 = int(stats[23])
-	rss2 = int(mstats[1])
-	return rss2 * resource.getpagesize()
-	
-def getTotalRss():
-	stats = open("/sys/fs/cgroup/memory/memory.stat").read().splitlines()
-	stats = dict([(key,int(value)) for key,value in map(str.split, stats)])
-	return stats["rss"]
-
-
-# Force disable stdout buffering.
-sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 1)
-
-
-while True:
-	
-	limit = getRssLimit()
-	used = getTotalRss()
-	fact = float(used) / limit
-	
-	if fact >= MemUsageFactorLimit:
-		print("mem limit: %s, current rss: %s, percentage: %s%%" % (byteNumRepr(limit), byteNumRepr(used), round(100.0*fact)))
-		
-		print("top procs:")
-		procs = sorted([(getProcRss(p),p) for p in getProcs()], reverse=True)
-		for rss,p in procs[:3]:
-			print("%i: %s" % (p, byteNumRepr(rss)))
-			
-		p = procs[0][1]
-		print("sending signal to proc %i ..." % p)
-		os.kill(p, NotifySignal)
-	
-	time.sleep(1)
-	if os.getppid() <= 1:
-		# This means that our parent process has died. Stop now.
-		break
 
+if __name__ == "__main__":
+	main()
@@ -3,32 +3,54 @@
 """
 This script uses the informations from cgroup to log the rss memory usage of the given job.
 Originally written by Jan-Thorsten Peter, modified by Albert Zeyer.
+
+With --record, it instead records the whole RSS curve into a binary ring file,
+sampling faster while the memory is rising. Use --dump to print such a file.
 """
 
 import sys, os, time
+import struct
+from argparse import ArgumentParser
+from i6lib.str_ import byteNumRepr
+from i6lib.cgroup import MemoryCgroup
+from i6lib.metrics import MetricsRegistry, MetricsExporter
+
 
-def byteNumRepr(c):
-	if c < 1024: return "%i B" % c
-	S = "KMG"
-	i = 0
-	while i < len(S) - 1:
-		if c < 0.8 * 1024 ** (i + 2): break
-		i += 1
-	f = float(c) / (1024 ** (i + 1))
-	return "%.1f %sB" % (f, S[i])
+def update_metrics(metrics, cgroup, sample, max_rss):
+	"""
+	:param MetricsRegistry metrics:
+	:param MemoryCgroup cgroup:
+	:param i6lib.cgroup.MemorySample sample:
+	:param int max_rss:
+	"""
+	labels = {"cgroup": cgroup.dir}
+	metrics.setGauge("cgroup_memory_rss_bytes", sample.rss, labels, help="RSS of the cgroup")
+	metrics.setGauge("cgroup_memory_usage_bytes", sample.usage, labels, help="usage of the cgroup, including page cache")
+	metrics.setGauge("cgroup_memory_limit_bytes", sample.limit, labels, help="memory limit of the cgroup")
+	metrics.setGauge("cgroup_memory_rss_peak_bytes", max_rss, labels, help="max RSS seen by the logger")
+	metrics.setGauge(
+		"cgroup_memory_usage_peak_bytes", cgroup.getPeakUsage(), labels,
+		help="kernel watermark of the usage, including page cache")
 
 class RssChecker(object):
-	def __init__(self, stat_file):
-		self.stat_file = stat_file
+	def __init__(self, cgroup, exporter=None):
+		"""
+		:param MemoryCgroup cgroup:
+		:param MetricsExporter|None exporter:
+		"""
+		self.cgroup = cgroup
+		self.exporter = exporter
 		self.max_value = 0
 
 	def get_rss(self):
-		stats = open(self.stat_file).read().splitlines()
-		stats = dict([(key,int(value)) for key,value in map(str.split, stats)])
-		return stats["total_rss"]
+		return self.cgroup.sample().rss
 
 	def update(self):
-		value = self.get_rss()
+		sample = self.cgroup.sample()
+		if self.exporter:
+			update_metrics(self.exporter.registry, self.cgroup, sample, max(self.max_value, sample.rss))
+			self.exporter.update()
+		value = sample.rss
 		if byteNumRepr(value) == byteNumRepr(self.max_value):  # might be equal because of precision
 			return
 		if value > self.max_value:
@@ -36,18 +58,205 @@ class RssChecker(object):
 			print("New maximum RSS usage: %s" % byteNumRepr(value))
 			time.sleep(10) # sleep a bit longer
 
+
+class RssRingFile(object):
+	"""
+	Fixed-size binary file with the last `capacity` samples.
+	Header: magic, record size, capacity, number of records written so far.
+	Record: time (float64), rss (uint64), usage (uint64), little endian.
+	"""
+
+	Magic = b"RSSRING1"
+	HeaderFmt = struct.Struct("<8sIIQ")
+	RecordFmt = struct.Struct("<dQQ")
+
+	def __init__(self, filename, capacity=None):
+		"""
+		:param str filename:
+		:param int|None capacity: number of records. if None, opens an existing file for reading
+		"""
+		self.filename = filename
+		if capacity is None:
+			self.fd = os.open(filename, os.O_RDONLY)
+			magic, record_size, self.capacity, self.count = self.HeaderFmt.unpack(
+				os.pread(self.fd, self.HeaderFmt.size, 0))
+			assert magic == self.Magic, "%s: not a RSS ring file" % filename
+			assert record_size == self.RecordFmt.size, "%s: unexpected record size %i" % (filename, record_size)
+			assert self.capacity >= 1, "%s: invalid capacity %i" % (filename, self.capacity)
+		else:
+			assert capacity >= 1, "capacity must be at least 1"
+			self.fd = os.open(filename, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+			self.capacity = capacity
+			self.count = 0
+			os.ftruncate(self.fd, self.HeaderFmt.size + capacity * self.RecordFmt.size)
+			self._write_header()
+
+	def _write_header(self):
+		os.pwrite(self.fd, self.HeaderFmt.pack(self.Magic, self.RecordFmt.size, self.capacity, self.count), 0)
+
+	def append(self, t, rss, usage):
+		"""
+		:param float t:
+		:param int rss:
+		:param int usage:
+		"""
+		offset = self.HeaderFmt.size + (self.count % self.capacity) * self.RecordFmt.size
+		os.pwrite(self.fd, self.RecordFmt.pack(t, rss, usage), offset)
+		self.count += 1
+		self._write_header()
+
+	def read_all(self):
+		"""
+		:return: the records in the ring, oldest first
+		:rtype: list[(float,int,int)]
+		"""
+		n = min(self.count, self.capacity)
+		data = os.pread(self.fd, n * self.RecordFmt.size, self.HeaderFmt.size)
+		records = [rec for rec in self.RecordFmt.iter_unpack(data)]
+		first = self.count % self.capacity if self.count > self.capacity else 0
+		return records[first:] + records[:first]
+
+	def close(self):
+		os.close(self.fd)
+
+
+def time_weighted_percentiles(records, qs=(50, 95)):
+	"""
+	With adaptive sampling, we have more samples while the memory is rising,
+	so every sample is weighted by the time until the next sample.
+
+	:param list[(float,int,int)] records: (time, rss, usage)
+	:param tuple[int] qs:
+	:return: q -> rss
+	:rtype: dict[int,int]
+	"""
+	weighted = []
+	for i, (t, rss, _) in enumerate(records):
+		dt = records[i + 1][0] - t if i + 1 < len(records) else 0.
+		weighted.append((rss, dt))
+	weighted.sort()
+	total = sum([dt for _, dt in weighted])
+	res = {}
+	for q in qs:
+		acc = 0.
+		res[q] = weighted[-1][0] if weighted else 0
+		for rss, dt in weighted:
+			acc += dt
+			if total > 0 and acc >= total * q / 100.:
+				res[q] = rss
+				break
+	return res
+
+
+class RssRecorder(object):
+	"""
+	Samples with adaptive frequency: min_interval while the RSS is rising,
+	and then doubling the interval up to max_interval while it is not.
+	"""
+
+	def __init__(self, cgroup, ring, min_interval, max_interval, exporter=None):
+		"""
+		:param MemoryCgroup cgroup:
+		:param RssRingFile ring:
+		:param float min_interval:
+		:param float max_interval:
+		:param MetricsExporter|None exporter:
+		"""
+		self.cgroup = cgroup
+		self.exporter = exporter
+		self.ring = ring
+		self.min_interval = min_interval
+		self.max_interval = max_interval
+		self.interval = max_interval
+		self.last_rss = None
+		self.max_value = 0
+
+	def update(self):
+		"""
+		:return: secs to sleep until the next sample
+		:rtype: float
+		"""
+		sample = self.cgroup.sample()
+		self.ring.append(sample.time, sample.rss, sample.usage)
+		if self.last_rss is not None and sample.rss > self.last_rss:
+			self.interval = self.min_interval
+		else:
+			self.interval = min(self.interval * 2, self.max_interval)
+		self.last_rss = sample.rss
+		self.max_value = max(self.max_value, sample.rss)
+		if self.exporter:
+			update_metrics(self.exporter.registry, self.cgroup, sample, self.max_value)
+			self.exporter.update()
+		return self.interval
+
+	def print_summary(self):
+		records = self.ring.read_all()
+		ps = time_weighted_percentiles(records)
+		print("RSS over %i samples: p50 %s, p95 %s, max %s" % (
+			len(records), byteNumRepr(ps[50]), byteNumRepr(ps[95]), byteNumRepr(self.max_value)))
+
+
+def dump(filename):
+	"""
+	:param str filename: RssRingFile
+	"""
+	ring = RssRingFile(filename)
+	records = ring.read_all()
+	print("# %s: %i samples (%i recorded in total)" % (filename, len(records), ring.count))
+	print("# time rss usage")
+	for t, rss, usage in records:
+		print("%.3f %i %i" % (t, rss, usage))
+	ring.close()
+
+
 def main():
+	parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+	parser.add_argument("--cgroup-dir", help="default: the memory cgroup of this process")
+	parser.add_argument("--record", metavar="FILE", help="record all samples into this ring file")
+	parser.add_argument(
+		"--ring-size", type=int, default=100000, help="number of samples in the ring file. default: 100000")
+	parser.add_argument("--min-interval", type=float, default=0.05, help="with --record. default: 0.05 secs")
+	parser.add_argument("--max-interval", type=float, default=1., help="with --record. default: 1 sec")
+	parser.add_argument("--dump", metavar="FILE", help="print the samples of a ring file, and exit")
+	parser.add_argument(
+		"--metrics-socket", metavar="PATH", help="serve OpenMetrics via HTTP on this Unix socket")
+	parser.add_argument(
+		"--metrics-textfile", metavar="FILE", help="write OpenMetrics to this file (atomically rewritten)")
+	args = parser.parse_args()
+	if args.ring_size < 1:
+		parser.error("--ring-size must be at least 1")
+
+	if args.dump:
+		dump(args.dump)
+		return
+
 	# Force disable stdout buffering.
 	sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 1)
 
-	# cgroups path to memory statistic file
-	stat_file = '/sys/fs/cgroup/memory/memory.stat'
+	cgroup = MemoryCgroup(args.cgroup_dir)
+	exporter = None
+	if args.metrics_socket or args.metrics_textfile:
+		exporter = MetricsExporter(MetricsRegistry(), socketPath=args.metrics_socket, textfile=args.metrics_textfile)
+	if args.record:
+		ring = RssRingFile(args.record, capacity=args.ring_size)
+		recorder = RssRecorder(
+			cgroup, ring, min_interval=args.min_interval, max_interval=args.max_interval, exporter=exporter)
+		while os.getppid() > 1: # run while parent process exists
+			time.sleep(recorder.update())
+		recorder.update()
+		recorder.print_summary()
+		ring.close()
+	else:
+		checker = RssChecker(cgroup, exporter=exporter)
+		while os.getppid() > 1: # run while parent process exists
+			checker.update()
+			time.sleep(1)
+	print("Final usage: %s" % byteNumRepr(cgroup.sample().rss))
+	peak = cgroup.getPeakUsage()
+	if peak is not None:
+		print("Peak usage (kernel watermark, including page cache): %s" % byteNumRepr(peak))
+	if exporter:
+		exporter.close()
 
-	checker = RssChecker(stat_file)
-	while os.getppid() > 1: # run while parent process exists
-		checker.update()
-		time.sleep(1)
-	print("Final usage: %s" % byteNumRepr(checker.get_rss()))
-	
 if __name__ == '__main__':
 	main()
@@ -0,0 +1,440 @@
+"""
+Local stand-in for a Grid Engine cluster, to test and benchmark i6lib.sge without a cluster.
+The executables qstat, qhost and ssh in this directory generate realistic output
+for a configurable number of jobs and hosts. Put this directory first into PATH to use them.
+
+Everything is deterministic, i.e. qstat -xml and qstat -j agree on the jobs,
+and qhost agrees with the hosts the jobs run on.
+
+Configuration via env:
+
+	FAKE_SGE_JOBS: number of jobs of every user. default: 10
+	FAKE_SGE_USERS: comma-separated. default: the current user
+	FAKE_SGE_HOSTS: number of execution hosts. default: 100
+	FAKE_SGE_QSTAT_LATENCY: secs per qstat/qhost call. default: 0
+	FAKE_SGE_QSTAT_JOB_LATENCY: additional secs per job in the qstat output. default: 0
+	FAKE_SGE_MISSING_EVERY: every n-th job is missing in the qstat -j output,
+		as if it quit after the qstat -xml listing. default: 0 (none)
+	FAKE_SGE_SSH_LATENCY: secs for the ssh connection setup without a master connection. default: 0
+	FAKE_SGE_SSH_MUX_LATENCY: secs for the ssh session setup over a master connection. default: 0
+	FAKE_SGE_HANG_HOSTS: comma-separated hostname patterns (fnmatch), where `cat /proc/modules` hangs
+	FAKE_SGE_DEAD_HOSTS: comma-separated hostname patterns (fnmatch), where ssh cannot connect
+	FAKE_SGE_LOG: if set, every call is appended to this file, one line per call
+"""
+
+import os
+import sys
+import time
+import getpass
+from fnmatch import fnmatch
+
+MyDir = os.path.dirname(os.path.abspath(__file__))
+FirstJobId = 4200000
+SubmitTime = 1790000000  # fixed, to make the output deterministic
+ArrayTasks = 10  # every third job is an array job with this many tasks
+ArrayRunningTasks = 2  # of a running array job. the other tasks are pending
+
+
+def getEnvList(name, default=()):
+	"""
+	:param str name:
+	:param list[str]|tuple[str] default:
+	:rtype: list[str]
+	"""
+	value = os.environ.get(name)
+	if not value:
+		return list(default)
+	return [s.strip() for s in value.split(",") if s.strip()]
+
+
+def getEnvNum(name, default, type_=float):
+	"""
+	:param str name:
+	:param int|float default:
+	:param type type_:
+	:rtype: int|float
+	"""
+	value = os.environ.get(name)
+	if not value:
+		return default
+	return type_(value)
+
+
+def getUsers():
+	return getEnvList("FAKE_SGE_USERS", [getpass.getuser()])
+
+
+def getNumJobs():
+	return getEnvNum("FAKE_SGE_JOBS", 10, int)
+
+
+def getNumHosts():
+	return getEnvNum("FAKE_SGE_HOSTS", 100, int)
+
+
+def hostName(i):
+	"""
+	:param int i: 0 <= i < getNumHosts()
+	:rtype: str
+	"""
+	return "cluster-cn-%i" % (201 + i)
+
+
+def hostMatches(hostname, envName):
+	"""
+	:param str hostname:
+	:param str envName: e.g. "FAKE_SGE_HANG_HOSTS"
+	:rtype: bool
+	"""
+	return any([fnmatch(hostname, pattern) for pattern in getEnvList(envName)])
+
+
+def log(cmd):
+	"""
+	:param list[str] cmd:
+	"""
+	filename = os.environ.get("FAKE_SGE_LOG")
+	if not filename:
+		return
+	with open(filename, "a") as f:
+		f.write(" ".join([os.path.basename(cmd[0])] + [repr(arg) if " " in arg else arg for arg in cmd[1:]]) + "\n")
+
+
+def sleepQstatLatency(numJobs):
+	"""
+	:param int numJobs: in the output
+	"""
+	secs = getEnvNum("FAKE_SGE_QSTAT_LATENCY", 0.) + numJobs * getEnvNum("FAKE_SGE_QSTAT_JOB_LATENCY", 0.)
+	if secs > 0:
+		time.sleep(secs)
+
+
+class Job:
+	"""
+	Job number `index` of user `users[userIndex]`. All properties are derived from that.
+	"""
+
+	def __init__(self, jobId):
+		"""
+		:param int jobId:
+		"""
+		users = getUsers()
+		self.id = jobId
+		self.index, userIndex = divmod(jobId - FirstJobId, len(users))
+		self.user = users[userIndex]
+		self.name = "%s-train-%i" % (self.user, self.index)
+		if self.index % 2 == 0:
+			self.state = "r"
+		elif self.index % 6 == 3:
+			self.state = "hqw"
+		else:
+			self.state = "qw"
+		self.host = hostName(self.index % getNumHosts())
+		self.queue = "4-GPU-1080@%s" % self.host
+		self.tasks = "1-%i:1" % ArrayTasks if self.index % 3 == 0 else None
+		self.submissionTime = SubmitTime + self.index * 7
+		self.startTime = self.submissionTime + 60
+		self.workdir = "/u/%s/setups/exp-%i" % (self.user, self.index // 10)
+
+	@classmethod
+	def exists(cls, jobId):
+		"""
+		:param int jobId:
+		:rtype: bool
+		"""
+		return FirstJobId <= jobId < FirstJobId + getNumJobs() * len(getUsers())
+
+	@classmethod
+	def iterJobs(cls, user="*"):
+		"""
+		:param str user: or "*"
+		:rtype: typing.Iterator[Job]
+		"""
+		users = getUsers()
+		for index in range(getNumJobs()):
+			for userIndex, user_ in enumerate(users):
+				if user in ("*", user_):
+					yield cls(FirstJobId + index * len(users) + userIndex)
+
+	def iterQstatRows(self):
+		"""
+		Like qstat -xml: of a running array job, every running task is a separate job_list,
+		and the pending tasks are one more job_list with the remaining task range, all with the same job number.
+
+		:return: (state, queue or "", tasks or None) per job_list
+		:rtype: typing.Iterator[(str,str,str|None)]
+		"""
+		if self.state != "r":
+			yield self.state, "", self.tasks
+		elif not self.tasks:
+			yield self.state, self.queue, None
+		else:
+			for task in range(1, ArrayRunningTasks + 1):
+				host = hostName((self.index + task - 1) % getNumHosts())
+				yield self.state, "4-GPU-1080@%s" % host, str(task)
+			yield "qw", "", "%i-%i:1" % (ArrayRunningTasks + 1, ArrayTasks)
+
+	def isMissing(self):
+		"""
+		:return: whether qstat -j does not know this job
+		:rtype: bool
+		"""
+		every = getEnvNum("FAKE_SGE_MISSING_EVERY", 0, int)
+		return every > 0 and self.index % every == every - 1
+
+
+def xmlTime(t):
+	return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(t))
+
+
+def qstatXml(user, out):
+	"""
+	Like `qstat -u user -xml`. Running jobs are in queue_info, pending jobs in job_info.
+
+	:param str user: or "*"
+	:param typing.TextIO out:
+	"""
+	jobs = list(Job.iterJobs(user))
+	sleepQstatLatency(len(jobs))
+	out.write(
+		"<?xml version='1.0'?>\n"
+		"<job_info  xmlns:xsd=\"http://arc.liv.ac.uk/repos/darcs/sge/source/dist/util/resources/schemas/qstat/qstat.xsd\">\n")
+	for section, running in [("queue_info", True), ("job_info", False)]:
+		out.write("  <%s>\n" % section)
+		for job in jobs:
+			for state, queue, tasks in job.iterQstatRows():
+				if (state == "r") != running:
+					continue
+				timeTag = "JAT_start_time" if running else "JB_submission_time"
+				out.write(
+					"    <job_list state=\"%s\">\n"
+					"      <JB_job_number>%i</JB_job_number>\n"
+					"      <JAT_prio>0.50500</JAT_prio>\n"
+					"      <JB_name>%s</JB_name>\n"
+					"      <JB_owner>%s</JB_owner>\n"
+					"      <state>%s</state>\n"
+					"      <%s>%s</%s>\n"
+					"      <queue_name>%s</queue_name>\n"
+					"      <slots>1</slots>\n" % (
+						"running" if running else "pending", job.id, job.name, job.user, state,
+						timeTag, xmlTime(job.startTime if running else job.submissionTime), timeTag, queue))
+				if tasks:
+					out.write("      <tasks>%s</tasks>\n" % tasks)
+				out.write("    </job_list>\n")
+		out.write("  </%s>\n" % section)
+	out.write("</job_info>\n")
+
+
+def qstatJobInfo(job):
+	"""
+	Like one job in the output of `qstat -j`.
+
+	:param Job job:
+	:rtype: str
+	"""
+	fields = [
+		("job_number", str(job.id)),
+		("exec_file", "job_scripts/%i" % job.id),
+		("submission_time", time.strftime("%a %b %d %H:%M:%S %Y", time.gmtime(job.submissionTime))),
+		("owner", job.user),
+		("uid", str(1000 + job.index % 100)),
+		("group", "users"),
+		("gid", "100"),
+		("sge_o_home", "/u/%s" % job.user),
+		("sge_o_log_name", job.user),
+		("sge_o_path", "/usr/local/cuda/bin:/usr/local/bin:/usr/bin:/bin"),
+		("sge_o_shell", "/bin/bash"),
+		("sge_o_workdir", job.workdir),
+		("sge_o_host", "cluster-cn-01"),
+		("account", "sge"),
+		("cwd", job.workdir),
+		("merge", "y"),
+		("hard resource_list", "h_vmem=15G,h_rt=36000,gpu=1"),
+		("mail_list", "%s@cluster-cn-01" % job.user),
+		("notify", "FALSE"),
+		("job_name", job.name),
+		("stdout_path_list", "NONE:NONE:%s/log/%s.o$JOB_ID" % (job.workdir, job.name)),
+		("jobshare", "0"),
+		("hard_queue_list", "*-GPU-*"),
+		("env_list", ""),
+		("script_file", "%s/run.sh" % job.workdir)]
+	if job.tasks:
+		fields.append(("job-array tasks", job.tasks))
+	if job.state == "r":
+		fields.append((
+			"usage    1", "cpu=01:02:03, mem=1234.56789 GBs, io=1.23456, vmem=4.321G, maxvmem=5.432G"))
+		fields.append(("scheduling info", "(Collecting of scheduler job information is turned off)"))
+	else:
+		fields.append(("scheduling info", "\n".join([
+			"queue instance \"4-GPU-1080@%s\" dropped because it is full" % hostName(i)
+			for i in range(min(3, getNumHosts()))])))
+	lines = ["=" * 62]
+	for key, value in fields:
+		valueLines = value.split("\n")
+		lines.append("%-28s%s" % (key + ":", valueLines[0]))
+		lines.extend(["%-28s%s" % ("", line) for line in valueLines[1:]])
+	return "\n".join(lines) + "\n"
+
+
+def qstatJobInfos(jobIds, out, err):
+	"""
+	Like `qstat -j id1,id2,...`.
+
+	:param list[int] jobIds:
+	:param typing.TextIO out:
+	:param typing.TextIO err:
+	:return: exit code
+	:rtype: int
+	"""
+	sleepQstatLatency(len(jobIds))
+	missing = []
+	for jobId in jobIds:
+		job = Job(jobId) if Job.exists(jobId) else None
+		if job is None or job.isMissing():
+			missing.append(jobId)
+			continue
+		out.write(qstatJobInfo(job))
+	if missing:
+		err.write("Following jobs do not exist or permissions are not sufficient: \n")
+		err.write("%s\n" % ", ".join(map(str, missing)))
+		return 1
+	return 0
+
+
+def qhost(out):
+	"""
+	Like `qhost`.
+
+	:param typing.TextIO out:
+	"""
+	sleepQstatLatency(0)
+	out.write(
+		"HOSTNAME                ARCH         NCPU NSOC NCOR NTHR  LOAD  MEMTOT  MEMUSE  SWAPTO  SWAPUS\n")
+	out.write("-" * 94 + "\n")
+	out.write(
+		"global                  -               -    -    -    -     -       -       -       -       -\n")
+	for i in range(getNumHosts()):
+		out.write("%-23s lx-amd64       12    2   12   12  %4.2f   62.8G   %4.1fG    2.0G     0.0\n" % (
+			hostName(i), (i * 37 % 1200) / 100., (i * 13 % 600) / 10.))
+
+
+def qstatMain(argv):
+	"""
+	:param list[str] argv: without the program name
+	:return: exit code
+	:rtype: int
+	"""
+	user = getpass.getuser()
+	xml = False
+	jobIds = None
+	args = list(argv)
+	while args:
+		arg = args.pop(0)
+		if arg == "-u":
+			user = args.pop(0)
+		elif arg == "-xml":
+			xml = True
+		elif arg == "-j":
+			jobIds = [int(jobId) for jobId in args.pop(0).split(",") if jobId]
+		else:
+			sys.stderr.write("fake qstat: unsupported option %r\n" % arg)
+			return 2
+	if jobIds is not None:
+		return qstatJobInfos(jobIds, sys.stdout, sys.stderr)
+	if not xml:
+		sys.stderr.write("fake qstat: only -xml or -j are supported\n")
+		return 2
+	qstatXml(user, sys.stdout)
+	return 0
+
+
+def sshMain(argv):
+	"""
+	Like ssh, where the remote host is this host.
+	ControlMaster is emulated with a plain file at ControlPath.
+	A file with the content "stale" emulates the socket of a killed master:
+	`-O check` fails, and sessions connect directly, with the error message of ssh.
+	/proc/modules of the remote host is served from a file in this directory.
+	Does not return when the remote command runs (exec).
+
+	:param list[str] argv: without the program name
+	:return: exit code
+	:rtype: int
+	"""
+	opts = {}
+	ctlCmd = None
+	args = list(argv)
+	while args and args[0].startswith("-"):
+		arg = args.pop(0)
+		if arg == "-o":
+			key, value = args.pop(0).split("=", 1)
+			opts[key] = value
+		elif arg == "-O":
+			ctlCmd = args.pop(0)
+		elif arg in ("-N", "-f", "-T", "-q"):
+			opts[arg] = True
+		else:
+			sys.stderr.write("fake ssh: unsupported option %r\n" % arg)
+			return 255
+	hostname = args.pop(0)
+	remoteCmd = " ".join(args)
+	controlPath = opts.get("ControlPath")
+
+	stale = bool(controlPath) and os.path.exists(controlPath) and open(controlPath).read() == "stale"
+	if ctlCmd == "check":
+		return 0 if controlPath and os.path.exists(controlPath) and not stale else 255
+	if ctlCmd == "exit":
+		if controlPath and os.path.exists(controlPath):
+			os.unlink(controlPath)
+		return 0
+	if ctlCmd:
+		sys.stderr.write("fake ssh: unsupported control command %r\n" % ctlCmd)
+		return 255
+
+	mux = bool(controlPath) and opts.get("ControlMaster") != "yes" and os.path.exists(controlPath) and not stale
+	if stale and opts.get("ControlMaster") == "no":
+		sys.stderr.write("Control socket connect(%s): Connection refused\r\n" % controlPath)
+	if hostMatches(hostname, "FAKE_SGE_DEAD_HOSTS") and not mux:
+		time.sleep(float(opts.get("ConnectTimeout", 10)))
+		sys.stderr.write("ssh: connect to host %s port 22: Connection timed out\r\n" % hostname)
+		return 255
+	if mux:
+		latency = getEnvNum("FAKE_SGE_SSH_MUX_LATENCY", 0.)
+	else:
+		latency = getEnvNum("FAKE_SGE_SSH_LATENCY", 0.)
+	if latency > 0:
+		time.sleep(latency)
+
+	if opts.get("ControlMaster") == "yes":
+		if controlPath:
+			open(controlPath, "w").close()
+		return 0
+	if opts.get("-N"):
+		return 0
+
+	# The remote command is a shell command line, as with the real ssh.
+	# If it is again an ssh (e.g. via the cluster gateway), the next hop handles /proc/modules.
+	if not remoteCmd.lstrip().startswith("ssh "):
+		if hostMatches(hostname, "FAKE_SGE_HANG_HOSTS"):
+			# exec, so that killing this ssh process also stops the hanging command.
+			remoteCmd = remoteCmd.replace("cat /proc/modules", "exec sleep 1000000")
+		else:
+			remoteCmd = remoteCmd.replace("/proc/modules", "%s/proc-modules" % MyDir)
+	os.environ["PATH"] = "%s:%s" % (MyDir, os.environ.get("PATH", ""))
+	sys.stdout.flush()
+	os.execvp("bash", ["bash", "-c", remoteCmd])
+
+
+def main(prog):
+	"""
+	:param str prog: "qstat", "qhost" or "ssh"
+	"""
+	log([prog] + sys.argv[1:])
+	if prog == "qstat":
+		sys.exit(qstatMain(sys.argv[1:]))
+	if prog == "qhost":
+		qhost(sys.stdout)
+		sys.exit(0)
+	if prog == "ssh":
+		sys.exit(sshMain(sys.argv[1:]))
+	raise Exception("unknown fake program %r" % prog)
@@ -0,0 +1,139 @@
+"""
+Bounded LRU cache with a TTL per entry, and an optional persistent sqlite store,
+which can be shared between processes.
+"""
+
+import time
+import json
+import threading
+from collections import OrderedDict
+
+
+class TtlLruCache:
+	"""
+	Keys are converted with str() for the persistent store, values must be JSON-serializable.
+	"""
+
+	def __init__(self, maxSize=10000, defaultTtl=300., dbFilename=None):
+		"""
+		:param int maxSize: max number of entries in memory
+		:param float defaultTtl: in secs
+		:param str|None dbFilename: sqlite file for the persistent store
+		"""
+		self.maxSize = maxSize
+		self.defaultTtl = defaultTtl
+		self.lock = threading.Lock()
+		self.entries = OrderedDict()  # key -> (value, expire time). most recently used last
+		self.hits = 0
+		self.diskHits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.db = None
+		if dbFilename:
+			self.openDb(dbFilename)
+
+	def openDb(self, dbFilename):
+		"""
+		:param str dbFilename:
+		"""
+		import sqlite3  # only here, to keep the import of this module cheap
+		self.db = sqlite3.connect(dbFilename, timeout=10., check_same_thread=False)
+		with self.db:
+			self.db.execute("PRAGMA journal_mode=WAL")
+			self.db.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, expires REAL)")
+			self.db.execute("DELETE FROM cache WHERE expires < ?", (time.time(),))
+
+	def __repr__(self):
+		return "<TtlLruCache %i entries, %s>" % (
+			len(self.entries), ", ".join(["%s %s" % item for item in sorted(self.stats().items())]))
+
+	def stats(self):
+		"""
+		:rtype: dict[str,int]
+		"""
+		return {"hits": self.hits, "diskHits": self.diskHits, "misses": self.misses, "evictions": self.evictions}
+
+	def _getFromDb(self, key, now):
+		row = self.db.execute(
+			"SELECT value, expires FROM cache WHERE key = ? AND expires >= ?", (str(key), now)).fetchone()
+		if row is None:
+			return None
+		return json.loads(row[0]), row[1]
+
+	def get(self, key, default=None):
+		"""
+		:param key:
+		:param default: returned if not in the cache or expired
+		"""
+		now = time.time()
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry is not None and entry[1] < now:
+				del self.entries[key]
+				entry = None
+			if entry is not None:
+				self.entries.move_to_end(key)
+				self.hits += 1
+				return entry[0]
+			if self.db:
+				entry = self._getFromDb(key, now)
+				if entry is not None:
+					self._set(key, entry)
+					self.diskHits += 1
+					return entry[0]
+			self.misses += 1
+			return default
+
+	def __contains__(self, key):
+		return self.get(key, default=self) is not self
+
+	def __getitem__(self, key):
+		value = self.get(key, default=self)
+		if value is self:
+			raise KeyError(key)
+		return value
+
+	def __setitem__(self, key, value):
+		self.set(key, value)
+
+	def __len__(self):
+		return len(self.entries)
+
+	def set(self, key, value, ttl=None):
+		"""
+		:param key:
+		:param value:
+		:param float|None ttl: in secs. by default self.defaultTtl
+		"""
+		if ttl is None:
+			ttl = self.defaultTtl
+		entry = (value, time.time() + ttl)
+		with self.lock:
+			self._set(key, entry)
+			if self.db:
+				with self.db:
+					self.db.execute(
+						"INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)",
+						(str(key), json.dumps(value), entry[1]))
+
+	def _set(self, key, entry):
+		self.entries[key] = entry
+		self.entries.move_to_end(key)
+		while len(self.entries) > self.maxSize:
+			self.entries.popitem(last=False)
+			self.evictions += 1
+
+	def pop(self, key, default=None):
+		with self.lock:
+			entry = self.entries.pop(key, None)
+			if self.db:
+				with self.db:
+					self.db.execute("DELETE FROM cache WHERE key = ?", (str(key),))
+		return entry[0] if entry is not None else default
+
+	def clear(self):
+		with self.lock:
+			self.entries.clear()
+			if self.db:
+				with self.db:
+					self.db.execute("DELETE FROM cache")
@@ -0,0 +1,254 @@
+"""
+Memory statistics of a cgroup, for cgroup v1 and v2.
+
+The files are kept open and are re-read via os.pread,
+so that a sample only costs a few syscalls, and we only parse the keys we need.
+"""
+
+import os
+import time
+from fnmatch import fnmatch
+from collections import namedtuple
+
+
+CgroupMount = "/sys/fs/cgroup"
+
+# key in memory.stat -> our name
+StatKeys = {
+	1: {"total_rss": "rss", "total_cache": "cache", "total_swap": "swap"},
+	2: {"anon": "rss", "file": "cache"},
+}
+
+MemorySample = namedtuple("MemorySample", ["time", "usage", "rss", "cache", "limit"])
+
+
+def getCgroupVersion(cgroupDir):
+	"""
+	:param str cgroupDir:
+	:rtype: int
+	"""
+	if os.path.exists("%s/memory.current" % cgroupDir):
+		return 2
+	return 1
+
+
+def findMemoryCgroupDir(pid="self"):
+	"""
+	:param int|str pid:
+	:return: directory of the memory cgroup of the process
+	:rtype: str
+	"""
+	v1Path = v2Path = None
+	for line in open("/proc/%s/cgroup" % pid).read().splitlines():
+		hierarchy, controllers, path = line.split(":", 2)
+		if hierarchy == "0" and not controllers:
+			v2Path = path
+		elif "memory" in controllers.split(","):
+			v1Path = path
+	if v1Path is not None and os.path.isdir("%s/memory" % CgroupMount):
+		candidates = ["%s/memory%s" % (CgroupMount, v1Path), "%s/memory" % CgroupMount]
+	elif v2Path is not None:
+		candidates = ["%s%s" % (CgroupMount, v2Path), CgroupMount]
+	else:
+		raise Exception("no memory cgroup found for pid %s" % pid)
+	for d in candidates:
+		# Within a cgroup namespace, the path is relative to the namespace root, which is the mount.
+		if os.path.exists("%s/memory.stat" % d):
+			return d.rstrip("/")
+	raise Exception("memory cgroup not found, tried: %s" % ", ".join(candidates))
+
+
+def getMemoryCgroupRoot():
+	"""
+	:return: root of the memory hierarchy
+	:rtype: str
+	"""
+	if os.path.isdir("%s/memory" % CgroupMount):
+		return "%s/memory" % CgroupMount
+	return CgroupMount
+
+
+def parseLimit(data):
+	"""
+	:param bytes data: content of memory.limit_in_bytes or memory.max
+	:return: limit in bytes, or None if there is no limit
+	:rtype: int|None
+	"""
+	data = data.strip()
+	if data == b"max":
+		return None
+	limit = int(data)
+	if limit >= 2 ** 62:  # v1 reports "no limit" as a huge number
+		return None
+	return limit
+
+
+def findLimitedCgroups(root, pattern=None):
+	"""
+	Finds e.g. the cgroups of the jobs on a node.
+
+	:param str root: e.g. getMemoryCgroupRoot()
+	:param str|None pattern: fnmatch pattern for the path relative to root, e.g. "sge/*"
+	:return: the topmost cgroups below root with a memory limit
+	:rtype: list[str]
+	"""
+	res = []
+	for dirpath, dirnames, _ in os.walk(root):
+		dirnames.sort()
+		if dirpath == root:
+			continue
+		if pattern and not fnmatch(os.path.relpath(dirpath, root), pattern):
+			continue
+		limitFilename = "%s/%s" % (dirpath, "memory.max" if getCgroupVersion(dirpath) == 2 else "memory.limit_in_bytes")
+		try:
+			limit = parseLimit(open(limitFilename, "rb").read())
+		except (IOError, OSError, ValueError):
+			continue  # gone in the meantime, or no memory controller
+		if limit is not None:
+			res.append(dirpath)
+			dirnames[:] = []  # sub cgroups are part of this job
+	return res
+
+
+class CgroupFile:
+	"""
+	A cgroup file which is kept open and re-read via pread.
+	"""
+
+	BufSize = 1024 * 16
+
+	def __init__(self, filename):
+		self.filename = filename
+		self.fd = os.open(filename, os.O_RDONLY | os.O_CLOEXEC)
+
+	def read(self):
+		"""
+		:rtype: bytes
+		"""
+		data = os.pread(self.fd, self.BufSize, 0)
+		while len(data) % self.BufSize == 0 and data:
+			more = os.pread(self.fd, self.BufSize, len(data))
+			if not more:
+				break
+			data += more
+		return data
+
+	def readInt(self):
+		"""
+		:return: the number, or None for "max"
+		:rtype: int|None
+		"""
+		data = self.read().strip()
+		if data == b"max":
+			return None
+		return int(data)
+
+	def readKeys(self, keys):
+		"""
+		:param list[bytes]|tuple[bytes] keys:
+		:return: key -> value, for the "key value" lines of the file. missing keys are left out
+		:rtype: dict[bytes,int]
+		"""
+		data = b"\n" + self.read()
+		res = {}
+		for key in keys:
+			p = data.find(b"\n" + key + b" ")
+			if p < 0:
+				continue
+			p += len(key) + 2
+			end = data.find(b"\n", p)
+			res[key] = int(data[p:] if end < 0 else data[p:end])
+		return res
+
+	def close(self):
+		if self.fd is not None:
+			os.close(self.fd)
+			self.fd = None
+
+
+class MemoryCgroup:
+	"""
+	The memory controller of a cgroup.
+	"""
+
+	def __init__(self, cgroupDir=None, version=None):
+		"""
+		:param str|None cgroupDir: by default the memory cgroup of this process
+		:param int|None version: 1 or 2. by default detected
+		"""
+		if not cgroupDir:
+			cgroupDir = findMemoryCgroupDir()
+		self.dir = cgroupDir
+		self.version = version or getCgroupVersion(cgroupDir)
+		self.statKeys = {key.encode("ascii"): name for key, name in StatKeys[self.version].items()}
+		if self.version == 2:
+			self.usageFile = CgroupFile("%s/memory.current" % cgroupDir)
+			self.limitFile = CgroupFile("%s/memory.max" % cgroupDir)
+		else:
+			self.usageFile = CgroupFile("%s/memory.usage_in_bytes" % cgroupDir)
+			self.limitFile = CgroupFile("%s/memory.limit_in_bytes" % cgroupDir)
+		self.statFile = CgroupFile("%s/memory.stat" % cgroupDir)
+		peakFilename = "%s/%s" % (cgroupDir, "memory.peak" if self.version == 2 else "memory.max_usage_in_bytes")
+		self.peakFile = CgroupFile(peakFilename) if os.path.exists(peakFilename) else None  # memory.peak: Linux >= 5.19
+
+	def __repr__(self):
+		return "<MemoryCgroup v%i %s>" % (self.version, self.dir)
+
+	def getLimit(self):
+		"""
+		:return: limit in bytes, or None if there is no limit
+		:rtype: int|None
+		"""
+		return parseLimit(self.limitFile.read())
+
+	def getUsage(self):
+		"""
+		:return: usage in bytes, including the page cache
+		:rtype: int
+		"""
+		return self.usageFile.readInt()
+
+	def getPeakUsage(self):
+		"""
+		:return: the kernel watermark of the usage (including the page cache) in bytes, or None if not available
+		:rtype: int|None
+		"""
+		if not self.peakFile:
+			return None
+		return self.peakFile.readInt()
+
+	def getStats(self):
+		"""
+		:return: name -> value, see StatKeys
+		:rtype: dict[str,int]
+		"""
+		values = self.statFile.readKeys(list(self.statKeys))
+		return {self.statKeys[key]: value for key, value in values.items()}
+
+	def getRss(self):
+		"""
+		:return: anonymous memory of all processes in the cgroup (including sub cgroups), in bytes
+		:rtype: int
+		"""
+		return self.getStats()["rss"]
+
+	def getProcs(self):
+		"""
+		:return: pids of the processes of the cgroup
+		:rtype: list[int]
+		"""
+		return list(map(int, open("%s/cgroup.procs" % self.dir).read().split()))
+
+	def sample(self):
+		"""
+		:rtype: MemorySample
+		"""
+		stats = self.getStats()
+		return MemorySample(
+			time=time.time(), usage=self.getUsage(), rss=stats["rss"], cache=stats.get("cache", 0),
+			limit=self.getLimit())
+
+	def close(self):
+		for f in (self.usageFile, self.limitFile, self.statFile, self.peakFile):
+			if f:
+				f.close()
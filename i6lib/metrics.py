@@ -0,0 +1,210 @@
+"""
+Simple OpenMetrics (Prometheus) exposition, without external dependencies.
+
+The metrics can be served via HTTP over a Unix socket (e.g. for curl --unix-socket),
+and/or written to a textfile (e.g. for the node exporter textfile collector),
+which is rewritten atomically.
+
+https://github.com/OpenObservability/OpenMetrics/blob/main/specification/OpenMetrics.md
+"""
+
+import os
+import time
+import threading
+import socketserver
+from http.server import BaseHTTPRequestHandler
+
+
+ContentType = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+
+def _escapeLabelValue(value):
+	"""
+	:param str value:
+	:rtype: str
+	"""
+	return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _formatValue(value):
+	"""
+	:param int|float value:
+	:rtype: str
+	"""
+	if isinstance(value, float):
+		if value == float("inf"):
+			return "+Inf"
+		if value == float("-inf"):
+			return "-Inf"
+		return repr(value)
+	return "%i" % value
+
+
+class MetricsRegistry:
+	"""
+	Holds the current values. Thread-safe.
+	"""
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.metrics = {}  # name -> (type, help, {labels tuple: value})
+
+	def _get(self, name, type_, help_):
+		if name not in self.metrics:
+			self.metrics[name] = (type_, help_, {})
+		assert self.metrics[name][0] == type_, "%s: type %s, not %s" % (name, self.metrics[name][0], type_)
+		return self.metrics[name][2]
+
+	def setGauge(self, name, value, labels=None, help=""):
+		"""
+		:param str name:
+		:param int|float|None value: None removes the sample
+		:param dict[str,str]|None labels:
+		:param str help:
+		"""
+		key = tuple(sorted((labels or {}).items()))
+		with self.lock:
+			samples = self._get(name, "gauge", help)
+			if value is None:
+				samples.pop(key, None)
+			else:
+				samples[key] = value
+
+	def incCounter(self, name, labels=None, value=1, help=""):
+		"""
+		:param str name: without the _total suffix
+		:param dict[str,str]|None labels:
+		:param int|float value:
+		:param str help:
+		"""
+		key = tuple(sorted((labels or {}).items()))
+		with self.lock:
+			samples = self._get(name, "counter", help)
+			samples[key] = samples.get(key, 0) + value
+
+	def remove(self, labels):
+		"""
+		Removes all samples with these labels, e.g. when a cgroup is gone.
+
+		:param dict[str,str] labels:
+		"""
+		items = set(labels.items())
+		with self.lock:
+			for _, _, samples in self.metrics.values():
+				for key in list(samples):
+					if items.issubset(key):
+						del samples[key]
+
+	def render(self):
+		"""
+		:return: OpenMetrics text format
+		:rtype: str
+		"""
+		lines = []
+		with self.lock:
+			for name, (type_, help_, samples) in sorted(self.metrics.items()):
+				lines.append("# TYPE %s %s" % (name, type_))
+				if help_:
+					lines.append("# HELP %s %s" % (name, help_))
+				suffix = "_total" if type_ == "counter" else ""
+				for key, value in sorted(samples.items()):
+					labels = ",".join(["%s=\"%s\"" % (k, _escapeLabelValue(v)) for k, v in key])
+					lines.append("%s%s%s %s" % (name, suffix, "{%s}" % labels if labels else "", _formatValue(value)))
+		lines.append("# EOF")
+		return "\n".join(lines) + "\n"
+
+
+def writeTextfile(registry, filename):
+	"""
+	Writes to a tmp file in the same dir, and then renames,
+	so that a reader never sees a partially written file.
+
+	:param MetricsRegistry registry:
+	:param str filename:
+	"""
+	tmpFilename = "%s.%i.tmp" % (filename, os.getpid())
+	with open(tmpFilename, "w") as f:
+		f.write(registry.render())
+	os.replace(tmpFilename, filename)
+
+
+class _Handler(BaseHTTPRequestHandler):
+	def do_GET(self):
+		if self.path.split("?")[0] not in ("/", "/metrics"):
+			self.send_error(404)
+			return
+		body = self.server.registry.render().encode("utf8")
+		self.send_response(200)
+		self.send_header("Content-Type", ContentType)
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		pass
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+	daemon_threads = True
+
+
+class UnixSocketServer:
+	"""
+	HTTP server on a Unix socket, in a background thread. E.g.::
+
+		curl --unix-socket <path> http://localhost/metrics
+	"""
+
+	def __init__(self, registry, path):
+		"""
+		:param MetricsRegistry registry:
+		:param str path:
+		"""
+		self.path = path
+		if os.path.exists(path):
+			os.unlink(path)  # left over from a previous run
+		self.server = _UnixHTTPServer(path, _Handler)
+		self.server.registry = registry
+		self.thread = threading.Thread(target=self.server.serve_forever, name="metrics server", daemon=True)
+		self.thread.start()
+
+	def close(self):
+		self.server.shutdown()
+		self.server.server_close()
+		if os.path.exists(self.path):
+			os.unlink(self.path)
+
+
+class MetricsExporter:
+	"""
+	Combines both outputs. Call update() whenever the values changed.
+	"""
+
+	def __init__(self, registry, socketPath=None, textfile=None, minInterval=1.):
+		"""
+		:param MetricsRegistry registry:
+		:param str|None socketPath:
+		:param str|None textfile:
+		:param float minInterval: write the textfile at most this often, in secs
+		"""
+		self.registry = registry
+		self.textfile = textfile
+		self.minInterval = minInterval
+		self.lastWrite = 0.
+		self.server = UnixSocketServer(registry, socketPath) if socketPath else None
+
+	def update(self, force=False):
+		"""
+		:param bool force: write the textfile even if the last write was less than minInterval ago
+		"""
+		if not self.textfile:
+			return
+		if not force and time.time() - self.lastWrite < self.minInterval:
+			return
+		writeTextfile(self.registry, self.textfile)
+		self.lastWrite = time.time()
+
+	def close(self):
+		self.update(force=True)
+		if self.server:
+			self.server.close()
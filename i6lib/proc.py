@@ -0,0 +1,201 @@
+"""
+Memory usage of processes, via /proc, and aggregation over process trees.
+"""
+
+import os
+import resource
+from collections import namedtuple
+
+
+PageSize = resource.getpagesize()
+
+# rss/pss/uss in bytes. pss/uss are None if not read (or not readable).
+ProcInfo = namedtuple("ProcInfo", ["pid", "ppid", "comm", "rss", "pss", "uss"])
+
+
+def _readFile(filename):
+	"""
+	:param str filename:
+	:rtype: bytes
+	"""
+	fd = os.open(filename, os.O_RDONLY | os.O_CLOEXEC)
+	try:
+		return os.read(fd, 1024 * 16)
+	finally:
+		os.close(fd)
+
+
+def readProcStat(pid):
+	"""
+	Reads /proc/<pid>/stat, which gives us the ppid and the rss in one go.
+
+	:param int pid:
+	:return: (ppid, comm, rss in bytes)
+	:rtype: (int,str,int)
+	"""
+	# http://man7.org/linux/man-pages/man5/proc.5.html
+	data = _readFile("/proc/%i/stat" % pid)
+	# comm is in parentheses and can contain spaces and parentheses itself.
+	p = data.rfind(b")")
+	comm = data[data.find(b"(") + 1:p].decode("utf8", "replace")
+	fields = data[p + 2:].split()
+	# fields[0] is field 3 (state) in the man page. ppid is field 4, rss (in pages) is field 24.
+	return int(fields[1]), comm, int(fields[21]) * PageSize
+
+
+def readSmapsRollup(pid):
+	"""
+	:param int pid:
+	:return: (pss, uss) in bytes. needs Linux >= 4.14, and permission to read it
+	:rtype: (int,int)
+	"""
+	data = _readFile("/proc/%i/smaps_rollup" % pid)
+	values = {}
+	for line in data.splitlines()[1:]:
+		key, value = line.split(b":", 1)
+		if key in (b"Pss", b"Private_Clean", b"Private_Dirty"):
+			values[key] = int(value.split()[0]) * 1024
+	return values[b"Pss"], values[b"Private_Clean"] + values[b"Private_Dirty"]
+
+
+def scanProcs(pids, smaps=False):
+	"""
+	:param list[int] pids:
+	:param bool smaps: also read pss/uss via smaps_rollup. this is much more expensive
+	:return: pid -> info. processes which are gone are left out
+	:rtype: dict[int,ProcInfo]
+	"""
+	procs = {}
+	for pid in pids:
+		try:
+			ppid, comm, rss = readProcStat(pid)
+		except (IOError, OSError, ValueError, IndexError):
+			continue  # gone in the meantime
+		pss = uss = None
+		if smaps:
+			try:
+				pss, uss = readSmapsRollup(pid)
+			except (IOError, OSError, KeyError, ValueError):
+				pass
+		procs[pid] = ProcInfo(pid=pid, ppid=ppid, comm=comm, rss=rss, pss=pss, uss=uss)
+	return procs
+
+
+def getProcTrees(procs):
+	"""
+	:param dict[int,ProcInfo] procs:
+	:return: root pid -> pids of the tree (incl. the root). the root is the topmost ancestor which is in procs
+	:rtype: dict[int,list[int]]
+	"""
+	roots = {}  # pid -> root, memo
+
+	def getRoot(pid):
+		path = []
+		while pid not in roots:
+			path.append(pid)
+			ppid = procs[pid].ppid
+			if ppid not in procs or ppid in path:
+				roots[pid] = pid
+				break
+			pid = ppid
+		root = roots[pid]
+		for p in path:
+			roots[p] = root
+		return root
+
+	trees = {}
+	for pid in sorted(procs):
+		trees.setdefault(getRoot(pid), []).append(pid)
+	return trees
+
+
+def getProcMem(proc):
+	"""
+	:param ProcInfo proc:
+	:return: pss if available, otherwise rss. summing pss over forked processes does not count shared pages twice
+	:rtype: int
+	"""
+	if proc.pss is not None:
+		return proc.pss
+	return proc.rss
+
+
+def getTreeMemUsage(procs):
+	"""
+	:param dict[int,ProcInfo] procs:
+	:return: list of (mem, root pid, pids), heaviest first
+	:rtype: list[(int,int,list[int])]
+	"""
+	res = []
+	for root, pids in getProcTrees(procs).items():
+		res.append((sum([getProcMem(procs[pid]) for pid in pids]), root, pids))
+	res.sort(reverse=True)
+	return res
+
+
+def getOwnAncestry():
+	"""
+	:return: our own pid and the pids of all our ancestors
+	:rtype: set[int]
+	"""
+	pids = set()
+	pid = os.getpid()
+	while pid > 0 and pid not in pids:
+		pids.add(pid)
+		try:
+			pid = readProcStat(pid)[0]
+		except (IOError, OSError, ValueError, IndexError):
+			break
+	return pids
+
+
+def getSubtreeMem(procs):
+	"""
+	:param dict[int,ProcInfo] procs:
+	:return: pid -> mem of the process and all its descendants in procs, and pid -> child pids
+	:rtype: (dict[int,int],dict[int,list[int]])
+	"""
+	children = {}
+	for pid, proc in procs.items():
+		if proc.ppid in procs and proc.ppid != pid:
+			children.setdefault(proc.ppid, []).append(pid)
+	mems = {}
+	for root, pids in getProcTrees(procs).items():
+		# Children before parents, so that we can accumulate bottom-up.
+		order = [root]
+		seen = {root}
+		for pid in order:
+			for child in children.get(pid, []):
+				if child not in seen:
+					seen.add(child)
+					order.append(child)
+		for pid in reversed(order):
+			mems[pid] = getProcMem(procs[pid]) + sum([mems[c] for c in children.get(pid, []) if c in mems])
+	return mems, children
+
+
+def findSignalTarget(procs):
+	"""
+	Finds the process which should be asked to free memory, e.g. the trainer.
+	The root of the heaviest process tree is usually not it, but a wrapper, e.g. the job shell,
+	which would just terminate on SIGUSR1.
+	So we walk down from the root, into the heaviest child subtree,
+	as long as that subtree has the majority of the memory, i.e. more than the process itself and its other children.
+	Like this, a trainer with its data loader workers is still taken as a whole,
+	also when the forked workers each count more (shared copy-on-write) RSS than the trainer itself.
+
+	:param dict[int,ProcInfo] procs: leave out processes which must never be the target, e.g. the watcher itself
+	:return: pid, or None if there are no procs
+	:rtype: int|None
+	"""
+	trees = getTreeMemUsage(procs)
+	if not trees:
+		return None
+	mems, children = getSubtreeMem(procs)
+	pid = trees[0][1]
+	while children.get(pid):
+		child = max(children[pid], key=lambda c: mems[c])
+		if mems[child] <= mems[pid] - mems[child]:
+			break
+		pid = child
+	return pid
@@ -1,34 +1,264 @@
 
-import socket
-from subprocess import Popen, PIPE, STDOUT
-import xml.etree.ElementTree as ET
+from subprocess import Popen, PIPE, STDOUT, DEVNULL, TimeoutExpired
 from . import str_
-import fcntl
-import select
+from .cache import TtlLruCache
+import selectors
 import os
 import time
-from pipes import quote
-import errno
+from shlex import quote
+from collections import namedtuple
 
+# Note: This module is imported by shell prompt hooks and the like, so keep the import cheap.
+# Expensive imports are done where they are needed, and values like notOnCluster are computed on first use.
 
-notOnCluster = not socket.gethostname().startswith("cluster-")
-if notOnCluster:
-	print("Not on cluster, starting qstat on cluster.")
 
+def isNotOnCluster():
+	"""
+	:return: whether we are not on the cluster, i.e. we must run qstat etc via ssh on a cluster node.
+		can be overwritten by setting the module attribute notOnCluster
+	:rtype: bool
+	"""
+	if "notOnCluster" not in globals():
+		import socket
+		value = not socket.gethostname().startswith("cluster-")
+		if value:
+			print("Not on cluster, starting qstat on cluster.")
+		globals()["notOnCluster"] = value
+	return globals()["notOnCluster"]
 
+def __getattr__(name):
+	if name == "notOnCluster":
+		return isNotOnCluster()
+	raise AttributeError("module %r has no attribute %r" % (__name__, name))
 
-def sshCmd(hostname, cmd):
-	return [
-		"ssh",
-		"-o", "BatchMode=yes",
-		"-o", "ConnectTimeout=3",
-		"-o", "ServerAliveInterval=2",
-		"-o", "StrictHostKeyChecking=no",
+
+
+SshOpts = [
+	"-o", "BatchMode=yes",
+	"-o", "ConnectTimeout=3",
+	"-o", "ServerAliveInterval=2",
+	"-o", "StrictHostKeyChecking=no"]
+
+# SSH connection multiplexing: we start a master connection in the background (see sshEnsureMaster),
+# which stays alive for SshControlPersist after the last use,
+# and all further ssh calls to that host (also from other processes) reuse it,
+# i.e. they skip the handshake. Without a master, ssh just connects directly.
+# We start the master explicitly with all stdio closed, because an implicitly started master (ControlMaster=auto)
+# would keep the stderr pipe of the first command open, and communicate() would hang.
+# sshCmd itself has no side effects, i.e. it never starts or checks a master.
+# An existing socket (maybe from another process) is checked via `ssh -O check` at most once per
+# SshMasterRetryInterval, and removed if it is stale (e.g. the master was killed).
+SshMultiplexing = True
+SshControlDir = os.environ.get("I6LIB_SSH_CONTROL_DIR")  # if None, see getSshControlDir
+SshControlPersist = "10m"
+SshControlTimeout = 2.  # secs for `ssh -O ...`. it only talks to the local master
+SshMasterStartTimeout = 10.  # secs. the master start is killed after that
+SshMasterRetryInterval = 60.  # secs. we check/start the master at most once per interval
+_sshMasterStartTimes = {}  # hostname -> time of the last check/start
+_sshControlDirOk = None  # see useSshMultiplexing
+
+def getSshControlDir():
+	global SshControlDir
+	if not SshControlDir:
+		import tempfile
+		SshControlDir = "%s/i6lib-ssh-%i" % (tempfile.gettempdir(), os.getuid())
+	return SshControlDir
+
+def useSshMultiplexing(multiplex=None):
+	"""
+	The control sockets give access to our ssh connections, so the control dir must be ours, and private.
+	Otherwise, someone else could have created it in advance, with their own sockets in it.
+
+	:param bool|None multiplex: by default SshMultiplexing
+	:return: whether to use multiplexing, i.e. multiplex, and the control dir is ok
+	:rtype: bool
+	"""
+	global _sshControlDirOk
+	if multiplex is None:
+		multiplex = SshMultiplexing
+	if not multiplex:
+		return False
+	if _sshControlDirOk is None:
+		controlDir = getSshControlDir()
+		os.makedirs(controlDir, mode=0o700, exist_ok=True)
+		st = os.stat(controlDir)
+		_sshControlDirOk = st.st_uid == os.getuid() and not st.st_mode & 0o077
+		if not _sshControlDirOk:
+			print("%s must be owned by us and only accessible by us, not using ssh multiplexing." % controlDir)
+	return _sshControlDirOk
+
+def sshControlPath(hostname):
+	return "%s/%s" % (getSshControlDir(), hostname)
+
+def _sshControlCmd(hostname, ctlCmd):
+	return ["ssh"] + SshOpts + ["-o", "ControlPath=%s" % sshControlPath(hostname), "-O", ctlCmd, hostname]
+
+def sshControl(hostname, ctlCmd):
+	"""
+	:param str hostname:
+	:param str ctlCmd: "check", "exit", ...
+	:return: whether it succeeded within SshControlTimeout
+	:rtype: bool
+	"""
+	proc = Popen(_sshControlCmd(hostname, ctlCmd), stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL)
+	try:
+		return proc.wait(timeout=SshControlTimeout) == 0
+	except TimeoutExpired:
+		proc.kill()
+		proc.wait()
+		return False
+
+def sshRemoveMaster(hostname):
+	"""
+	Stops the master, if there is one, and removes the socket, e.g. a stale one of a killed master.
+
+	:param str hostname:
+	"""
+	if os.path.exists(sshControlPath(hostname)):
+		sshControl(hostname, "exit")
+		try:
+			os.unlink(sshControlPath(hostname))
+		except OSError:
+			pass
+
+def sshCheckMaster(hostname):
+	"""
+	Health check of the master connection. A socket without a working master
+	(e.g. the master was killed, or the network connection died) is removed,
+	so that we can start a new master, and ssh does not complain about it.
+
+	:param str hostname:
+	:return: whether there is a working master connection
+	:rtype: bool
+	"""
+	if not os.path.exists(sshControlPath(hostname)):
+		return False
+	if sshControl(hostname, "check"):
+		return True
+	sshRemoveMaster(hostname)
+	return False
+
+def sshNeedsMaster(hostname):
+	"""
+	:param str hostname:
+	:return: whether we should check the master connection, or start one, i.e. we did not do that recently
+	:rtype: bool
+	"""
+	lastStart = _sshMasterStartTimes.get(hostname)
+	return lastStart is None or time.time() - lastStart > SshMasterRetryInterval
+
+def sshStartMasterAsync(hostname):
+	"""
+	:param str hostname:
+	:return: the ssh process. it exits (with -f, the master goes to the background) once the master is up
+	:rtype: Popen
+	"""
+	_sshMasterStartTimes[hostname] = time.time()
+	return Popen(
+		["ssh"] + SshOpts + [
+			"-o", "ControlMaster=yes",
+			"-o", "ControlPath=%s" % sshControlPath(hostname),
+			"-o", "ControlPersist=%s" % SshControlPersist,
+			"-N", "-f", hostname],
+		stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL)
+
+def sshCheckMasterAsync(hostname):
+	"""
+	Like :func:`sshCheckMaster`, but does not wait. Use :func:`sshCheckMasterFinish` on the result.
+
+	:param str hostname:
+	:return: the `ssh -O check` process
+	:rtype: Popen
+	"""
+	_sshMasterStartTimes[hostname] = time.time()
+	return Popen(_sshControlCmd(hostname, "check"), stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL)
+
+def sshCheckMasterFinish(hostname, proc):
+	"""
+	:param str hostname:
+	:param Popen proc: from :func:`sshCheckMasterAsync`. killed if it is not done within SshControlTimeout
+	:return: whether there is a working master connection. if it is stale, the socket is removed,
+		and the next :func:`sshNeedsMaster` is True, i.e. we start a new master
+	:rtype: bool
+	"""
+	try:
+		proc.wait(timeout=SshControlTimeout)  # it only talks to the local master, i.e. this is fast
+	except TimeoutExpired:
+		proc.kill()
+		proc.wait()
+		return False  # we don't know. check again after SshMasterRetryInterval
+	if proc.returncode == 0:
+		return True
+	sshRemoveMaster(hostname)
+	_sshMasterStartTimes.pop(hostname, None)
+	return False
+
+def sshStartMaster(hostname, timeout=None):
+	"""
+	:param str hostname:
+	:param float|None timeout: secs, by default SshMasterStartTimeout. after that, the start is killed
+	:return: whether there is a working master connection now
+	:rtype: bool
+	"""
+	if sshCheckMaster(hostname):
+		_sshMasterStartTimes[hostname] = time.time()
+		return True
+	if timeout is None:
+		timeout = SshMasterStartTimeout
+	proc = sshStartMasterAsync(hostname)
+	try:
+		return proc.wait(timeout=timeout) == 0
+	except TimeoutExpired:
+		proc.kill()
+		proc.wait()
+		return False
+
+def sshEnsureMaster(hostname, multiplex=None):
+	"""
+	Checks the master connection, and starts one if there is none (blocking, at most SshMasterStartTimeout),
+	at most once per SshMasterRetryInterval.
+	Call this before running sshCmd(hostname, ...) when you want multiplexing.
+
+	:param str hostname:
+	:param bool|None multiplex: by default SshMultiplexing. if False, does nothing
+	"""
+	if useSshMultiplexing(multiplex) and sshNeedsMaster(hostname):
+		sshStartMaster(hostname)
+
+def sshTeardown(hostname=None):
+	"""
+	Stops the master connection(s).
+
+	:param str|None hostname: if None, all masters in SshControlDir
+	"""
+	if hostname is None:
+		controlDir = getSshControlDir()
+		hostnames = sorted(os.listdir(controlDir)) if os.path.isdir(controlDir) else []
+	else:
+		hostnames = [hostname]
+	for hostname in hostnames:
+		sshControl(hostname, "exit")
+		_sshMasterStartTimes.pop(hostname, None)
+
+def sshCmd(hostname, cmd, multiplex=None):
+	"""
+	:param str hostname:
+	:param list[str] cmd:
+	:param bool|None multiplex: use the master connection. by default SshMultiplexing.
+		this must be False if the ssh command runs on another host, because the socket dir is local
+	:rtype: list[str]
+	"""
+	opts = []
+	if useSshMultiplexing(multiplex):
+		# ControlMaster=no: use the master if it is there, otherwise just connect directly.
+		opts = ["-o", "ControlMaster=no", "-o", "ControlPath=%s" % sshControlPath(hostname)]
+	return ["ssh"] + SshOpts + opts + [
 		hostname,
 		" ".join(map(quote, cmd))]
 
 def clusterCmd(cmd):
-	if notOnCluster:
+	if isNotOnCluster():
+		sshEnsureMaster("cluster-cn-01")
 		return sshCmd("cluster-cn-01", cmd)
 	return cmd
 
@@ -56,41 +286,109 @@ def collectQstatInfo(out):
 			info[key] = value
 	return info
 
-qstatInfoCache = {}
+def splitQstatInfos(out):
+	"""
+	:param str out: output of `qstat -j id1,id2,...`, where every job starts with a "===" line
+	:return: the output per job
+	:rtype: list[str]
+	"""
+	parts = []
+	lines = []
+	for line in out.splitlines():
+		if line.startswith("==="):
+			if lines:
+				parts.append("\n".join(lines))
+			lines = []
+			continue
+		lines.append(line)
+	if lines:
+		parts.append("\n".join(lines))
+	return parts
+
+# Set I6LIB_QSTAT_CACHE_DB to a sqlite file to share the cache between processes.
+qstatInfoCache = TtlLruCache(maxSize=10000, defaultTtl=300., dbFilename=os.environ.get("I6LIB_QSTAT_CACHE_DB"))
+QstatBatchSize = 100  # max number of job ids per qstat -j call
+QstatInfoTtlQueued = 30.  # secs. queued jobs can still be modified (qalter), and will get started
+QstatInfoTtlRunning = 3600.  # secs. the details of running jobs hardly change
+
+def getQstatInfoTtl(state):
+	"""
+	:param str|None state: e.g. "r", "qw", "hqw", "Eqw", as in the qstat overview
+	:return: how long we cache the details of a job in this state, in secs
+	:rtype: float
+	"""
+	if not state:
+		return qstatInfoCache.defaultTtl
+	if "q" in state or "w" in state:
+		return QstatInfoTtlQueued
+	return QstatInfoTtlRunning
+
+def getQstatInfos(jobIds, states=None):
+	"""
+	Like getQstatInfo, but for many jobs with only a few qstat calls.
+
+	:param list[int|str] jobIds:
+	:param dict[int|str,str]|None states: jobId -> state, e.g. from getCurrentJobs. determines the cache TTL
+	:return: jobId -> info, or None if the job does not exist (anymore)
+	:rtype: dict[int|str,dict[str,str]|None]
+	"""
+	res = {}
+	missing = []
+	for jobId in jobIds:
+		info = qstatInfoCache.get(jobId)
+		if info is not None:
+			res[jobId] = info
+		elif jobId not in missing:
+			missing.append(jobId)
+	for i in range(0, len(missing), QstatBatchSize):
+		batch = missing[i:i + QstatBatchSize]
+		qcmd = ["qstat", "-j", ",".join(map(str, batch))]
+		qcmd = clusterCmd(qcmd)
+		out, err = Popen(qcmd, stdout=PIPE, stderr=PIPE).communicate()
+		out, err = map(str_.get_str, (out, err))
+		# If some jobs do not exist (e.g. they already quit), we get
+		# "Following jobs do not exist:" in err, and the info of the other jobs in out.
+		infos = {}
+		for part in splitQstatInfos(out):
+			info = collectQstatInfo(part)
+			if "job_number" in info:
+				infos[str(info["job_number"])] = info
+		for jobId in batch:
+			info = infos.get(str(jobId))
+			if info is not None:
+				qstatInfoCache.set(jobId, info, ttl=getQstatInfoTtl((states or {}).get(jobId)))
+			res[jobId] = info
+	return res
 
 def getQstatInfo(jobId):
-	if jobId in qstatInfoCache:
-		return qstatInfoCache[jobId]
-	qcmd = ["qstat", "-j", str(jobId)]
-	qcmd = clusterCmd(qcmd)
-	out, err = Popen(qcmd, stdout=PIPE, stderr=PIPE).communicate()
-	out, err = map(str_.get_str, (out, err))
-	if "Following jobs do not exist:" in err:
-		# Can happen if job already quit.
-		return None
-	info = collectQstatInfo(out)
-	qstatInfoCache[jobId] = info
-	return info
+	return getQstatInfos([jobId])[jobId]
+
+# One line of the qstat overview. Same keys as the dicts of getCurrentJobs.
+QstatJob = namedtuple("QstatJob", ["id", "name", "user", "state", "date_time", "host", "slots", "tasks"])
+
+# XML tag -> QstatJob field
+_QstatJobTags = {
+	"JB_job_number": "id", "JB_name": "name", "JB_owner": "user", "state": "state",
+	"JAT_start_time": "start_time", "JB_submission_time": "submission_time",
+	"queue_name": "host", "slots": "slots", "tasks": "tasks"}
+
+def parseQstatJob(xmlNode):
+	"""
+	:param xml.etree.ElementTree.Element xmlNode: job_list
+	:rtype: QstatJob
+	"""
+	values = {}
+	for child in xmlNode:
+		key = _QstatJobTags.get(child.tag)
+		if key:
+			values[key] = child.text
+	return QstatJob(
+		id=int(values["id"]), name=values["name"], user=values["user"], state=values["state"],
+		date_time=values.get("start_time") or values.get("submission_time"),
+		host=values.get("host") or "", slots=values.get("slots"), tasks=values.get("tasks") or "0")
 
 def parseQstatOverviewLine(xmlNode):
-	info = {}
-	info["id"] = int(xmlNode.find("JB_job_number").text)
-	info["name"] = xmlNode.find("JB_name").text
-	info["user"] = xmlNode.find("JB_owner").text
-	info["state"] = xmlNode.find("state").text
-	startTime = xmlNode.find("JAT_start_time")
-	if startTime is not None:
-		info["date_time"] = startTime.text
-	else:
-		info["date_time"] = xmlNode.find("JB_submission_time").text
-	info["host"] = xmlNode.find("queue_name").text or ""
-	info["slots"] = xmlNode.find("slots").text
-	tasks = xmlNode.find("tasks")
-	if tasks is not None:
-		info["tasks"] = tasks.text
-	else:
-		info["tasks"] = "0"
-	return info
+	return dict(parseQstatJob(xmlNode)._asdict())
 
 def getJobCwd(info):
 	if "sge_o_workdir" in info:
@@ -100,110 +398,287 @@ def getJobCwd(info):
 	else:
 		return None
 
-def getCurrentJobs(user=None):
+def iterParseQstatXml(stream):
+	"""
+	Parses the output of `qstat -xml` incrementally, and frees the parsed elements on the way,
+	so that the memory usage stays constant, also for huge listings.
+
+	:param typing.BinaryIO stream:
+	:rtype: typing.Iterator[QstatJob]
+	"""
+	import xml.etree.ElementTree as ET
+	stack = []
+	try:
+		for event, elem in ET.iterparse(stream, events=("start", "end")):
+			if event == "start":
+				if not stack:
+					assert elem.tag == "job_info"
+				elif len(stack) == 1:
+					assert elem.tag in ["queue_info", "job_info"]
+				elif len(stack) == 2:
+					assert elem.tag == "job_list"
+				stack.append(elem)
+				continue
+			stack.pop()
+			if elem.tag == "job_list" and len(stack) == 2:
+				yield parseQstatJob(elem)
+				stack[-1].remove(elem)
+	except ET.ParseError:
+		if stack:
+			raise
+		# Empty output.
+
+def iterCurrentJobs(user=None):
+	"""
+	:param str|None user: by default the local user. "*" for all users
+	:rtype: typing.Iterator[QstatJob]
+	"""
 	if user is None:
 		from .user import LocalUser
 		user = LocalUser
 	qcmd = ["qstat", "-u", user, "-xml"]
 	qcmd = clusterCmd(qcmd)
 
-	xml = Popen(qcmd, stdout=PIPE).stdout.read()
-	if not xml.strip():
-		return []
+	proc = Popen(qcmd, stdout=PIPE)
+	try:
+		for job in iterParseQstatXml(proc.stdout):
+			yield job
+	finally:
+		proc.stdout.close()
+		if proc.poll() is None:
+			proc.kill()  # generator was not consumed until the end
+		proc.wait()
 
-	root = ET.fromstring(xml)
-	assert root.tag == "job_info"
+# Use the job status daemon (i6lib.sge_daemon) if it is running.
+# Its data can be up to about its poll interval old (see sge_daemon.MaxAgeSlack),
+# so set this to False if you need the state right after e.g. a qsub.
+UseJobStatusDaemon = True
 
-	jobs = []
-	for l in root:
-		assert l.tag in ["queue_info", "job_info"]
-		for node in l:
-			assert node.tag == "job_list"
-			info = parseQstatOverviewLine(node)
-			jobs += [info]
-	return jobs
+def getCurrentJobs(user=None):
+	if user is None:
+		from .user import LocalUser
+		user = LocalUser
+	if UseJobStatusDaemon:
+		from . import sge_daemon
+		jobs = sge_daemon.getCurrentJobs(user)
+		if jobs is not None:
+			return jobs
+	return [dict(job._asdict()) for job in iterCurrentJobs(user)]
 
 
-def getCurrentJobsMoreInfo(user=None):
-	jobs = []
-	for info in getCurrentJobs(user):
-		moreInfo = getQstatInfo(info["id"])
+def addMoreInfo(jobs):
+	"""
+	:param list[dict[str]] jobs: from getCurrentJobs. will be extended by the qstat -j info
+	:rtype: list[dict[str]]
+	"""
+	moreInfos = getQstatInfos(
+		[info["id"] for info in jobs], states={info["id"]: info["state"] for info in jobs})
+	for info in jobs:
+		moreInfo = moreInfos[info["id"]]
 		for k in set(moreInfo or ()).difference(info):
 			info[k] = moreInfo[k]
 		info["cwd"] = getJobCwd(info)
-		jobs += [info]
 	return jobs
 
+def getCurrentJobsMoreInfo(user=None):
+	if user is None:
+		from .user import LocalUser
+		user = LocalUser
+	if UseJobStatusDaemon:
+		from . import sge_daemon
+		jobs = sge_daemon.getCurrentJobs(user, moreInfo=True)
+		if jobs is not None:
+			return jobs
+	return addMoreInfo(getCurrentJobs(user))
+
+
+def getClusterHosts():
+	"""
+	:return: the execution hosts, via qhost
+	:rtype: list[str]
+	"""
+	out = Popen(clusterCmd(["qhost"]), stdout=PIPE).communicate()[0]
+	hosts = []
+	for line in str_.get_str(out).splitlines():
+		if not line or line.startswith(("HOSTNAME", "---", "global", " ")):
+			continue
+		hosts.append(line.split()[0])
+	return hosts
 
-def _checkReadableStream(stream, timeout):
-	while True:
-		try:
-			readable, writable, exceptional = select.select([stream], [], [stream], timeout)
-			return readable
-		except EnvironmentError as e:
-			if e.errno == errno.EINTR:
-				# http://stackoverflow.com/questions/14136195
-				# We can just keep trying.
-				continue
-			raise
-		except select.error as e:  # Deprecated, Python 2 and Python <=3.2
-			if e.args[0] == errno.EINTR:
-				continue
-			raise
 
 class CheckException(Exception): pass
 class HangingException(CheckException): pass
 class TimeoutException(HangingException): pass
 class ProcModulesHangingException(HangingException): pass
 
-def checkHangingHost(hostname):
-	begin_str, end_str = "__BEGIN", "__END"
+HangCheckBeginTimeout = 10.0  # secs until we must have the connection
+HangCheckCatProcTimeout = 10.0  # secs for `cat /proc/modules`, after we have the connection
+SshMaxSessions = 10  # default MaxSessions of sshd, i.e. max number of sessions over one master connection
+
+# (hostname, status, exception or None, total secs, secs until connected or None, output)
+# status is one of "ok", "timeout", "proc_modules_hanging", "unexpected_output"
+HostCheckResult = namedtuple(
+	"HostCheckResult", ["hostname", "status", "exception", "duration", "connectTime", "output"])
+
+_HangCheckBegin, _HangCheckEnd = "__BEGIN", "__END"
+
+def _hangCheckSshHost(hostname):
+	"""
+	:param str hostname:
+	:return: the host of the first ssh hop of the hang check, i.e. where a local master connection helps
+	:rtype: str
+	"""
+	if isNotOnCluster():
+		return "cluster-cn-01"
+	return hostname
+
+def _hangCheckCmd(hostname, multiplex=None):
 	cmd = [
 		"/bin/bash", "-c",
-		"echo %s && cat /proc/modules && echo %s" % (begin_str, end_str)]
-	cmd = sshCmd(hostname, cmd)
-	cmd = clusterCmd(cmd)
-	proc = Popen(cmd, stderr=STDOUT, stdout=PIPE, stdin=PIPE)
-	fl = fcntl.fcntl(proc.stdout, fcntl.F_GETFL)
-	fcntl.fcntl(proc.stdout, fcntl.F_SETFL, fl | os.O_NONBLOCK)
-	start_time = time.time()
-	have_begin = False
-	begin_timeout = 10.0
-	cat_proc_timeout = 10.0
-	out = b""
-	while True:
-		proc.poll()
-		if proc.returncode is not None:
-			# Finished. Read remaining data.
-			while True:
-				readable = _checkReadableStream(proc.stdout, 0.1)
-				if not readable: break
-				buf = os.read(proc.stdout.fileno(), 1024)
-				if not buf: break
-				out += buf
-		else:
-			readable = _checkReadableStream(proc.stdout, 0.1)
-			if readable:
-				buf = os.read(proc.stdout.fileno(), 1024)
-				out += buf
-		if not have_begin:
-			# Ignore other prefix. Some SSHs will output some welcome msg or so.
-			if out.startswith(("%s\n" % begin_str).encode("utf8")) or ("\n%s\n" % begin_str).encode("utf8") in out:
-				have_begin = True
-				start_time = time.time()
-		if proc.returncode is None:  # still running
-			if not have_begin:
-				if time.time() - start_time > begin_timeout:
-					raise TimeoutException("%s: no connection after timeout. output so far: %r" % (hostname, out))
+		"echo %s && cat /proc/modules && echo %s" % (_HangCheckBegin, _HangCheckEnd)]
+	if isNotOnCluster():
+		# This ssh runs on the cluster node, so we cannot use our local control socket.
+		return sshCmd("cluster-cn-01", sshCmd(hostname, cmd, multiplex=False), multiplex=multiplex)
+	return sshCmd(hostname, cmd, multiplex=multiplex)
+
+def _hasHangCheckBegin(out):
+	# Ignore other prefix. Some SSHs will output some welcome msg or so.
+	begin = ("%s\n" % _HangCheckBegin).encode("utf8")
+	return out.startswith(begin) or b"\n" + begin in out
+
+class _HangCheck:
+	def __init__(self, hostname, multiplex=None):
+		self.hostname = hostname
+		self.startTime = time.time()
+		self.connectTime = None
+		self.out = bytearray()
+		# The master check/start must not block the hang check, so it runs in parallel,
+		# and this check uses the existing master, or connects directly. Later checks of the host reuse the master.
+		self.masterHost = _hangCheckSshHost(hostname)
+		self.masterProc = None
+		self.masterCheck = False  # whether masterProc is `ssh -O check`, otherwise the master start
+		if useSshMultiplexing(multiplex) and sshNeedsMaster(self.masterHost):
+			if os.path.exists(sshControlPath(self.masterHost)):
+				self.masterProc = sshCheckMasterAsync(self.masterHost)
+				self.masterCheck = True
 			else:
-				if time.time() - start_time > cat_proc_timeout:
-					proc.kill()
-					raise ProcModulesHangingException(hostname)  # hanging!
+				self.masterProc = sshStartMasterAsync(self.masterHost)
+		self.proc = Popen(_hangCheckCmd(hostname, multiplex=multiplex), stderr=STDOUT, stdout=PIPE, stdin=DEVNULL)
+		os.set_blocking(self.proc.stdout.fileno(), False)
+
+	def deadline(self):
+		if self.connectTime is None:
+			return self.startTime + HangCheckBeginTimeout
+		return self.startTime + self.connectTime + HangCheckCatProcTimeout
+
+	def read(self):
+		"""
+		:return: False on EOF
+		:rtype: bool
+		"""
+		try:
+			buf = os.read(self.proc.stdout.fileno(), 65536)
+		except BlockingIOError:
+			return True
+		self.out += buf
+		if self.connectTime is None and _hasHangCheckBegin(self.out):
+			self.connectTime = time.time() - self.startTime
+		return bool(buf)
+
+	def stopMasterStart(self):
+		"""
+		A master check/start which did not finish within the check is killed. We retry after SshMasterRetryInterval.
+		A stale master socket is removed, so that the next check of the host starts a new master.
+		"""
+		if self.masterProc is None:
+			return
+		if self.masterCheck:
+			sshCheckMasterFinish(self.masterHost, self.masterProc)
 		else:
-			break
-	if not have_begin:
-		raise CheckException("%s: did not get prefix output: %r" % (hostname, out))
-	if not out.endswith((end_str + "\n").encode("utf8")):
-		raise CheckException("%s: unexpected postfix output: %r" % (hostname, out))
-	return  # everything ok
+			if self.masterProc.poll() is None:
+				self.masterProc.kill()
+			self.masterProc.wait()
+		self.masterProc = None
+
+	def finish(self, timedOut):
+		"""
+		:param bool timedOut:
+		:rtype: HostCheckResult
+		"""
+		if timedOut:
+			self.proc.kill()
+		self.proc.wait()
+		self.proc.stdout.close()
+		self.stopMasterStart()
+		out = bytes(self.out)
+		hostname = self.hostname
+		if timedOut and self.connectTime is None:
+			exc = TimeoutException("%s: no connection after timeout. output so far: %r" % (hostname, out))
+			status = "timeout"
+		elif timedOut:
+			exc = ProcModulesHangingException(hostname)  # hanging!
+			status = "proc_modules_hanging"
+		elif self.connectTime is None:
+			exc = CheckException("%s: did not get prefix output: %r" % (hostname, out))
+			status = "unexpected_output"
+		elif not out.endswith((_HangCheckEnd + "\n").encode("utf8")):
+			exc = CheckException("%s: unexpected postfix output: %r" % (hostname, out))
+			status = "unexpected_output"
+		else:
+			exc = None
+			status = "ok"
+		return HostCheckResult(
+			hostname=hostname, status=status, exception=exc, duration=time.time() - self.startTime,
+			connectTime=self.connectTime, output=out)
+
+def checkHangingHosts(hostnames, maxInFlight=32, callback=None):
+	"""
+	Checks many hosts concurrently, with at most maxInFlight checks at the same time.
+
+	:param list[str] hostnames:
+	:param int maxInFlight:
+	:param None|(HostCheckResult)->None callback: called as soon as a host is done
+	:return: results, in the order of hostnames
+	:rtype: list[HostCheckResult]
+	"""
+	# With more concurrent sessions than sshd allows over one master connection, the sessions would be refused.
+	multiplex = None if min(maxInFlight, len(hostnames)) <= SshMaxSessions else False
+	pending = list(hostnames)
+	pending.reverse()
+	results = {}
+	sel = selectors.DefaultSelector()
+	running = set()
+	try:
+		while pending or running:
+			while pending and len(running) < maxInFlight:
+				check = _HangCheck(pending.pop(), multiplex=multiplex)
+				sel.register(check.proc.stdout, selectors.EVENT_READ, check)
+				running.add(check)
+			timeout = max(min([check.deadline() for check in running]) - time.time(), 0.)
+			done = []  # (check, timedOut)
+			for key, _ in sel.select(timeout):
+				if not key.data.read():
+					done.append((key.data, False))
+			now = time.time()
+			for check in running:
+				if check.deadline() <= now and check not in [c for c, _ in done]:
+					done.append((check, True))
+			for check, timedOut in done:
+				sel.unregister(check.proc.stdout)
+				running.remove(check)
+				results[check.hostname] = res = check.finish(timedOut)
+				if callback:
+					callback(res)
+	finally:
+		for check in running:
+			check.proc.kill()
+			check.proc.wait()
+			check.stopMasterStart()
+		sel.close()
+	return [results[hostname] for hostname in hostnames]
 
+def checkHangingHost(hostname):
+	res = checkHangingHosts([hostname])[0]
+	if res.exception:
+		raise res.exception
+	return  # everything ok
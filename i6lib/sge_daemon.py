@@ -0,0 +1,361 @@
+"""
+Job status daemon: polls qstat for all users at a fixed rate, keeps the job table in memory,
+and serves snapshots and incremental diffs over a Unix socket.
+So with many clients (monitoring scripts, shell prompts, dashboards), the scheduler only sees one qstat poll loop.
+
+`sge.getCurrentJobs` and `sge.getCurrentJobsMoreInfo` use the daemon if it is running,
+and fall back to calling qstat directly otherwise.
+
+Start it via::
+
+	python3 -m i6lib.sge_daemon
+
+Protocol: one JSON request line, one JSON response line. Requests:
+
+	{"cmd": "snapshot", "user": "az"}  -> {"version": ..., "time": ..., "jobs": [...]}
+	{"cmd": "snapshot", "user": "az", "moreInfo": true}  -> like getCurrentJobsMoreInfo
+	{"cmd": "diff", "user": "az", "since": version}
+		-> {"version": ..., "time": ..., "added": [...], "changed": [...], "removed": [[id, tasks], ...]}
+		or a snapshot (with "resync": true) if that version is too old
+
+user can be "*" for all users.
+A job is identified by (id, tasks), as for an array job, every running task and the pending task range
+are separate entries with the same id, like in the qstat output.
+Every response also has the "interval" of the daemon.
+
+The socket is only accessible by our user: it is created with mode 0600,
+by default in a directory with mode 0700, and clients ignore a socket owned by another user.
+"""
+
+import os
+import sys
+import time
+import json
+import socket
+import tempfile
+import threading
+import socketserver
+import signal
+from collections import deque
+from argparse import ArgumentParser
+from . import sge
+
+
+DefaultSocketPath = (
+	os.environ.get("I6LIB_SGE_DAEMON_SOCKET") or
+	"%s/i6lib-sge-daemon-%i/daemon.sock" % (tempfile.gettempdir(), os.getuid()))
+DefaultInterval = 10.  # secs between qstat polls
+# secs. clients ignore the daemon if its last successful poll is older than its interval plus this,
+# i.e. if it missed a poll, they rather call qstat themselves than get stale data.
+MaxAgeSlack = 5.
+ClientTimeout = 5.  # secs
+MaxDiffHistory = 100  # number of diffs we keep, to serve clients which are some versions behind
+
+
+class JobTable:
+	"""
+	The current jobs of all users, and the recent diffs. Thread-safe.
+	"""
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.jobs = {}  # (id, tasks) -> sge.QstatJob, in the order of qstat
+		self.version = 0
+		self.time = None  # of the last successful update
+		self.diffs = deque(maxlen=MaxDiffHistory)  # (version, added keys, changed keys, removed keys)
+
+	def update(self, jobs):
+		"""
+		:param list[sge.QstatJob] jobs:
+		"""
+		newJobs = {jobKey(job): job for job in jobs}
+		with self.lock:
+			added = [key for key in newJobs if key not in self.jobs]
+			removed = [key for key in self.jobs if key not in newJobs]
+			changed = [key for key, job in newJobs.items() if key in self.jobs and self.jobs[key] != job]
+			if added or removed or changed:
+				self.version += 1
+				self.diffs.append((self.version, set(added), set(changed), set(removed)))
+			self.jobs = newJobs
+			self.time = time.time()
+
+	def snapshot(self, user):
+		"""
+		:param str user: or "*"
+		:rtype: dict[str]
+		"""
+		with self.lock:
+			jobs = [dict(job._asdict()) for job in self.jobs.values() if user in ("*", job.user)]
+			return {"version": self.version, "time": self.time, "jobs": jobs}
+
+	def diff(self, user, since):
+		"""
+		:param str user: or "*"
+		:param int since: version
+		:rtype: dict[str]
+		"""
+		with self.lock:
+			if since == self.version:
+				return {"version": self.version, "time": self.time, "added": [], "changed": [], "removed": []}
+			if not self.diffs or self.diffs[0][0] > since + 1 or since > self.version:
+				res = None  # too old, or unknown. outside the lock, because snapshot locks as well
+			else:
+				existedBefore = {}  # (id, tasks) -> bool, from the first diff after since which touches the job
+				for version, added_, changed_, removed_ in self.diffs:
+					if version <= since:
+						continue
+					for key in added_:
+						existedBefore.setdefault(key, False)
+					for key in changed_ | removed_:
+						existedBefore.setdefault(key, True)
+				added = {key for key, before in existedBefore.items() if not before and key in self.jobs}
+				changed = {key for key, before in existedBefore.items() if before and key in self.jobs}
+				removed = [key for key, before in existedBefore.items() if before and key not in self.jobs]
+
+				def jobList(keys):
+					return [
+						dict(job._asdict()) for key, job in self.jobs.items()
+						if key in keys and user in ("*", job.user)]
+				res = {
+					"version": self.version, "time": self.time,
+					"added": jobList(added), "changed": jobList(changed),
+					# We don't know the user of removed jobs anymore. The client just ignores unknown keys.
+					"removed": [list(key) for key in sorted(removed)]}
+		if res is None:
+			res = self.snapshot(user)
+			res["resync"] = True
+		return res
+
+
+def jobKey(job):
+	"""
+	:param sge.QstatJob|dict[str] job:
+	:return: (id, tasks), which identifies a line of the qstat output
+	:rtype: (int,str)
+	"""
+	if isinstance(job, dict):
+		return job["id"], job["tasks"]
+	return job.id, job.tasks
+
+
+class _Handler(socketserver.StreamRequestHandler):
+	def handle(self):
+		line = self.rfile.readline()
+		if not line:
+			return
+		try:
+			req = json.loads(line.decode("utf8"))
+			res = self.server.daemon.handleRequest(req)
+		except Exception as exc:
+			res = {"error": "%s: %s" % (type(exc).__name__, exc)}
+		self.wfile.write(json.dumps(res).encode("utf8") + b"\n")
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+	daemon_threads = True
+
+
+class JobStatusDaemon:
+	def __init__(self, socketPath=DefaultSocketPath, interval=DefaultInterval):
+		"""
+		:param str socketPath:
+		:param float interval: secs between qstat polls
+		"""
+		self.socketPath = socketPath
+		self.interval = interval
+		self.table = JobTable()
+		self.server = None
+
+	def poll(self):
+		self.table.update(list(sge.iterCurrentJobs(user="*")))
+
+	def handleRequest(self, req):
+		"""
+		:param dict[str] req:
+		:rtype: dict[str]
+		"""
+		if self.table.time is None:
+			return {"error": "no data yet"}
+		user = req.get("user") or "*"
+		if req.get("cmd") == "snapshot":
+			res = self.table.snapshot(user)
+			if req.get("moreInfo"):
+				# qstat -j. goes via the (bounded, TTL) qstatInfoCache, so repeated requests don't hit the scheduler.
+				res["jobs"] = sge.addMoreInfo(res["jobs"])
+		elif req.get("cmd") == "diff":
+			res = self.table.diff(user, int(req["since"]))
+		else:
+			return {"error": "unknown request %r" % req.get("cmd")}
+		res["interval"] = self.interval
+		return res
+
+	def run(self):
+		if self.socketPath == DefaultSocketPath:
+			socketDir = os.path.dirname(self.socketPath)
+			os.makedirs(socketDir, mode=0o700, exist_ok=True)
+			st = os.stat(socketDir)
+			if st.st_uid != os.getuid() or st.st_mode & 0o077:
+				raise Exception("%s must be owned by us and only accessible by us" % socketDir)
+		if os.path.exists(self.socketPath):
+			if _isListening(self.socketPath):
+				raise Exception("daemon already running on %s" % self.socketPath)
+			os.unlink(self.socketPath)  # left over
+		oldUmask = os.umask(0o177)  # bind creates the socket with mode 0600
+		try:
+			self.server = _UnixServer(self.socketPath, _Handler)
+		finally:
+			os.umask(oldUmask)
+		self.server.daemon = self
+		threading.Thread(target=self.server.serve_forever, name="sge daemon server", daemon=True).start()
+		print("Serving on %s, polling qstat every %.0f secs." % (self.socketPath, self.interval))
+		try:
+			while True:
+				start = time.time()
+				try:
+					self.poll()
+				except Exception as exc:
+					# Keep the old table. Clients will fall back to qstat once it is too old.
+					print("qstat poll failed: %s: %s" % (type(exc).__name__, exc))
+				time.sleep(max(self.interval - (time.time() - start), 0.))
+		finally:
+			self.server.shutdown()
+			self.server.server_close()
+			os.unlink(self.socketPath)
+
+
+def _isListening(socketPath):
+	"""
+	:param str socketPath:
+	:rtype: bool
+	"""
+	sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	try:
+		sock.connect(socketPath)
+	except OSError:
+		return False
+	finally:
+		sock.close()
+	return True
+
+
+def queryDaemon(req, socketPath=None, maxAge=None):
+	"""
+	:param dict[str] req:
+	:param str|None socketPath:
+	:param float|None maxAge: if the data of the daemon is older than this, return None.
+		by default, the poll interval of the daemon plus MaxAgeSlack
+	:return: response, or None if the daemon is not running or not usable
+	:rtype: dict[str]|None
+	"""
+	socketPath = socketPath or DefaultSocketPath
+	try:
+		if os.stat(socketPath).st_uid != os.getuid():
+			return None  # not our daemon
+	except OSError:
+		return None  # not running
+	try:
+		sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		sock.settimeout(ClientTimeout)
+		try:
+			sock.connect(socketPath)
+			sock.sendall(json.dumps(req).encode("utf8") + b"\n")
+			f = sock.makefile("rb")
+			res = json.loads(f.readline().decode("utf8"))
+			f.close()
+		finally:
+			sock.close()
+	except (OSError, ValueError):
+		return None
+	if "error" in res:
+		return None
+	if maxAge is None:
+		maxAge = res.get("interval", DefaultInterval) + MaxAgeSlack
+	if time.time() - res["time"] > maxAge:
+		return None
+	return res
+
+
+def getCurrentJobs(user, moreInfo=False):
+	"""
+	:param str user:
+	:param bool moreInfo:
+	:return: like sge.getCurrentJobs, or None if the daemon is not usable
+	:rtype: list[dict[str]]|None
+	"""
+	res = queryDaemon({"cmd": "snapshot", "user": user, "moreInfo": moreInfo})
+	if res is None:
+		return None
+	return res["jobs"]
+
+
+class JobWatcher:
+	"""
+	Client side: keeps a local copy of the job table, and updates it via diffs.
+	"""
+
+	def __init__(self, user, socketPath=None):
+		"""
+		:param str user: or "*"
+		:param str|None socketPath:
+		"""
+		self.user = user
+		self.socketPath = socketPath
+		self.version = None
+		self.jobs = {}  # (id, tasks) -> dict
+
+	def update(self):
+		"""
+		:return: (added, changed, removed) jobs since the last update, or None if the daemon is not usable
+		:rtype: (list[dict[str]],list[dict[str]],list[dict[str]])|None
+		"""
+		if self.version is None:
+			res = queryDaemon({"cmd": "snapshot", "user": self.user}, socketPath=self.socketPath)
+		else:
+			res = queryDaemon({"cmd": "diff", "user": self.user, "since": self.version}, socketPath=self.socketPath)
+		if res is None:
+			return None
+		if "jobs" in res:  # snapshot
+			newJobs = {jobKey(job): job for job in res["jobs"]}
+			added = [job for key, job in newJobs.items() if key not in self.jobs]
+			changed = [job for key, job in newJobs.items() if key in self.jobs and self.jobs[key] != job]
+			removed = [job for key, job in self.jobs.items() if key not in newJobs]
+			self.jobs = newJobs
+		else:
+			added, changed = res["added"], res["changed"]
+			removed = [self.jobs.pop(tuple(key)) for key in res["removed"] if tuple(key) in self.jobs]
+			for job in added + changed:
+				self.jobs[jobKey(job)] = job
+		self.version = res["version"]
+		return added, changed, removed
+
+
+def main():
+	parser = ArgumentParser(description="SGE job status daemon.")
+	parser.add_argument("--socket", default=DefaultSocketPath, help="default: %s" % DefaultSocketPath)
+	parser.add_argument(
+		"--interval", type=float, default=DefaultInterval, help="secs between qstat polls. default: %s" % DefaultInterval)
+	parser.add_argument("--watch", metavar="USER", help="client mode: print the changes of the jobs of this user")
+	args = parser.parse_args()
+
+	# Force disable stdout buffering.
+	sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 1)
+
+	if args.watch:
+		watcher = JobWatcher(args.watch, socketPath=args.socket)
+		while True:
+			res = watcher.update()
+			if res is None:
+				print("daemon not available")
+			else:
+				for kind, jobs in zip(("added", "changed", "removed"), res):
+					for job in jobs:
+						print("%s: %s %s %s %s %s" % (kind, job["id"], job["tasks"], job["state"], job["name"], job["host"]))
+			time.sleep(args.interval)
+
+	# So that we clean up the socket.
+	signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+	JobStatusDaemon(socketPath=args.socket, interval=args.interval).run()
+
+
+if __name__ == "__main__":
+	main()
@@ -15,3 +15,38 @@ def get_str(s):
     if isinstance(s, bytes):
         return s.decode("utf8")
     raise Exception("Type not supported: %r" % s)
+
+
+def byteNumRepr(c):
+    """
+    :param int|float c: number of bytes
+    :return: human readable, e.g. "1.5 GB"
+    :rtype: str
+    """
+    if c < 1024: return "%i B" % c
+    S = "KMG"
+    i = 0
+    while i < len(S) - 1:
+        if c < 0.8 * 1024 ** (i + 2): break
+        i += 1
+    f = float(c) / (1024 ** (i + 1))
+    return "%.1f %sB" % (f, S[i])
+
+
+SizeSuffixes = "KMGT"
+
+
+def parseSize(s):
+    """
+    Inverse of :func:`byteNumRepr`, with 1024-based suffixes.
+
+    :param str s: e.g. "512M", "1.5G", "4096", "1 KiB"
+    :return: size in bytes
+    :rtype: int
+    """
+    import re
+    m = re.match(r"^(\d+(?:\.\d+)?) ?([%s]?)I?B?$" % SizeSuffixes, s.strip().upper())
+    if not m:
+        raise ValueError("invalid size %r, expected e.g. 4096, 512K, 1.5G" % s)
+    factor = 1024 ** (SizeSuffixes.index(m.group(2)) + 1) if m.group(2) else 1
+    return int(float(m.group(1)) * factor)
@@ -8,6 +8,11 @@ def loginUsername():
 	import pwd, os
 	return pwd.getpwuid(os.getuid())[0]
 
-LocalUser = loginUsername()
+def __getattr__(name):
+	# LocalUser is computed on first use, not at import.
+	if name == "LocalUser":
+		globals()["LocalUser"] = loginUsername()
+		return globals()["LocalUser"]
+	raise AttributeError("module %r has no attribute %r" % (__name__, name))
 
 
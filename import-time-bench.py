@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+"""
+Measures the import time of our library modules via `python -X importtime`,
+and checks it against a budget, as these modules are imported by shell prompt hooks, cron checks etc.
+Also checks that the import does not pull in modules which are only needed lazily
+(e.g. readline, socket, pwd), i.e. that there are no expensive import-time side effects.
+
+Exits with code 1 if a budget is exceeded.
+
+Example::
+
+	./import-time-bench.py
+	./import-time-bench.py --repeat 20 i6lib.sge
+"""
+
+import os
+import sys
+import subprocess
+from argparse import ArgumentParser
+
+MyDir = os.path.dirname(os.path.abspath(__file__))
+
+# module -> (budget in ms (cumulative import time, incl. the parent package), modules which must not be imported)
+Budgets = {
+	"i6lib.sge": (40., ["socket", "pwd", "xml.etree.ElementTree", "sqlite3", "tempfile", "pipes"]),
+	"i6lib.user": (10., ["pwd"]),
+	"i6lib.cgroup": (20., []),
+	"i6lib.cache": (20., ["sqlite3"]),
+	"lib.ui": (10., ["readline"]),
+	"lib.utils": (30., ["readline"]),
+}
+
+
+def measure(module):
+	"""
+	:param str module:
+	:return: (cumulative import time in ms, self import time per imported module in ms, all imported modules)
+	:rtype: (float,dict[str,float],set[str])
+	"""
+	out = subprocess.run(
+		[sys.executable, "-X", "importtime", "-c", "import sys, %s; print('\\n'.join(sys.modules))" % module],
+		cwd=MyDir, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True, universal_newlines=True)
+	total = None
+	selfTimes = {}
+	for line in out.stderr.splitlines():
+		if not line.startswith("import time:") or "[us]" in line:
+			continue
+		selfUs, cumulativeUs, name = line[len("import time:"):].split("|")
+		name = name.strip()
+		selfTimes[name] = int(selfUs) / 1000.
+		if name == module:
+			total = int(cumulativeUs) / 1000.
+	# Parent packages are imported first, and are not part of the cumulative time of the module.
+	parts = module.split(".")
+	for i in range(1, len(parts)):
+		total += selfTimes.get(".".join(parts[:i]), 0.)
+	return total, selfTimes, set(out.stdout.split())
+
+
+def main():
+	parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+	parser.add_argument("modules", nargs="*", help="default: all in Budgets")
+	parser.add_argument("--repeat", type=int, default=5, help="take the minimum over this many runs. default: 5")
+	parser.add_argument("--top", type=int, default=5, help="show the slowest imported modules. default: 5")
+	parser.add_argument(
+		"--budget-factor", type=float, default=1., help="scale all budgets, e.g. for slow machines. default: 1")
+	args = parser.parse_args()
+
+	ok = True
+	for module in args.modules or sorted(Budgets):
+		budget, forbidden = Budgets.get(module, (None, []))
+		times = []
+		selfTimes, imported = None, None
+		for i in range(args.repeat):
+			total, selfTimes_, imported = measure(module)
+			times.append(total)
+			if total == min(times):
+				selfTimes = selfTimes_
+		best = min(times)
+		status = "ok"
+		if budget is not None:
+			budget *= args.budget_factor
+		if budget is not None and best > budget:
+			status = "OVER BUDGET"
+			ok = False
+		bad = sorted(set(forbidden) & imported)
+		if bad:
+			status = "IMPORTS %s" % ", ".join(bad)
+			ok = False
+		print("%-15s %6.1f ms (budget %s ms, median %.1f ms): %s" % (
+			module, best, "%.0f" % budget if budget is not None else "-", sorted(times)[len(times) // 2], status))
+		for name, t in sorted(selfTimes.items(), key=lambda item: -item[1])[:args.top]:
+			print("  %6.1f ms  %s" % (t, name))
+	sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+	main()
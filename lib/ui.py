@@ -3,12 +3,21 @@
 from __future__ import print_function
 import sys
 
-try:
-    import readline
-except ImportError:
-    # noinspection SpellCheckingInspection
-    readline = None
-if readline:
+_readlineSetupDone = False
+
+def setupReadline():
+    """
+    Only done on the first interactive input, because importing and configuring readline
+    is relatively expensive, and most users of this module never ask anything.
+    """
+    global _readlineSetupDone
+    if _readlineSetupDone:
+        return
+    _readlineSetupDone = True
+    try:
+        import readline
+    except ImportError:
+        return
     readline.parse_and_bind("tab: complete")
     readline.parse_and_bind("set show-all-if-ambiguous on")
 
@@ -26,6 +35,7 @@ AllConfirmed = False
 def confirm(question):
     if AllConfirmed:
         return
+    setupReadline()
     while True:
         s = raw_input("%s Press enter to confirm or Ctrl+C otherwise." % question)
         if s == "":
@@ -35,6 +45,7 @@ def confirm(question):
 def seriousConfirm(question):
     if AllConfirmed:
         return
+    setupReadline()
     while True:
         s = raw_input("%s Type 'yes' to confirm." % question)
         if s == "yes":
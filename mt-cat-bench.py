@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark for mt-cat.py, compared to cat (and pv, if installed).
+
+For every combination of input size, input pattern, consumer and tool, this runs::
+
+	producer | tool | consumer
+
+and records the throughput, the peak RSS of the tool and the end-to-end latency per chunk.
+The producer and consumer are this script itself (subcommands produce/consume).
+The first line of each chunk carries the CLOCK_MONOTONIC send time, which is system-wide,
+so the consumer can measure the latency.
+
+The results are written as JSON lines, one per run, with the git commit,
+so that they can be compared across commits.
+
+Example::
+
+	./mt-cat-bench.py --sizes 10M,100M --read-max-sizes 64K,1M -o results.jsonl
+"""
+
+import os
+import sys
+import time
+import json
+import subprocess
+from argparse import ArgumentParser
+from i6lib.str_ import parseSize
+
+MyDir = os.path.dirname(os.path.abspath(__file__))
+MtCat = os.path.join(MyDir, "mt-cat.py")
+
+LineLen = 64  # every chunk consists of lines of this length
+
+# name -> (chunk size, burst length in chunks, pause after a burst in secs)
+InputPatterns = {
+	"bulk": (1024 * 1024, None, 0.),
+	"bursty": (64 * 1024, 64, 0.05),
+	"trickle": (4 * 1024, 1, 0.001),
+}
+
+# name -> (max bytes/sec or None, read for this long in secs, then pause for this long)
+Consumers = {
+	"fast": (None, None, 0.),
+	"slow": (50 * 1024 * 1024, None, 0.),
+	"bursty": (None, 0.05, 0.1),
+}
+
+
+def monotonic():
+	return time.clock_gettime(time.CLOCK_MONOTONIC)
+
+
+def percentiles(values):
+	"""
+	:param list[float] values:
+	:rtype: dict[str,float|None]
+	"""
+	values = sorted(values)
+	res = {}
+	for q in (50, 90, 99):
+		res["p%i" % q] = values[min(int(len(values) * q / 100.), len(values) - 1)] if values else None
+	res["max"] = values[-1] if values else None
+	return res
+
+
+def produce(size, pattern):
+	"""
+	Writes size bytes to stdout, in chunks as given by the pattern.
+
+	:param int size:
+	:param str pattern: key of InputPatterns
+	"""
+	chunk_size, burst_len, pause = InputPatterns[pattern]
+	chunk_size = max(chunk_size // LineLen, 1) * LineLen
+	filler = (b"x" * (LineLen - 1) + b"\n") * (chunk_size // LineLen - 1)
+	written = 0
+	count = 0
+	while written < size:
+		header = (b"T%.9f" % monotonic()).ljust(LineLen - 1) + b"\n"
+		chunk = memoryview(header + filler)[:size - written]
+		while chunk:
+			chunk = chunk[os.write(1, chunk):]
+		written += chunk_size
+		count += 1
+		if burst_len and count % burst_len == 0:
+			time.sleep(pause)
+
+
+def consume(result_file, consumer):
+	"""
+	Reads stdin until EOF, and writes the measured chunk latencies to result_file, as JSON.
+
+	:param str result_file:
+	:param str consumer: key of Consumers
+	"""
+	rate, read_period, pause = Consumers[consumer]
+	latencies = []
+	total = 0
+	rest = b""
+	start = period_start = monotonic()
+	while True:
+		buf = os.read(0, 1024 * 1024)
+		if not buf:
+			break
+		now = monotonic()
+		total += len(buf)
+		buf = rest + buf
+		# Lines are aligned to LineLen, so we only need to check the line starts.
+		usable = len(buf) - len(buf) % LineLen
+		for i in range(0, usable, LineLen):
+			if buf[i:i + 1] == b"T":
+				latencies.append(now - float(buf[i + 1:buf.index(b" ", i)]))
+		rest = buf[usable:]
+		if rate:
+			ahead = total / float(rate) - (now - start)
+			if ahead > 0:
+				time.sleep(ahead)
+		if read_period and now - period_start >= read_period:
+			time.sleep(pause)
+			period_start = monotonic()
+	with open(result_file, "w") as f:
+		json.dump({"bytes": total, "latencies": latencies}, f)
+
+
+def run_pipeline(tool_cmd, size, pattern, consumer):
+	"""
+	:param list[str] tool_cmd:
+	:param int size:
+	:param str pattern:
+	:param str consumer:
+	:return: measurements
+	:rtype: dict[str]
+	"""
+	import tempfile
+	me = [sys.executable, os.path.abspath(__file__)]
+	with tempfile.NamedTemporaryFile(prefix="mt-cat-bench-", suffix=".json") as result_file:
+		start = monotonic()
+		producer = subprocess.Popen(me + ["produce", str(size), pattern], stdout=subprocess.PIPE)
+		tool = subprocess.Popen(tool_cmd, stdin=producer.stdout, stdout=subprocess.PIPE)
+		producer.stdout.close()
+		consumer_proc = subprocess.Popen(me + ["consume", result_file.name, consumer], stdin=tool.stdout)
+		tool.stdout.close()
+		# wait4 to get the rusage of the tool only.
+		_, status, rusage = os.wait4(tool.pid, 0)
+		tool.returncode = os.waitstatus_to_exitcode(status)
+		producer.wait()
+		consumer_proc.wait()
+		duration = monotonic() - start
+		assert tool.returncode == 0, "%r failed with exit code %i" % (tool_cmd, tool.returncode)
+		with open(result_file.name) as f:
+			result = json.load(f)
+	assert result["bytes"] == size, "%r: got %i bytes, expected %i" % (tool_cmd, result["bytes"], size)
+	return {
+		"duration": duration,
+		"throughput": size / duration,
+		"peak_rss": rusage.ru_maxrss * 1024,
+		"user_time": rusage.ru_utime,
+		"sys_time": rusage.ru_stime,
+		"chunks": len(result["latencies"]),
+		"latency": percentiles(result["latencies"]),
+	}
+
+
+def get_tools(read_max_sizes, engines):
+	"""
+	:param list[int] read_max_sizes:
+	:param list[str] engines:
+	:return: list of (name, options, cmd)
+	:rtype: list[(str,dict[str],list[str])]
+	"""
+	tools = [("cat", {}, ["cat"])]
+	try:
+		subprocess.check_call(["pv", "--version"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+		tools.append(("pv", {}, ["pv", "-q"]))
+	except (OSError, subprocess.CalledProcessError):
+		pass
+	for engine in engines:
+		for read_max_size in read_max_sizes:
+			tools.append((
+				"mt-cat", {"engine": engine, "read_max_size": read_max_size},
+				[sys.executable, MtCat, "--mode", "thread", "--engine", engine, "--read-max-size", str(read_max_size)]))
+	return tools
+
+
+def get_git_commit():
+	try:
+		return subprocess.check_output(
+			["git", "rev-parse", "HEAD"], cwd=MyDir, stderr=subprocess.DEVNULL).decode("utf8").strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+def main():
+	if sys.argv[1:2] == ["produce"]:
+		produce(int(sys.argv[2]), sys.argv[3])
+		return
+	if sys.argv[1:2] == ["consume"]:
+		consume(sys.argv[2], sys.argv[3])
+		return
+	parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+	parser.add_argument("--sizes", default="10M", help="comma-separated input sizes. default: 10M")
+	parser.add_argument(
+		"--patterns", default=",".join(InputPatterns),
+		help="comma-separated input patterns, of: %s" % ", ".join(InputPatterns))
+	parser.add_argument(
+		"--consumers", default=",".join(Consumers),
+		help="comma-separated consumers, of: %s" % ", ".join(Consumers))
+	parser.add_argument(
+		"--read-max-sizes", default="64K,1000000", help="comma-separated mt-cat --read-max-size values")
+	parser.add_argument("--engines", default="thread,select", help="comma-separated mt-cat --engine values")
+	parser.add_argument("--repeat", type=int, default=1)
+	parser.add_argument("-o", "--output", help="append the JSON lines to this file. default: stdout")
+	args = parser.parse_args()
+
+	commit = get_git_commit()
+	tools = get_tools(list(map(parseSize, args.read_max_sizes.split(","))), args.engines.split(","))
+	out = open(args.output, "a") if args.output else sys.stdout
+	for size in map(parseSize, args.sizes.split(",")):
+		for pattern in args.patterns.split(","):
+			for consumer in args.consumers.split(","):
+				for tool, tool_opts, cmd in tools:
+					for i in range(args.repeat):
+						res = {
+							"commit": commit, "time": time.time(),
+							"size": size, "pattern": pattern, "consumer": consumer, "tool": tool}
+						res.update(tool_opts)
+						res.update(run_pipeline(cmd, size, pattern, consumer))
+						out.write(json.dumps(res, sort_keys=True) + "\n")
+						out.flush()
+						print(
+							"%s %s, %s input, %s consumer: %.1f MB/s, peak RSS %.1f MB, latency p50 %.2f ms" % (
+								tool, " ".join("%s=%s" % item for item in sorted(tool_opts.items())), pattern, consumer,
+								res["throughput"] / 1e6, res["peak_rss"] / 1e6,
+								(res["latency"]["p50"] or 0) * 1000),
+							file=sys.stderr)
+	if args.output:
+		out.close()
+
+
+if __name__ == "__main__":
+	main()
@@ -5,81 +5,1469 @@
 
 import os
 import sys
-from threading import Thread, Condition
-from argparse import ArgumentParser
+import stat
+import errno
+import fcntl
+import tempfile
+import time
+import random
+import selectors
+import struct
+import zlib
+import mmap
+from threading import Thread, Condition, Event, Lock
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+from argparse import ArgumentParser, ArgumentTypeError
+from i6lib.str_ import byteNumRepr, parseSize
 
 
 class Pipe:
-	def __init__(self):
-		self.buffer = []
+	"""
+	Decouples a reader from one or more writers.
+	The data is kept in a ring of reusable bytearray slabs.
+	The reader fills the free space of the last slab via :func:`readinto`,
+	and each writer drains memoryview slices via :func:`write`, with its own cursor.
+	Slabs which all writers have drained go back to the free pool.
+	If the writers fall behind, new slabs are allocated, up to max_buffer bytes.
+	Once that is reached, the reader blocks,
+	or, with spill=True, the overflow goes to a temporary file and is replayed from there.
+	All positions are absolute offsets in the stream.
+	"""
+
+	def __init__(
+			self, slab_size=1000000, num_slabs=4, max_buffer=None, spill=False, spill_dir=None, stats=None,
+			num_writers=1):
+		"""
+		:param int slab_size: also the max read size
+		:param int num_slabs: preallocated slabs, and max size of the free pool
+		:param int|None max_buffer: in bytes. None means unlimited
+		:param bool spill: when max_buffer is reached, spill to a temporary file instead of blocking the reader
+		:param str|None spill_dir: where to create the temporary file
+		:param PipeStats|None stats:
+		:param int num_writers: each runs :func:`writer_loop` with its own index
+		"""
+		self.slab_size = slab_size
+		self.num_slabs = num_slabs
+		self.max_slabs = max(max_buffer // slab_size, 1) if max_buffer else None
+		self.free = [bytearray(slab_size) for _ in range(num_slabs)]
+		self.slabs = deque()  # all are full, except maybe the last one
+		self.fill = 0  # used bytes in the last slab
+		self.base = 0  # stream offset of slabs[0]
+		self.end = 0  # stream offset of the end of the buffered data
+		self.cursors = [0] * num_writers  # stream offset per writer. None if the writer was removed
+		self.pos = 0  # min over the cursors, i.e. all writers are done with the data before
+		self.spill = spill
+		self.spill_dir = spill_dir
+		self.spill_file = None
+		self.spill_start = None  # stream offset of the spilled data. not None while spilling
+		self.stats = stats
 		self.cond = Condition()
+		self.push_lock = Lock()
+		self.reader_waiting = False
+		self.writers_waiting = 0
 		self.finish = False
+		self.error = None  # set by abort
 
-	def read(self):
+	def readinto(self, buf):
+		"""
+		:param memoryview buf:
+		:return: number of bytes read into buf, 0 on EOF
+		:rtype: int
+		"""
 		raise NotImplementedError
 
-	def write(self, v):
+	def write(self, buf):
+		"""
+		:param memoryview buf:
+		:return: number of bytes written
+		:rtype: int
+		"""
 		raise NotImplementedError
 
+	def _can_reserve(self):
+		if self.slabs and self.fill < self.slab_size:
+			return True
+		return self.max_slabs is None or len(self.slabs) < self.max_slabs
+
+	def _reserve(self):
+		"""
+		:return: free space right after the buffered data
+		:rtype: memoryview
+		"""
+		if not self.slabs or self.fill == self.slab_size:
+			self.slabs.append(self.free.pop() if self.free else bytearray(self.slab_size))
+			self.fill = 0
+		return memoryview(self.slabs[-1])[self.fill:]
+
+	def _commit(self, n):
+		self.fill += n
+		self.end += n
+
+	def _start_spill(self):
+		if self.spill_file is None:
+			self.spill_file = tempfile.TemporaryFile(prefix="mt-cat-spill-", dir=self.spill_dir)
+			self.spill_writebuf = bytearray(self.slab_size)
+		self.spill_start = self.end
+
+	def _stop_spill(self):
+		# All spilled data was written, thus also all slabs.
+		assert not self.slabs and self.pos == self.end
+		self.base = self.end
+		self.spill_start = None
+		os.ftruncate(self.spill_file.fileno(), 0)
+
+	def _in_spill(self, pos):
+		return self.spill_start is not None and pos >= self.spill_start
+
+	def _peek(self, pos):
+		"""
+		:param int pos: stream offset, pos < self.end, not in the spill file
+		:return: buffered data starting at pos, up to the end of its slab
+		:rtype: memoryview
+		"""
+		i, offset = divmod(pos - self.base, self.slab_size)
+		end = self.fill if i == len(self.slabs) - 1 else self.slab_size
+		return memoryview(self.slabs[i])[offset:end]
+
+	def _consume(self, writer_idx, n):
+		"""
+		:param int writer_idx:
+		:param int n:
+		:return: whether some slab was released
+		:rtype: bool
+		"""
+		self.cursors[writer_idx] += n
+		return self._release()
+
+	def _release(self):
+		"""
+		Releases the slabs before the min cursor.
+
+		:return: whether some slab was released
+		:rtype: bool
+		"""
+		cursors = [c for c in self.cursors if c is not None]
+		self.pos = min(cursors) if cursors else self.end
+		released = False
+		while self.slabs and self.pos - self.base >= self.slab_size:
+			slab = self.slabs.popleft()
+			self.base += self.slab_size
+			if len(self.free) < self.num_slabs:
+				self.free.append(slab)
+			released = True
+		return released
+
+	def remove_writer(self, writer_idx):
+		"""
+		Call this when a writer fails, so that the others can continue without it.
+		When there are no writers left, the reader stops.
+
+		:param int writer_idx:
+		"""
+		with self.cond:
+			self.cursors[writer_idx] = None
+			self._release()
+			self.cond.notify_all()
+
+	def has_writers(self):
+		return any(c is not None for c in self.cursors)
+
+	def abort(self, exc):
+		"""
+		Stops the reader and all writers, e.g. when the reader failed.
+		The first error is kept in self.error, to be reported at the end.
+
+		:param BaseException exc:
+		"""
+		with self.cond:
+			if self.error is None:
+				self.error = exc
+			self.finish = True
+			self.cursors = [None] * len(self.cursors)
+			self._release()
+			self.cond.notify_all()
+
+	def _reader_reserve(self):
+		"""
+		:return: (buffer to read into, offset in the spill file or None),
+			or None if the reader has to wait for the writers
+		:rtype: (memoryview, int|None)|None
+		"""
+		if self.spill_start is not None and self.pos >= self.end:
+			self._stop_spill()
+		if self.spill_start is None and not self._can_reserve():
+			if not self.spill:
+				return None
+			self._start_spill()
+		if self.spill_start is not None:
+			return memoryview(self.spill_writebuf), self.end - self.spill_start
+		return self._reserve(), None
+
+	def _spill_write(self, buf, spill_offset):
+		"""
+		Call this without holding the lock, before :func:`_reader_commit`.
+		"""
+		if spill_offset is None:
+			return
+		view = memoryview(buf)
+		while view:
+			n = os.pwrite(self.spill_file.fileno(), view, spill_offset)
+			view = view[n:]
+			spill_offset += n
+
+	def _reader_commit(self, n, spill_offset):
+		if spill_offset is None:
+			self._commit(n)
+		else:
+			self.end += n
+
+	def _writer_peek(self, writer_idx):
+		"""
+		:param int writer_idx: its cursor must be < self.end
+		:return: (buffered data, None), or (None, (offset, size)) if the data is in the spill file
+		:rtype: (memoryview|None, (int,int)|None)
+		"""
+		pos = self.cursors[writer_idx]
+		if self._in_spill(pos):
+			return None, (pos - self.spill_start, min(self.end - pos, self.slab_size))
+		return self._peek(pos), None
+
+	def _spill_read(self, buf, spill_range):
+		"""
+		Call this without holding the lock.
+
+		:param bytearray buf: scratch buffer of size self.slab_size
+		:param (int,int) spill_range: (offset, size)
+		:rtype: memoryview
+		"""
+		offset, size = spill_range
+		buf = memoryview(buf)[:size]
+		return buf[:os.preadv(self.spill_file.fileno(), [buf], offset)]
+
+	def push(self, data, read_time=0.):
+		"""
+		Appends data, as one piece, i.e. not interleaved with the pushes from other threads.
+		This is for multiple readers, instead of :func:`reader_loop`.
+		Blocks while max_buffer is reached, as :func:`reader_loop`.
+		Call :func:`close_input` when all readers are done.
+
+		:param bytes data:
+		:param float read_time: how long the reader was blocked for this, for the stats
+		:return: False if there are no writers anymore, i.e. the reader can stop
+		:rtype: bool
+		"""
+		view = memoryview(data)
+		with self.push_lock, self.cond:
+			while view:
+				if not self.has_writers():
+					return False
+				target = self._reader_reserve()
+				if not target:
+					if self.writers_waiting:  # for what we have committed so far
+						self.cond.notify_all()
+					self.reader_waiting = True
+					self.cond.wait()
+					self.reader_waiting = False
+					continue
+				buf, spill_offset = target
+				n = min(len(buf), len(view))
+				if spill_offset is None:
+					buf[:n] = view[:n]
+				else:
+					self._spill_write(view[:n], spill_offset)
+				self._reader_commit(n, spill_offset)
+				view = view[n:]
+			if self.stats:
+				now = time.perf_counter()
+				self.stats.on_read(self, len(data), read_time, now)
+			if self.writers_waiting:
+				self.cond.notify_all()
+			return True
+
+	def close_input(self):
+		"""
+		Marks the end of the data, when it was added via :func:`push`.
+		"""
+		with self.cond:
+			self.finish = True
+			self.cond.notify_all()
+
 	def reader_loop(self):
-		while True:
-			v = self.read()
-			with self.cond:
-				if v is None:
-					self.finish = True
-					self.cond.notifyAll()
-					return
-				self.buffer.append(v)
-				self.cond.notifyAll()
+		"""
+		If reading fails, the pipe is aborted (see :func:`abort`).
+		"""
+		stats = self.stats
+		try:
+			while True:
+				with self.cond:
+					while True:
+						if not self.has_writers():
+							return
+						target = self._reader_reserve()
+						if target:
+							break
+						self.reader_waiting = True
+						self.cond.wait()
+						self.reader_waiting = False
+					buf, spill_offset = target
+				if stats:
+					t0 = stats.read_since = time.perf_counter()
+				n = self.readinto(buf)
+				if stats:
+					t1 = time.perf_counter()
+				if n:
+					self._spill_write(buf[:n], spill_offset)
+				with self.cond:
+					if stats:
+						stats.on_read(self, n, t1 - t0, t1)
+					if not n:
+						return
+					self._reader_commit(n, spill_offset)
+					if self.writers_waiting:
+						self.cond.notify_all()
+		except Exception as exc:
+			self.abort(exc)
+		finally:
+			self.close_input()
 
-	def writer_loop(self):
+	def writer_loop(self, writer_idx=0, write=None):
+		"""
+		:param int writer_idx:
+		:param ((memoryview)->int)|None write: if not given, :func:`write`
+		"""
+		if write is None:
+			write = self.write
+		stats = self.stats
+		spill_readbuf = None
 		while True:
 			with self.cond:
 				while True:
-					if self.buffer:
+					if self.error is not None:
+						return
+					if self.cursors[writer_idx] < self.end:
 						break
 					if self.finish:
 						return
-					self.cond.wait(timeout=1)
-				v = self.buffer.pop(0)
-			self.write(v)
+					self.writers_waiting += 1
+					self.cond.wait()
+					self.writers_waiting -= 1
+				buf, spill_range = self._writer_peek(writer_idx)
+			if spill_range:
+				if spill_readbuf is None:
+					spill_readbuf = bytearray(self.slab_size)
+				buf = self._spill_read(spill_readbuf, spill_range)
+			if stats:
+				t0 = stats.write_since = time.perf_counter()
+			n = write(buf)
+			if stats:
+				t1 = time.perf_counter()
+			with self.cond:
+				if self.error is not None:
+					return
+				if self._consume(writer_idx, n) and self.reader_waiting:
+					self.cond.notify_all()
+				if stats:
+					stats.on_write(self, n, t1 - t0, t1)
 
 
-def main():
-	parser = ArgumentParser(description='Multithreaded cat. Reads stdin and writes to stdout in parallel.')
-	args = parser.parse_args()  # ignored at the moment.
+class Samples:
+	"""
+	Fixed-size uniform random sample (reservoir sampling) of a stream of values, for percentiles.
+	"""
 
-	sin_fd = sys.stdin.fileno()
-	sout = open(sys.stdout.fileno(), "wb", buffering=0, closefd=False)
-	read_max_size = 1000000
-
-	def read():
-		# This has the behavior which we actually want:
-		#  - If there are <= read_max_size bytes available, it will return those immediately,
-		#    i.e. it will not block to wait until read_max_size bytes are available.
-		#  - If there are 0 bytes available, it will block and wait until some bytes are available.
-		v = os.read(sin_fd, read_max_size)
-		return v or None
-	def write(v):
-		sout.write(v)
-		sout.flush()
-
-	pipe = Pipe()
-	pipe.read = read
+	def __init__(self, max_size=100000):
+		self.max_size = max_size
+		self.values = []
+		self.count = 0
+		self.max = None
+
+	def add(self, v):
+		self.count += 1
+		if self.max is None or v > self.max:
+			self.max = v
+		if len(self.values) < self.max_size:
+			self.values.append(v)
+			return
+		i = random.randrange(self.count)
+		if i < self.max_size:
+			self.values[i] = v
+
+	def percentile(self, q):
+		"""
+		:param float q: between 0 and 100
+		:rtype: float|None
+		"""
+		if not self.values:
+			return None
+		values = sorted(self.values)
+		return values[min(int(len(values) * q / 100.), len(values) - 1)]
+
+	def repr_ms(self):
+		if not self.values:
+			return "n/a"
+		return "p50 %.2f ms, p90 %.2f ms, p99 %.2f ms, max %.2f ms (%i samples)" % (
+			self.percentile(50) * 1000, self.percentile(90) * 1000, self.percentile(99) * 1000, self.max * 1000,
+			self.count)
+
+
+class PipeStats:
+	"""
+	Counters of a :class:`Pipe`, updated by its reader and writer loop while holding its lock.
+	The chunk latency is the time from the end of the read of a chunk until it is completely written.
+	"""
+
+	def __init__(self):
+		self.start_time = time.perf_counter()
+		self.bytes_in = 0
+		self.bytes_out = 0
+		self.read_time = 0.0  # blocked in readinto
+		self.write_time = 0.0  # blocked in write
+		self.read_since = None  # start time of the current readinto
+		self.write_since = None  # start time of the current write
+		self.peak_depth = 0
+		self.pending = deque()  # (stream end offset, time) of chunks which are not completely written yet
+		self.chunk_latency = Samples()
+		self.write_latency = Samples()
+		self.last = None  # (time, bytes_in, bytes_out, read_time, write_time) of the last report
+
+	def on_read(self, pipe, n, duration, now):
+		self.bytes_in += n
+		self.read_time += duration
+		self.read_since = None
+		if n:
+			self.pending.append((pipe.end, now))
+			self.peak_depth = max(self.peak_depth, pipe.end - pipe.pos)
+
+	def on_write(self, pipe, n, duration, now):
+		self.bytes_out += n
+		self.write_time += duration
+		self.write_since = None
+		self.write_latency.add(duration)
+		while self.pending and self.pending[0][0] <= pipe.pos:
+			self.chunk_latency.add(now - self.pending.popleft()[1])
+
+	def report_line(self, pipe):
+		"""
+		:param Pipe pipe:
+		:return: stats since the last call
+		:rtype: str
+		"""
+		with pipe.cond:
+			now = time.perf_counter()
+			# Count a read/write which is still blocking as well.
+			read_time = self.read_time + (now - self.read_since if self.read_since else 0.)
+			write_time = self.write_time + (now - self.write_since if self.write_since else 0.)
+			cur = (now, self.bytes_in, self.bytes_out, read_time, write_time)
+			depth = pipe.end - pipe.pos
+		last = self.last or (self.start_time, 0, 0, 0.0, 0.0)
+		self.last = cur
+		dt = max(cur[0] - last[0], 1e-6)
+		return "mt-cat stats: in %s/s, out %s/s, buffer %s, reader blocked %i%%, writer blocked %i%%" % (
+			byteNumRepr((cur[1] - last[1]) / dt), byteNumRepr((cur[2] - last[2]) / dt), byteNumRepr(depth),
+			round(100. * (cur[3] - last[3]) / dt), round(100. * (cur[4] - last[4]) / dt))
+
+	def summary(self):
+		"""
+		:rtype: str
+		"""
+		dt = max(time.perf_counter() - self.start_time, 1e-6)
+		return "\n".join([
+			"mt-cat summary: %s in, %s out in %.1f s, %s/s" % (
+				byteNumRepr(self.bytes_in), byteNumRepr(self.bytes_out), dt, byteNumRepr(self.bytes_out / dt)),
+			"mt-cat summary: peak buffer %s, reader blocked %.1f s, writer blocked %.1f s" % (
+				byteNumRepr(self.peak_depth), self.read_time, self.write_time),
+			"mt-cat summary: chunk latency %s" % self.chunk_latency.repr_ms(),
+			"mt-cat summary: write latency %s" % self.write_latency.repr_ms()])
+
+
+class CompressError(Exception):
+	pass
+
+
+class ParallelCompressor:
+	"""
+	Compresses blocks in a thread pool, pigz-style, and writes them in the original order
+	from a separate output thread.
+	zlib, bz2 and lzma release the GIL while compressing, so this scales over the cores.
+
+	gzip and zlib give a single stream: each block is compressed as raw deflate, ended with a sync flush,
+	and primed with the last 32KB of the previous block as dictionary, like pigz does.
+	We write the header and the trailer (checksum, size) around that.
+	bz2 and lzma (xz) give one stream per block, which their decompressors concatenate.
+	"""
+
+	Formats = ("gzip", "zlib", "bz2", "lzma")
+	Levels = {"gzip": (0, 9), "zlib": (0, 9), "bz2": (1, 9), "lzma": (0, 9)}  # valid compression levels
+	DeflateWindow = 32 * 1024
+
+	def __init__(self, fmt, write, level=None, block_size=1024 * 1024, num_threads=None):
+		"""
+		:param str fmt: one of Formats
+		:param (memoryview|bytes)->int write: output, can write partially
+		:param int|None level: compression level
+		:param int block_size: uncompressed size per block
+		:param int|None num_threads: default is the number of CPUs
+		"""
+		assert fmt in self.Formats
+		self.fmt = fmt
+		self.out_write = write
+		self.level = level
+		self.block_size = block_size
+		self.block = bytearray()
+		self.prev_tail = b""  # for the deflate dictionary
+		self.checksum = zlib.crc32(b"") if fmt == "gzip" else zlib.adler32(b"")
+		self.size = 0
+		num_threads = num_threads or os.cpu_count() or 1
+		self.pool = ThreadPoolExecutor(num_threads, thread_name_prefix="compress")
+		self.queue = Queue(maxsize=2 * num_threads)  # futures in order, None at the end
+		self.error = None
+		self.output_thread = Thread(name="compress output", target=self._output_loop)
+		self.output_thread.daemon = True
+		self.output_thread.start()
+		if fmt == "gzip":
+			# magic, deflate, no flags, mtime, no extra flags, OS unix
+			self._put(struct.pack("<4sIBB", b"\x1f\x8b\x08\x00", int(time.time()), 0, 3))
+		elif fmt == "zlib":
+			self._put(b"\x78\x9c")  # deflate with 32KB window, default level
+
+	def _put(self, data):
+		if self.error:
+			raise self.error
+		self.queue.put(data)
+
+	def _output_loop(self):
+		while True:
+			item = self.queue.get()
+			if item is None:
+				return
+			if self.error:
+				continue  # just drain, so that _put does not block
+			try:
+				data = item if isinstance(item, bytes) else item.result()
+				view = memoryview(data)
+				while view:
+					view = view[self.out_write(view):]
+			except OSError as exc:
+				self.error = exc
+			except Exception as exc:
+				self.error = CompressError("%s compression failed: %s: %s" % (self.fmt, type(exc).__name__, exc))
+
+	def _compress(self, block, zdict):
+		"""
+		Runs in the pool.
+
+		:param bytes block:
+		:param bytes zdict:
+		:rtype: bytes
+		"""
+		level = self.level
+		if self.fmt in ("gzip", "zlib"):
+			opts = {"zdict": zdict} if zdict else {}
+			c = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION if level is None else level, zlib.DEFLATED, -15, **opts)
+			return c.compress(block) + c.flush(zlib.Z_SYNC_FLUSH)
+		if self.fmt == "bz2":
+			import bz2
+			return bz2.compress(block, 9 if level is None else level)
+		import lzma
+		return lzma.compress(block, preset=level)
+
+	def _submit_block(self):
+		block = bytes(self.block)
+		self.block = bytearray()
+		if self.fmt == "gzip":
+			self.checksum = zlib.crc32(block, self.checksum)
+		elif self.fmt == "zlib":
+			self.checksum = zlib.adler32(block, self.checksum)
+		self.size += len(block)
+		self._put(self.pool.submit(self._compress, block, self.prev_tail))
+		if self.fmt in ("gzip", "zlib"):
+			self.prev_tail = block[-self.DeflateWindow:]
+
+	def write(self, buf):
+		"""
+		:param memoryview buf:
+		:return: number of bytes consumed, i.e. len(buf)
+		:rtype: int
+		"""
+		if self.error:
+			raise self.error
+		self.block += buf
+		if len(self.block) >= self.block_size:
+			self._submit_block()
+		return len(buf)
+
+	def close(self):
+		"""
+		Compresses the remaining data, writes the trailer and waits for the output.
+		"""
+		if self.block or (not self.size and self.fmt in ("bz2", "lzma")):  # bz2/lzma: at least one (empty) stream
+			self._submit_block()
+		if self.fmt in ("gzip", "zlib"):
+			trailer = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15).flush(zlib.Z_FINISH)
+			if self.fmt == "gzip":
+				trailer += struct.pack("<II", self.checksum & 0xffffffff, self.size & 0xffffffff)
+			else:
+				trailer += struct.pack(">I", self.checksum & 0xffffffff)
+			self._put(trailer)
+		self.queue.put(None)
+		self.output_thread.join()
+		self.pool.shutdown()
+		if self.error:
+			raise self.error
+
+	def abort(self):
+		"""
+		Stops without writing the remaining data and the trailer,
+		so that the output is not a complete-looking stream.
+		"""
+		if not self.error:
+			self.error = CompressError("aborted")
+		self.queue.put(None)
+		self.output_thread.join()
+		self.pool.shutdown(cancel_futures=True)
+
+
+def merge_reader_loop(pipe, filename, fd, size, prefix=None):
+	"""
+	Reads one of multiple merged inputs, and pushes only complete lines to the pipe,
+	so lines from different inputs are never torn.
+	Only a single line longer than size is pushed in pieces.
+	At EOF, a missing final newline is added.
+
+	:param Pipe pipe:
+	:param str filename: "-" is stdin
+	:param int fd: of filename. closed at the end, except stdin
+	:param int size: read size
+	:param str|None prefix: for every line, with %s for the filename
+	:return: False if the pipe has no writers anymore
+	:rtype: bool
+	"""
+	prefix = (prefix % filename).encode("utf8") if prefix else None
+	at_line_start = True
+
+	def push(chunk, read_time):
+		nonlocal at_line_start
+		if prefix:
+			lines = chunk.split(b"\n")
+			chunk = b"\n".join([prefix + line for line in lines[:-1]] + [prefix + lines[-1] if lines[-1] else b""])
+			if not at_line_start:
+				chunk = chunk[len(prefix):]
+		at_line_start = chunk.endswith(b"\n")
+		return pipe.push(chunk, read_time)
+
+	pending = b""
+	try:
+		while True:
+			t0 = time.perf_counter()
+			try:
+				data = os.read(fd, size)
+			except OSError as exc:
+				raise OSError(exc.errno, exc.strerror, filename)
+			read_time = time.perf_counter() - t0
+			if not data:
+				break
+			end = data.rfind(b"\n") + 1
+			if end:
+				chunk, pending = pending + data[:end], data[end:]
+			elif len(pending) + len(data) >= size:
+				chunk, pending = pending + data, b""
+			else:
+				pending += data
+				continue
+			if not push(chunk, read_time):
+				return False
+		if pending:
+			return push(pending + b"\n", 0.)
+		return True
+	finally:
+		if filename != "-":
+			os.close(fd)
+
+
+class FileReadahead:
+	"""
+	Reads a regular file ahead of the :class:`Pipe` reader,
+	either with parallel os.pread workers, or via mmap with madvise hints to the kernel.
+	On network filesystems, several outstanding reads use the bandwidth much better than a single serial read.
+	The data is returned in order, via :func:`readinto`.
+	Data which was appended to the file after we started is read normally.
+
+	With mmap, accessing pages beyond the end of a file which was truncated meanwhile raises SIGBUS,
+	which would kill the process. We check the file size before every copy, which leaves only a small race,
+	so use mmap only for files which are not truncated while we read them.
+	With pread, a truncated file just ends early.
+	"""
+
+	def __init__(self, fd, block_size, num_workers=4, use_mmap=False):
+		"""
+		:param int fd: regular file
+		:param int block_size: size per pread, or per madvise window
+		:param int num_workers: number of pread threads. with mmap, how many windows to advise ahead
+		:param bool use_mmap:
+		"""
+		self.fd = fd
+		self.block_size = block_size
+		self.num_workers = num_workers
+		self.offset = os.lseek(fd, 0, os.SEEK_CUR)
+		self.size = os.fstat(fd).st_size
+		self.mmap = None
+		self.pool = None
+		if use_mmap and self.size > self.offset:
+			self.mmap = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+			self.mmap.madvise(mmap.MADV_SEQUENTIAL)
+			self.advised_end = self.offset
+		elif not use_mmap:
+			self.pool = ThreadPoolExecutor(num_workers, thread_name_prefix="readahead")
+			self.futures = deque()  # (offset, future)
+			self.next_offset = self.offset  # of the next block to submit
+			self.current = memoryview(b"")  # remaining part of the current block
+
+	def _readinto_mmap(self, buf):
+		self.size = min(self.size, os.fstat(self.fd).st_size)  # truncated meanwhile? see the class docstring
+		if self.offset >= self.size:
+			return 0
+		window = self.block_size * self.num_workers
+		while self.advised_end < min(self.offset + window, self.size):
+			start = self.advised_end - self.advised_end % mmap.PAGESIZE
+			self.mmap.madvise(mmap.MADV_WILLNEED, start, min(self.block_size, self.size - start))
+			self.advised_end = start + self.block_size
+		n = min(len(buf), self.size - self.offset)
+		buf[:n] = self.mmap[self.offset:self.offset + n]
+		return n
+
+	def _readinto_pread(self, buf):
+		if not self.current:
+			while len(self.futures) < self.num_workers * 2 and self.next_offset < self.size:
+				self.futures.append(
+					(self.next_offset, self.pool.submit(os.pread, self.fd, self.block_size, self.next_offset)))
+				self.next_offset += self.block_size
+			if not self.futures:
+				return 0
+			offset, future = self.futures.popleft()
+			assert offset == self.offset
+			data = future.result()
+			if len(data) < self.block_size:
+				data = self._complete_block(data)
+			self.current = memoryview(data)
+			if not self.current:
+				return 0
+		n = min(len(buf), len(self.current))
+		buf[:n] = self.current[:n]
+		self.current = self.current[n:]
+		return n
+
+	def _complete_block(self, data):
+		"""
+		A pread can return less than requested, e.g. on network filesystems or at the end of the file.
+		Read the remainder of the block at the right offset.
+		If we hit EOF before, the file ended early (last block, or truncated), and the blocks after are void.
+
+		:param bytes data: short result of the pread at self.offset
+		:return: the complete block, or up to EOF
+		:rtype: bytes
+		"""
+		parts = [data]
+		offset = self.offset + len(data)
+		left = self.block_size - len(data)
+		while left > 0:
+			part = os.pread(self.fd, left, offset)
+			if not part:
+				self.size = offset
+				for _, future in self.futures:
+					future.cancel()
+				self.futures.clear()
+				self.next_offset = self.size
+				break
+			parts.append(part)
+			offset += len(part)
+			left -= len(part)
+		return b"".join(parts)
+
+	def readinto(self, buf):
+		"""
+		:param memoryview buf:
+		:return: number of bytes read into buf, 0 on EOF
+		:rtype: int
+		"""
+		n = 0
+		if self.offset < self.size:
+			if self.mmap is not None:
+				n = self._readinto_mmap(buf)
+			elif self.pool is not None:
+				n = self._readinto_pread(buf)
+		if not n:
+			n = os.preadv(self.fd, [buf], self.offset)
+		self.offset += n
+		return n
+
+	def close(self):
+		"""
+		Leaves the file position at where we stopped reading.
+		"""
+		if self.mmap is not None:
+			self.mmap.close()
+		if self.pool is not None:
+			self.pool.shutdown(cancel_futures=True)
+		os.lseek(self.fd, self.offset, os.SEEK_SET)
+
+
+# If the kernel refuses a transfer with one of these right away, we fall back to the threaded copy.
+KernelFallbackErrnos = {errno.EINVAL, errno.ENOSYS, errno.EXDEV, errno.EBADF, errno.EOPNOTSUPP, errno.ESPIPE}
+
+
+def get_fd_kind(fd):
+	"""
+	:param int fd:
+	:return: "pipe", "file" or "other"
+	:rtype: str
+	"""
+	mode = os.fstat(fd).st_mode
+	if stat.S_ISFIFO(mode):
+		return "pipe"
+	if stat.S_ISREG(mode):
+		return "file"
+	return "other"
+
+
+def choose_mode(sin_fd, sout_fd):
+	"""
+	Regular file input never blocks, i.e. there is nothing to decouple,
+	so we can let the kernel do the whole copy.
+	For pipe input, we want the unbounded decoupling of the threaded copy.
+	The splice mode only buffers up to the pipe capacity, so it must be chosen explicitly.
+
+	:param int sin_fd:
+	:param int sout_fd:
+	:rtype: str
+	"""
+	if get_fd_kind(sin_fd) != "file":
+		return "thread"
+	if get_fd_kind(sout_fd) == "file" and hasattr(os, "copy_file_range"):
+		return "copy_file_range"
+	if hasattr(os, "sendfile"):
+		return "sendfile"
+	return "thread"
+
+
+def kernel_transfer_loop(transfer, size):
+	"""
+	:param (int)->int transfer: moves up to size bytes, returns the number of bytes, 0 on EOF
+	:param int size:
+	:return: False if the kernel refused the very first transfer, i.e. nothing was copied
+	:rtype: bool
+	"""
+	first = True
+	while True:
+		try:
+			n = transfer(size)
+		except OSError as exc:
+			if first and exc.errno in KernelFallbackErrnos:
+				return False
+			raise
+		if not n:
+			return True
+		first = False
+
+
+def splice_copy(sin_fd, sout_fd, size):
+	"""
+	Reader and writer thread, decoupled by an intermediate kernel pipe.
+	The writer falls back to a user-space copy if the output does not support splice.
+
+	:param int sin_fd:
+	:param int sout_fd:
+	:param int size:
+	:return: False if the kernel refused the very first transfer, i.e. nothing was copied
+	:rtype: bool
+	"""
+	pr, pw = os.pipe()
+	errors = []
+	try:
+		with open("/proc/sys/fs/pipe-max-size") as f:
+			fcntl.fcntl(pw, getattr(fcntl, "F_SETPIPE_SZ", 1031), int(f.read()))
+	except (IOError, OSError):
+		pass  # keep the default pipe capacity
+
+	def reader():
+		try:
+			while os.splice(sin_fd, pw, size):
+				pass
+		except OSError as exc:
+			errors.append(exc)
+		finally:
+			os.close(pw)
+
+	def writer():
+		try:
+			try:
+				while os.splice(pr, sout_fd, size):
+					pass
+			except OSError as exc:
+				if exc.errno not in KernelFallbackErrnos:
+					raise
+				while True:
+					v = os.read(pr, size)
+					if not v:
+						break
+					while v:
+						v = v[os.write(sout_fd, v):]
+		except OSError as exc:
+			errors.append(exc)
+		finally:
+			# If we stopped early (e.g. EPIPE), the reader gets EPIPE as well, instead of blocking on the full pipe.
+			os.close(pr)
+
+	try:
+		# Splice the first chunk here, to be able to fall back when the input does not support it.
+		if not os.splice(sin_fd, pw, size):
+			os.close(pw)
+			pw = None
+	except OSError as exc:
+		os.close(pr)
+		os.close(pw)
+		if exc.errno in KernelFallbackErrnos:
+			return False
+		raise
+	threads = [Thread(name="writer", target=writer)]
+	if pw is not None:
+		threads.append(Thread(name="reader", target=reader))
+	for t in threads:
+		t.daemon = True
+		t.start()
+	for t in threads:
+		t.join()
+	if errors:
+		raise errors[0]  # the first one is the cause. e.g. the EPIPE of the reader follows from the writer
+	return True
+
+
+def threaded_copy(
+		sin_fd, sout_fd, size, inputs=None, merge=False, prefix=None, readahead=None, use_mmap=False,
+		outputs=(), stats_interval=None, compress=None, **pipe_opts):
+	"""
+	:param int sin_fd:
+	:param int sout_fd:
+	:param int size: read size
+	:param list[str]|None inputs: filenames ("-" is stdin), read one after another, instead of sin_fd.
+		each is opened only when we get to it, see :func:`open_input_file`
+	:param bool merge: read the inputs in parallel, each with its own reader thread,
+		and merge their lines into the output
+	:param str|None prefix: for merge, prefix for every line, with %s for the input filename
+	:param int|None readahead: number of parallel pread workers for regular file inputs (not for merge)
+	:param bool use_mmap: read regular file inputs via mmap with madvise hints instead (not for merge)
+	:param list[str] outputs: additional files to write to, like tee. each gets its own writer thread.
+		when one of them fails, we continue with the others
+	:param float|None stats_interval: if set, print stats to stderr periodically, and a summary at the end
+	:param dict[str]|None compress: if set, compress stdout. kwargs for :class:`ParallelCompressor`
+	:param pipe_opts: passed to :class:`Pipe`
+	:return: False if some of the inputs failed. the errors are reported on stderr
+	:rtype: bool
+	"""
+	sout = open(sout_fd, "wb", buffering=0, closefd=False)
+	remaining_inputs = list(inputs or [])
+	failed_inputs = []
+	cur_fd = None
+	cur_filename = None
+	cur_readahead = None
+
+	def input_failed(exc):
+		print("mt-cat: %s" % error_str(exc), file=sys.stderr)
+		failed_inputs.append(exc.filename)
+
+	def open_input(filename, fd):
+		nonlocal cur_fd, cur_filename, cur_readahead
+		if fd is None:
+			try:
+				fd = open_input_file(filename, sin_fd)
+			except OSError as exc:
+				input_failed(exc)  # like cat, continue with the next input
+				return
+		cur_fd = fd
+		cur_filename = filename
+		if (readahead or use_mmap) and get_fd_kind(fd) == "file":
+			cur_readahead = FileReadahead(fd, size, num_workers=readahead or 4, use_mmap=use_mmap)
+
+	def close_input():
+		nonlocal cur_fd, cur_readahead
+		if cur_readahead:
+			cur_readahead.close()
+			cur_readahead = None
+		if cur_fd != sin_fd:
+			os.close(cur_fd)
+		cur_fd = None
+
+	if not inputs:
+		open_input(None, sin_fd)
+
+	def readinto(buf):
+		while True:
+			if cur_fd is None:
+				if not remaining_inputs:
+					return 0
+				open_input(remaining_inputs.pop(0), None)
+				continue
+			try:
+				if cur_readahead:
+					n = cur_readahead.readinto(buf)
+				else:
+					# This has the behavior which we actually want:
+					#  - If there are <= len(buf) bytes available, it will return those immediately,
+					#    i.e. it will not block to wait until the buffer is full.
+					#  - If there are 0 bytes available, it will block and wait until some bytes are available.
+					n = os.readv(cur_fd, [buf])
+			except OSError as exc:
+				if not cur_filename:
+					raise
+				# Like cat, report it, and continue with the next input.
+				input_failed(OSError(exc.errno, exc.strerror, cur_filename))
+				n = 0
+			if n:
+				return n
+			close_input()
+			if not remaining_inputs:
+				return 0
+	def write(buf):
+		return sout.write(buf)
+
+	stats = PipeStats() if stats_interval else None
+	pipe = Pipe(slab_size=size, stats=stats, num_writers=1 + len(outputs), **pipe_opts)
+	pipe.readinto = readinto
 	pipe.write = write
-	reader = Thread(name="reader", target=pipe.reader_loop)
-	writer = Thread(name="writer", target=pipe.writer_loop)
+
+	def output_writer_loop(writer_idx, filename):
+		try:
+			# Open it here, as opening a FIFO blocks until there is a reader.
+			with open(filename, "wb", buffering=0) as f:
+				pipe.writer_loop(writer_idx, f.write)
+		except (IOError, OSError) as exc:
+			print("mt-cat: %s, continue without it" % exc, file=sys.stderr)
+			pipe.remove_writer(writer_idx)
+
+	def compress_writer_loop():
+		compressor = ParallelCompressor(write=write, **compress)
+		try:
+			pipe.writer_loop(0, compressor.write)
+		except Exception:
+			compressor.abort()
+			raise
+		if pipe.error is not None:
+			compressor.abort()  # the input failed
+		else:
+			compressor.close()
+
+	def main_writer_loop():
+		try:
+			if compress:
+				compress_writer_loop()
+			else:
+				pipe.writer_loop()
+		except Exception as exc:
+			# Unlike the --output files, we cannot continue without stdout.
+			# Also, its cursor would keep all the data in the buffer.
+			pipe.abort(exc)
+
+	def merge_input_loop(filename):
+		try:
+			# Open it here, so that a FIFO without a writer yet does not block the other inputs.
+			merge_reader_loop(pipe, filename, open_input_file(filename, sin_fd), size, prefix)
+		except OSError as exc:
+			if exc.filename != filename:
+				pipe.abort(exc)
+			else:
+				input_failed(exc)  # continue with the other inputs
+		except Exception as exc:
+			pipe.abort(exc)
+
+	def merge_loop():
+		readers = [
+			Thread(name="reader %s" % filename, target=merge_input_loop, args=(filename,))
+			for filename in inputs]
+		try:
+			for t in readers:
+				t.daemon = True
+				t.start()
+			for t in readers:
+				t.join()
+		finally:
+			pipe.close_input()
+
+	reader = Thread(name="reader", target=merge_loop if merge else pipe.reader_loop)
+	writers = [Thread(name="writer", target=main_writer_loop)]
+	for i, filename in enumerate(outputs):
+		writers.append(Thread(name="writer %s" % filename, target=output_writer_loop, args=(i + 1, filename)))
 	reader.daemon = True
-	writer.daemon = True
 	reader.start()
-	writer.start()
+	for writer in writers:
+		writer.daemon = True
+		writer.start()
+	if stats:
+		done = Event()
+
+		def stats_loop():
+			while not done.wait(stats_interval):
+				print(stats.report_line(pipe), file=sys.stderr)
+
+		stats_thread = Thread(name="stats", target=stats_loop)
+		stats_thread.daemon = True
+		stats_thread.start()
 	try:
 		reader.join()
-		writer.join()
+		for writer in writers:
+			writer.join()
+	finally:
+		if stats:
+			done.set()
+			print(stats.summary(), file=sys.stderr)
+	if pipe.error is not None:
+		raise pipe.error
+	return not failed_inputs
+
+
+def selector_copy(sin_fd, sout_fd, size, outputs=(), stats_interval=None, **pipe_opts):
+	"""
+	Single-threaded alternative to :func:`threaded_copy`, driven by fd readiness events.
+	There are no polling timeouts, i.e. we only wake up when some fd is ready,
+	or when the next stats line is due.
+	Unlike :func:`threaded_copy`, the outputs are opened upfront.
+
+	:param int sin_fd: from :func:`reopen_nonblocking`
+	:param int sout_fd: from :func:`reopen_nonblocking`
+	:param int size: read size
+	:param list[str] outputs: additional files to write to, like tee. when one of them fails, we continue without it
+	:param float|None stats_interval: if set, print stats to stderr periodically, and a summary at the end
+	:param pipe_opts: passed to :class:`Pipe`
+	"""
+	out_fds = [sout_fd]
+	for filename in outputs:
+		try:
+			out_fds.append(os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666))
+		except OSError as exc:
+			print("mt-cat: %s, continue without it" % exc, file=sys.stderr)
+	stats = PipeStats() if stats_interval else None
+	pipe = Pipe(slab_size=size, stats=stats, num_writers=len(out_fds), **pipe_opts)
+	# Poll also works for regular files, unlike epoll.
+	sel = selectors.PollSelector() if hasattr(selectors, "PollSelector") else selectors.DefaultSelector()
+	interest = {}  # fd -> registered events
+	spill_readbuf = None
+	next_report = time.perf_counter() + stats_interval if stats else None
+
+	def set_interest(fd, events):
+		cur = interest.get(fd, 0)
+		if cur == events:
+			return
+		if not events:
+			sel.unregister(fd)
+			del interest[fd]
+			return
+		if cur:
+			sel.modify(fd, events)
+		else:
+			sel.register(fd, events)
+		interest[fd] = events
+
+	for fd in out_fds[1:]:  # we opened them, i.e. nobody else shares the open file description
+		fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+	try:
+		eof = False
+		while True:
+			read_target = None
+			if not eof and pipe.has_writers():
+				read_target = pipe._reader_reserve()
+			set_interest(sin_fd, selectors.EVENT_READ if read_target else 0)
+			for i, fd in enumerate(out_fds):
+				pending = pipe.cursors[i] is not None and pipe.cursors[i] < pipe.end
+				set_interest(fd, selectors.EVENT_WRITE if pending else 0)
+			if not interest:
+				break  # EOF and everything written, or no writers left
+			timeout = None
+			if stats:
+				now = time.perf_counter()
+				if now >= next_report:
+					print(stats.report_line(pipe), file=sys.stderr)
+					next_report = now + stats_interval
+				timeout = next_report - now
+			for key, _ in sel.select(timeout):
+				if key.fd == sin_fd:
+					buf, spill_offset = read_target
+					t0 = time.perf_counter()
+					try:
+						n = os.readv(sin_fd, [buf])
+					except BlockingIOError:
+						continue
+					t1 = time.perf_counter()
+					if stats:
+						stats.on_read(pipe, n, t1 - t0, t1)
+					if not n:
+						eof = True
+						continue
+					pipe._spill_write(buf[:n], spill_offset)
+					pipe._reader_commit(n, spill_offset)
+				else:
+					i = out_fds.index(key.fd)
+					buf, spill_range = pipe._writer_peek(i)
+					if spill_range:
+						if spill_readbuf is None:
+							spill_readbuf = bytearray(size)
+						buf = pipe._spill_read(spill_readbuf, spill_range)
+					t0 = time.perf_counter()
+					try:
+						n = os.write(key.fd, buf)
+					except BlockingIOError:
+						continue
+					except OSError as exc:
+						if i == 0:
+							raise
+						print("mt-cat: %s: %s, continue without it" % (outputs[i - 1], exc), file=sys.stderr)
+						pipe.remove_writer(i)
+						continue
+					t1 = time.perf_counter()
+					pipe._consume(i, n)
+					if stats:
+						stats.on_write(pipe, n, t1 - t0, t1)
+	finally:
+		for fd in out_fds[1:]:
+			os.close(fd)
+		sel.close()
+		if stats:
+			print(stats.summary(), file=sys.stderr)
+
+
+def reopen_nonblocking(fd, flags):
+	"""
+	O_NONBLOCK is a flag of the open file description, which an inherited fd shares with other processes,
+	e.g. with the shell for a terminal, or with the other commands of a pipeline,
+	so we must not set it on our stdin/stdout.
+	A pipe can be opened again via /proc though, which gives us our own open file description.
+	Regular files never block, so we can use them as they are.
+
+	:param int fd:
+	:param int flags: os.O_RDONLY or os.O_WRONLY
+	:return: non-blocking fd for :func:`selector_copy`, fd itself if that is already fine,
+		or None if not possible, e.g. for a terminal or socket
+	:rtype: int|None
+	"""
+	kind = get_fd_kind(fd)
+	if kind == "file":
+		return fd
+	if kind != "pipe":
+		return None
+	try:
+		return os.open("/proc/self/fd/%i" % fd, flags | os.O_NONBLOCK)
+	except OSError:
+		return None
+
+
+def error_str(exc):
+	"""
+	:param OSError exc:
+	:return: like cat reports errors, e.g. "foo: No such file or directory"
+	:rtype: str
+	"""
+	if exc.filename is not None:
+		return "%s: %s" % (exc.filename, exc.strerror)
+	return exc.strerror or str(exc)
+
+
+def open_input_file(filename, sin_fd):
+	"""
+	Like cat, we open an input only when we get to it.
+	Opening a FIFO blocks until there is a writer, so opening all upfront could deadlock with the writers.
+
+	:param str filename: "-" is stdin
+	:param int sin_fd:
+	:return: fd. on error, raises OSError with the filename
+	:rtype: int
+	"""
+	if filename == "-":
+		return sin_fd
+	return os.open(filename, os.O_RDONLY)
+
+
+def parse_size(s):
+	"""
+	Argument type for argparse, see :func:`i6lib.str_.parseSize`.
+	All our sizes must be positive. E.g. a read size of 0 would look like EOF.
+
+	:param str s: e.g. "512M", "1G", "4096"
+	:return: size in bytes
+	:rtype: int
+	"""
+	try:
+		size = parseSize(s)
+	except ValueError as exc:
+		raise ArgumentTypeError(str(exc))
+	if size < 1:
+		raise ArgumentTypeError("invalid size %r, must be at least 1 byte" % s)
+	return size
+
+
+def main():
+	parser = ArgumentParser(description='Multithreaded cat. Reads stdin and writes to stdout in parallel.')
+	parser.add_argument(
+		"inputs", nargs="*", metavar="FILE", help="read these instead of stdin, one after another, like cat. - is stdin")
+	parser.add_argument(
+		"--merge", action="store_true",
+		help="read the inputs in parallel and merge them line-wise. lines are never torn or interleaved."
+		" needs the thread engine")
+	parser.add_argument("--prefix", action="store_true", help="with --merge, prefix every line with its filename")
+	parser.add_argument(
+		"--prefix-format", default="%s: ", metavar="FMT",
+		help="format of --prefix, with %%s for the filename. default: '%%s: '")
+	parser.add_argument(
+		"-o", "--output", action="append", default=[], metavar="FILE",
+		help="also write to this file (or FIFO, or /dev/fd/N), like tee. can be given multiple times."
+		" each output has its own writer, so a slow one does not stall the others")
+	parser.add_argument(
+		"--mode", choices=["auto", "thread", "splice", "sendfile", "copy_file_range"], default="auto",
+		help="how to copy the data. auto uses copy_file_range/sendfile for file input, otherwise thread")
+	parser.add_argument(
+		"--engine", choices=["thread", "select"], default="thread",
+		help="for the thread mode: reader and writer threads, or a single thread driven by fd readiness events."
+		" select falls back to thread if stdin or stdout is not a pipe or regular file")
+	parser.add_argument(
+		"--read-max-size", type=parse_size, default=1000000, metavar="SIZE",
+		help="max size of a single read, and the slab size of the buffer. default: 1000000")
+	parser.add_argument(
+		"--readahead", type=int, metavar="N",
+		help="read regular file inputs with N parallel pread workers, e.g. for network filesystems."
+		" implies the thread mode in auto mode")
+	parser.add_argument(
+		"--mmap", action="store_true",
+		help="read regular file inputs via mmap, with sequential/willneed hints. implies the thread mode in auto mode")
+	parser.add_argument(
+		"--max-buffer", type=parse_size, metavar="SIZE",
+		help="max memory for buffered data, e.g. 512M. the reader blocks when it is reached. default: unlimited")
+	parser.add_argument(
+		"--spill", action="store_true",
+		help="instead of blocking the reader at --max-buffer, spill to a temporary file")
+	parser.add_argument("--spill-dir", help="directory for the spill file. default: $TMPDIR")
+	parser.add_argument(
+		"--stats", nargs="?", type=float, const=10.0, metavar="INTERVAL",
+		help="print throughput and buffer stats to stderr every INTERVAL secs (default 10), and a summary at the end."
+		" implies the thread mode in auto mode")
+	parser.add_argument(
+		"--compress", choices=ParallelCompressor.Formats,
+		help="compress stdout, with blocks compressed in parallel (like pigz). needs the thread engine")
+	parser.add_argument("--compress-level", type=int, help="compression level of --compress")
+	parser.add_argument(
+		"--compress-threads", type=int, help="number of compression threads. default: number of CPUs")
+	parser.add_argument(
+		"--compress-block", type=parse_size, default=1024 * 1024, metavar="SIZE",
+		help="uncompressed size per compressed block. default: 1M")
+	parser.add_argument("-v", "--verbose", action="store_true", help="report the chosen mode on stderr")
+	args = parser.parse_args()
+
+	sin_fd = sys.stdin.fileno()
+	sout_fd = sys.stdout.fileno()
+	read_max_size = args.read_max_size
+	if args.prefix and not args.merge:
+		parser.error("--prefix needs --merge")
+	if args.merge and len(args.inputs) < 2:
+		parser.error("--merge needs at least two inputs")
+	if args.readahead is not None and args.readahead < 1:
+		parser.error("--readahead must be at least 1")
+	# Like cat, we report the inputs which fail, continue with the others, and fail at the end.
+	inputs_ok = True
+	inputs = args.inputs or None
+	if len(args.inputs) == 1 and not args.merge:
+		try:
+			sin_fd = open_input_file(args.inputs[0], sin_fd)  # e.g. for the kernel copy modes
+		except OSError as exc:
+			print("mt-cat: %s" % error_str(exc), file=sys.stderr)
+			sys.exit(1)
+		inputs = None
+
+	mode = args.mode
+	if mode == "auto":
+		if args.stats or args.output or args.compress or inputs or args.readahead or args.mmap:
+			mode = "thread"
+		else:
+			mode = choose_mode(sin_fd, sout_fd)
+	if mode != "thread" and inputs:
+		parser.error("multiple inputs need the thread mode")
+	if args.engine != "thread" and inputs:
+		parser.error("multiple inputs need the thread engine")
+	if args.engine != "thread" and (args.readahead or args.mmap):
+		parser.error("--readahead and --mmap need the thread engine")
+	if mode != "thread" and args.output:
+		parser.error("--output needs the thread mode")
+	if args.compress and (mode != "thread" or args.engine != "thread"):
+		parser.error("--compress needs the thread mode and the thread engine")
+	if args.compress_level is not None:
+		if not args.compress:
+			parser.error("--compress-level needs --compress")
+		min_level, max_level = ParallelCompressor.Levels[args.compress]
+		if not min_level <= args.compress_level <= max_level:
+			parser.error("--compress-level for %s must be between %i and %i" % (args.compress, min_level, max_level))
+	if args.compress_threads is not None:
+		if not args.compress:
+			parser.error("--compress-threads needs --compress")
+		if args.compress_threads < 1:
+			parser.error("--compress-threads must be at least 1")
+	compress = None
+	if args.compress:
+		compress = dict(
+			fmt=args.compress, level=args.compress_level,
+			block_size=args.compress_block, num_threads=args.compress_threads)
+	if mode == "splice" and not hasattr(os, "splice"):
+		mode = "thread"
+
+	def report(mode_):
+		if args.verbose:
+			print("mt-cat: %s mode" % mode_, file=sys.stderr)
+
+	try:
+		if mode == "copy_file_range":
+			ok = kernel_transfer_loop(lambda n: os.copy_file_range(sin_fd, sout_fd, n), read_max_size)
+		elif mode == "sendfile":
+			ok = kernel_transfer_loop(lambda n: os.sendfile(sout_fd, sin_fd, None, n), read_max_size)
+		elif mode == "splice":
+			ok = splice_copy(sin_fd, sout_fd, read_max_size)
+		else:
+			ok = False
+		if ok:
+			report(mode)
+			return
+		engine = args.engine
+		copy_in_fd, copy_out_fd = sin_fd, sout_fd
+		if engine == "select":
+			copy_in_fd = reopen_nonblocking(sin_fd, os.O_RDONLY)
+			copy_out_fd = reopen_nonblocking(sout_fd, os.O_WRONLY)
+			if copy_in_fd is None or copy_out_fd is None:
+				engine = "thread"  # stdin/stdout is e.g. a terminal or socket
+				for fd in (copy_in_fd, copy_out_fd):
+					if fd not in (None, sin_fd, sout_fd):
+						os.close(fd)
+				copy_in_fd, copy_out_fd = sin_fd, sout_fd
+		if mode != "thread":
+			report("%s not supported, thread (%s engine)" % (mode, engine))
+		else:
+			report("thread (%s engine)" % engine)
+		opts = dict(compress=compress) if compress else {}
+		if args.readahead or args.mmap:
+			opts.update(readahead=args.readahead, use_mmap=args.mmap)
+		if inputs:
+			opts.update(inputs=inputs, merge=args.merge, prefix=args.prefix_format if args.prefix else None)
+		copy = {"thread": threaded_copy, "select": selector_copy}[engine]
+		if copy(
+				copy_in_fd, copy_out_fd, read_max_size, outputs=args.output, stats_interval=args.stats,
+				max_buffer=args.max_buffer, spill=args.spill, spill_dir=args.spill_dir, **opts) is False:
+			inputs_ok = False  # some input failed. already reported
 	except KeyboardInterrupt:
 		pass
+	except BrokenPipeError:
+		sys.exit(1)  # the consumer went away. like cat (without SIGPIPE), no message for this
+	except (IOError, OSError) as exc:
+		print("mt-cat: %s" % error_str(exc), file=sys.stderr)
+		sys.exit(1)
+	except CompressError as exc:
+		print("mt-cat: %s" % exc, file=sys.stderr)
+		sys.exit(1)
+	if not inputs_ok:
+		sys.exit(1)
 
 
 if __name__ == "__main__":
 	main()
-
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+
+"""
+Scaling benchmark for i6lib.sge, against the fake qstat/qhost/ssh in fake-sge/ (see fake-sge/fakesge.py).
+
+For every number of jobs, this measures in a fresh process:
+
+	getCurrentJobs: qstat -xml listing
+	getCurrentJobsMoreInfo: plus qstat -j for every job, cold and warm (qstatInfoCache)
+	checkHangingHost: a single healthy host, and a hanging one (should take HangCheckCatProcTimeout)
+	checkHangingHosts: sweep over the hosts of all running jobs
+
+and records the wall time, the peak RSS and the number of qstat/ssh calls.
+The results are written as JSON lines, one per run, with the git commit,
+so that they can be compared across commits.
+
+Example::
+
+	./sge-bench.py --jobs 10,1000,10000 --qstat-latency 0.2 --ssh-latency 0.1 -o results.jsonl
+"""
+
+import os
+import sys
+import time
+import json
+import resource
+import tempfile
+import subprocess
+from argparse import ArgumentParser
+
+MyDir = os.path.dirname(os.path.abspath(__file__))
+FakeSgeDir = os.path.join(MyDir, "fake-sge")
+HangHost = "cluster-cn-hang"  # matched by FAKE_SGE_HANG_HOSTS, not a real execution host of the fake cluster
+
+Cases = ["getCurrentJobs", "getCurrentJobsMoreInfo", "checkHangingHost", "checkHangingHosts"]
+
+
+def run_case(case, args):
+	"""
+	Runs in the child process. The fake cluster is configured via env by the parent.
+
+	:param str case:
+	:param args: from the ArgumentParser
+	:rtype: dict[str]
+	"""
+	from i6lib import sge
+	sge.UseJobStatusDaemon = False
+	if args.on_cluster:
+		sge.notOnCluster = False
+	sge.SshMultiplexing = not args.no_multiplex
+	sge.SshControlDir = tempfile.mkdtemp(prefix="sge-bench-ssh-")
+	sge.HangCheckCatProcTimeout = args.hang_timeout
+	sge.isNotOnCluster()  # prints the "Not on cluster" msg, not part of the timing
+	res = {}
+	try:
+		if case == "getCurrentJobs":
+			start = time.time()
+			jobs = sge.getCurrentJobs()
+			res["duration"] = time.time() - start
+			res["num_results"] = len(jobs)
+		elif case == "getCurrentJobsMoreInfo":
+			start = time.time()
+			jobs = sge.getCurrentJobsMoreInfo()
+			res["duration"] = time.time() - start
+			res["num_results"] = len(jobs)
+			res["num_missing"] = len([job for job in jobs if job["cwd"] is None])
+			start = time.time()
+			sge.getCurrentJobsMoreInfo()
+			res["duration_warm"] = time.time() - start
+		elif case == "checkHangingHost":
+			host = sge.getClusterHosts()[0]
+			start = time.time()
+			sge.checkHangingHost(host)
+			res["duration"] = time.time() - start
+			start = time.time()
+			try:
+				sge.checkHangingHost(HangHost)
+			except sge.HangingException:
+				res["hang_detected"] = True
+			else:
+				res["hang_detected"] = False
+			res["duration_hang"] = time.time() - start
+		elif case == "checkHangingHosts":
+			hosts = sorted(set([job["host"].split("@")[-1] for job in sge.getCurrentJobs() if job["host"]]))
+			start = time.time()
+			results = sge.checkHangingHosts(hosts, maxInFlight=args.max_in_flight)
+			res["duration"] = time.time() - start
+			res["num_results"] = len(results)
+			res["num_not_ok"] = len([r for r in results if r.status != "ok"])
+		else:
+			raise Exception("unknown case %r" % case)
+	finally:
+		sge.sshTeardown()
+		os.rmdir(sge.SshControlDir)
+	res["peak_rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+	return res
+
+
+def count_calls(log_filename):
+	"""
+	:param str log_filename: FAKE_SGE_LOG
+	:return: program -> number of calls. ssh calls over a master connection count as ssh_mux
+	:rtype: dict[str,int]
+	"""
+	calls = {}
+	if not os.path.exists(log_filename):
+		return calls
+	for line in open(log_filename):
+		prog = line.split()[0]
+		if prog == "ssh" and "ControlMaster=no" in line:
+			prog = "ssh_mux"
+		calls[prog] = calls.get(prog, 0) + 1
+	return calls
+
+
+def run_child(case, num_jobs, args):
+	"""
+	:param str case:
+	:param int num_jobs:
+	:param args: from the ArgumentParser
+	:rtype: dict[str]
+	"""
+	with tempfile.NamedTemporaryFile(prefix="sge-bench-", suffix=".log") as log_file:
+		env = dict(os.environ)
+		env.update({
+			"PATH": "%s:%s" % (FakeSgeDir, os.environ.get("PATH", "")),
+			"FAKE_SGE_JOBS": str(num_jobs),
+			"FAKE_SGE_USERS": args.users,
+			"FAKE_SGE_HOSTS": str(args.hosts),
+			"FAKE_SGE_QSTAT_LATENCY": str(args.qstat_latency),
+			"FAKE_SGE_QSTAT_JOB_LATENCY": str(args.qstat_job_latency),
+			"FAKE_SGE_SSH_LATENCY": str(args.ssh_latency),
+			"FAKE_SGE_SSH_MUX_LATENCY": str(args.ssh_mux_latency),
+			"FAKE_SGE_MISSING_EVERY": str(args.missing_every),
+			"FAKE_SGE_HANG_HOSTS": ",".join([HangHost] + ([args.hang_hosts] if args.hang_hosts else [])),
+			"FAKE_SGE_DEAD_HOSTS": args.dead_hosts or "",
+			"FAKE_SGE_LOG": log_file.name})
+		env.pop("I6LIB_QSTAT_CACHE_DB", None)
+		cmd = [sys.executable, os.path.abspath(__file__), "run", case] + sys.argv[1:]
+		out = subprocess.check_output(cmd, env=env)
+		res = json.loads(out.decode("utf8").splitlines()[-1])
+		res["calls"] = count_calls(log_file.name)
+	return res
+
+
+def get_git_commit():
+	try:
+		return subprocess.check_output(
+			["git", "rev-parse", "HEAD"], cwd=MyDir, stderr=subprocess.DEVNULL).decode("utf8").strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+def main():
+	child_case = None
+	argv = sys.argv[1:]
+	if argv[:1] == ["run"]:
+		child_case = argv[1]
+		argv = argv[2:]
+	parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+	parser.add_argument("--jobs", default="10,1000,10000", help="comma-separated numbers of jobs of the user")
+	parser.add_argument("--cases", default=",".join(Cases), help="comma-separated, of: %s" % ", ".join(Cases))
+	parser.add_argument(
+		"--users", help="comma-separated users of the fake cluster. the first one is us. default: us and 3 others")
+	parser.add_argument("--hosts", type=int, default=100, help="number of execution hosts. default: 100")
+	parser.add_argument("--qstat-latency", type=float, default=0., help="secs per qstat call")
+	parser.add_argument("--qstat-job-latency", type=float, default=0., help="additional secs per job in qstat output")
+	parser.add_argument("--ssh-latency", type=float, default=0., help="secs for an ssh connection setup")
+	parser.add_argument(
+		"--ssh-mux-latency", type=float, default=0., help="secs for an ssh session over a master connection")
+	parser.add_argument("--missing-every", type=int, default=0, help="every n-th job is missing in qstat -j")
+	parser.add_argument("--hang-hosts", help="hostname pattern, where `cat /proc/modules` hangs")
+	parser.add_argument("--dead-hosts", help="hostname pattern, where ssh cannot connect")
+	parser.add_argument(
+		"--hang-timeout", type=float, default=1., help="sge.HangCheckCatProcTimeout for the benchmark. default: 1")
+	parser.add_argument("--max-in-flight", type=int, default=32, help="for checkHangingHosts. default: 32")
+	parser.add_argument("--on-cluster", action="store_true", help="run qstat directly, not via ssh to cluster-cn-01")
+	parser.add_argument("--no-multiplex", action="store_true", help="disable ssh master connections")
+	parser.add_argument("--repeat", type=int, default=1)
+	parser.add_argument("-o", "--output", help="append the JSON lines to this file. default: stdout")
+	args = parser.parse_args(argv)
+
+	if child_case:
+		print(json.dumps(run_case(child_case, args)))
+		return
+
+	if not args.users:
+		from i6lib.user import loginUsername
+		args.users = ",".join([loginUsername(), "fake-user-a", "fake-user-b", "fake-user-c"])
+		sys.argv += ["--users", args.users]  # for the child processes
+	commit = get_git_commit()
+	out = open(args.output, "a") if args.output else sys.stdout
+	for num_jobs in map(int, args.jobs.split(",")):
+		for case in args.cases.split(","):
+			for i in range(args.repeat):
+				res = {
+					"commit": commit, "time": time.time(), "case": case, "jobs": num_jobs,
+					"hosts": args.hosts, "on_cluster": args.on_cluster, "multiplex": not args.no_multiplex,
+					"qstat_latency": args.qstat_latency, "qstat_job_latency": args.qstat_job_latency,
+					"ssh_latency": args.ssh_latency, "ssh_mux_latency": args.ssh_mux_latency,
+					"missing_every": args.missing_every}
+				res.update(run_child(case, num_jobs, args))
+				out.write(json.dumps(res, sort_keys=True) + "\n")
+				out.flush()
+				print(
+					"%s, %i jobs: %.3fs%s, peak RSS %.1f MB, calls: %s" % (
+						case, num_jobs, res["duration"],
+						"".join([
+							", %s %s" % (key[len("duration_"):], "%.3fs" % res[key])
+							for key in sorted(res) if key.startswith("duration_")]),
+						res["peak_rss"] / 1e6,
+						" ".join(["%s=%i" % item for item in sorted(res["calls"].items())]) or "-"),
+					file=sys.stderr)
+	if args.output:
+		out.close()
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+"""
+Checks many cluster hosts concurrently for hanging (no ssh connection, or `cat /proc/modules` hangs),
+and prints a table with the result per host.
+
+Example::
+
+	./sge-hang-sweep.py --qhost -j 64
+	./sge-hang-sweep.py cluster-cn-211 cluster-cn-212
+"""
+
+import sys
+import json
+from argparse import ArgumentParser
+from i6lib import sge
+
+
+def main():
+	parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+	parser.add_argument("hosts", nargs="*")
+	parser.add_argument("-f", "--hosts-file", help="file with one hostname per line")
+	parser.add_argument("--qhost", action="store_true", help="check all execution hosts, as listed by qhost")
+	parser.add_argument("-j", "--max-in-flight", type=int, default=32, help="max concurrent checks. default: 32")
+	parser.add_argument("--json", action="store_true", help="print JSON lines instead of a table")
+	parser.add_argument("-v", "--verbose", action="store_true", help="print every result as soon as it is done")
+	args = parser.parse_args()
+
+	hosts = list(args.hosts)
+	if args.hosts_file:
+		hosts += [line.strip() for line in open(args.hosts_file) if line.strip() and not line.startswith("#")]
+	if args.qhost:
+		hosts += sge.getClusterHosts()
+	if not hosts:
+		parser.error("no hosts given")
+
+	def callback(res):
+		if args.verbose:
+			print("%s: %s (%.1fs)" % (res.hostname, res.status, res.duration), file=sys.stderr)
+
+	results = sge.checkHangingHosts(hosts, maxInFlight=args.max_in_flight, callback=callback)
+
+	if args.json:
+		for res in results:
+			print(json.dumps({
+				"host": res.hostname, "status": res.status, "duration": res.duration, "connect_time": res.connectTime,
+				"error": str(res.exception) if res.exception else None}))
+	else:
+		hostLen = max([len(res.hostname) for res in results] + [4])
+		print("%-*s  %-20s  %7s  %7s  %s" % (hostLen, "host", "status", "total", "connect", "details"))
+		for res in sorted(results, key=lambda res: (res.status == "ok", res.hostname)):
+			print("%-*s  %-20s  %6.1fs  %7s  %s" % (
+				hostLen, res.hostname, res.status, res.duration,
+				"%.1fs" % res.connectTime if res.connectTime is not None else "-",
+				str(res.exception)[:100] if res.exception and res.status == "unexpected_output" else ""))
+	numBad = len([res for res in results if res.status != "ok"])
+	print("%i hosts, %i ok, %i not ok" % (len(results), len(results) - numBad, numBad), file=sys.stderr)
+	sys.exit(1 if numBad else 0)
+
+
+if __name__ == "__main__":
+	main()
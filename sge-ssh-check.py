@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+"""
+Checks the ssh master connection handling of i6lib.sge against the fake ssh in fake-sge/ (see fake-sge/fakesge.py),
+via its call log: master reuse, at most one `ssh -O check` per host and SshMasterRetryInterval,
+removal of stale sockets, and that a hang check never blocks on a master start.
+
+Exits with code 1 if a check fails.
+
+Example::
+
+	./sge-ssh-check.py
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+from subprocess import Popen, PIPE
+
+MyDir = os.path.dirname(os.path.abspath(__file__))
+FakeSgeDir = os.path.join(MyDir, "fake-sge")
+Gateway = "cluster-cn-01"
+
+
+class Env:
+	"""
+	Fresh fake cluster env and fresh i6lib.sge state, as in a new process.
+	"""
+
+	def __init__(self, tmpDir):
+		"""
+		:param str tmpDir:
+		"""
+		from i6lib import sge
+		self.sge = sge
+		self.logFilename = os.path.join(tmpDir, "calls.log")
+		self.controlDir = os.path.join(tmpDir, "ssh")
+		os.environ["PATH"] = "%s:%s" % (FakeSgeDir, os.environ.get("PATH", ""))
+		os.environ["FAKE_SGE_LOG"] = self.logFilename
+		os.environ["FAKE_SGE_JOBS"] = "3"
+		os.environ["FAKE_SGE_HOSTS"] = "5"
+		sge.UseJobStatusDaemon = False
+		sge.SshMultiplexing = True
+		sge.SshControlDir = self.controlDir
+		self.newProcess(notOnCluster=True)
+
+	def newProcess(self, notOnCluster):
+		"""
+		Resets the module state, but keeps the control sockets, like a new process would see them.
+
+		:param bool notOnCluster:
+		"""
+		self.sge.notOnCluster = notOnCluster
+		self.sge._sshMasterStartTimes.clear()
+		self.sge._sshControlDirOk = None
+		if os.path.exists(self.logFilename):
+			os.unlink(self.logFilename)
+
+	def calls(self):
+		"""
+		:return: kind -> number of ssh calls, kind is "check", "exit", "master", "mux" or "direct"
+		:rtype: dict[str,int]
+		"""
+		res = {}
+		if not os.path.exists(self.logFilename):
+			return res
+		for line in open(self.logFilename):
+			if not line.startswith("ssh "):
+				continue
+			if " -O " in line:
+				kind = line.split(" -O ")[1].split()[0]
+			elif "ControlMaster=yes" in line:
+				kind = "master"
+			elif "ControlMaster=no" in line:
+				kind = "mux"
+			else:
+				kind = "direct"
+			res[kind] = res.get(kind, 0) + 1
+		return res
+
+	def runClusterCmd(self):
+		"""
+		:return: stderr
+		:rtype: bytes
+		"""
+		proc = Popen(self.sge.clusterCmd(["qstat", "-xml"]), stdout=PIPE, stderr=PIPE)
+		out, err = proc.communicate()
+		assert proc.returncode == 0 and b"<job_info" in out, (proc.returncode, err)
+		return err
+
+
+def checkReuse(env):
+	env.newProcess(notOnCluster=True)
+	env.runClusterCmd()
+	env.runClusterCmd()
+	calls = env.calls()
+	assert calls == {"master": 1, "mux": 2}, calls
+	assert os.path.exists(env.sge.sshControlPath(Gateway))
+
+
+def checkExistingMasterIsCheckedOnce(env):
+	env.newProcess(notOnCluster=True)  # the master of checkReuse is still there
+	for i in range(3):
+		env.runClusterCmd()
+	calls = env.calls()
+	assert calls == {"check": 1, "mux": 3}, calls
+
+
+def checkStaleSocket(env):
+	env.newProcess(notOnCluster=True)
+	with open(env.sge.sshControlPath(Gateway), "w") as f:
+		f.write("stale")  # see the fake ssh
+	err = env.runClusterCmd()
+	assert b"Control socket" not in err, err
+	calls = env.calls()
+	assert calls == {"check": 1, "exit": 1, "master": 1, "mux": 1}, calls
+	assert open(env.sge.sshControlPath(Gateway)).read() != "stale"
+
+
+def checkSshCmdHasNoSideEffects(env):
+	env.newProcess(notOnCluster=True)
+	env.sge.sshCmd("cluster-cn-02", ["true"])
+	assert env.calls() == {}, env.calls()
+	assert not os.path.exists(env.sge.sshControlPath("cluster-cn-02"))
+
+
+def checkHangCheckStaleSocket(env):
+	env.newProcess(notOnCluster=False)
+	host = "cluster-cn-03"
+	with open(env.sge.sshControlPath(host), "w") as f:
+		f.write("stale")
+	env.sge.checkHangingHost(host)
+	assert not os.path.exists(env.sge.sshControlPath(host)), "stale socket not removed"
+	env.sge.checkHangingHost(host)  # starts a new master
+	env.sge.checkHangingHost(host)  # uses it
+	calls = env.calls()
+	assert calls == {"check": 1, "exit": 1, "master": 1, "mux": 3}, calls
+	assert os.path.exists(env.sge.sshControlPath(host))
+
+
+def checkHangCheckDoesNotWaitForMaster(env):
+	env.newProcess(notOnCluster=False)
+	os.environ["FAKE_SGE_DEAD_HOSTS"] = "cluster-cn-dead"  # ssh waits for ConnectTimeout=3 there
+	env.sge.HangCheckBeginTimeout = 1.
+	try:
+		start = time.time()
+		try:
+			env.sge.checkHangingHost("cluster-cn-dead")
+		except env.sge.TimeoutException:
+			pass
+		else:
+			assert False, "no timeout"
+		duration = time.time() - start
+		assert duration < 2., "took %.1f secs" % duration
+	finally:
+		del os.environ["FAKE_SGE_DEAD_HOSTS"]
+		env.sge.HangCheckBeginTimeout = 10.
+
+
+def checkForeignControlDir(env):
+	env.newProcess(notOnCluster=True)
+	os.chmod(env.controlDir, 0o777)
+	try:
+		assert not env.sge.useSshMultiplexing()
+		cmd = env.sge.clusterCmd(["qstat"])
+		assert not [arg for arg in cmd if arg.startswith("ControlPath=")], cmd
+	finally:
+		os.chmod(env.controlDir, 0o700)
+		env.sge._sshControlDirOk = None
+
+
+Checks = [
+	checkReuse, checkExistingMasterIsCheckedOnce, checkStaleSocket, checkSshCmdHasNoSideEffects,
+	checkHangCheckStaleSocket, checkHangCheckDoesNotWaitForMaster, checkForeignControlDir]
+
+
+def main():
+	sys.path.insert(0, MyDir)
+	tmpDir = tempfile.mkdtemp(prefix="sge-ssh-check-")
+	ok = True
+	try:
+		env = Env(tmpDir)
+		for check in Checks:
+			try:
+				check(env)
+			except AssertionError as exc:
+				print("%s: FAILED: %s" % (check.__name__, exc))
+				ok = False
+			else:
+				print("%s: ok" % check.__name__)
+	finally:
+		shutil.rmtree(tmpDir)
+	sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+	main()